@@ -3,13 +3,40 @@
 import os
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, flash, redirect, session, g, jsonify, request
+from flask import (
+    Flask, render_template, stream_template, flash, redirect, session, g,
+    stream_with_context, make_response,
+    jsonify, request, get_flashed_messages, abort, url_for,
+)
 # from flask_debugtoolbar import DebugToolbarExtension
+from markupsafe import Markup
+from sqlalchemy import and_, delete, func, select
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import or_
-
-from forms import CafeInfoForm, SignupForm, LoginForm, CsrfForm, ProfileEditForm
-from models import connect_db, Cafe, db, City, User, Like, Speciality
+from werkzeug.local import LocalProxy
+from werkzeug.utils import send_file
+
+from forms import (
+    CafeInfoForm, SignupForm, LoginForm, CsrfForm, ProfileEditForm,
+    parse_specialities,
+)
+from models import connect_db, Cafe, CachedUser, db, City, User, Like, Speciality
+from passwords import PasswordHasherBusy
+from pagination import KeysetPage, OffsetPage
+from caching import LRUCache
+from likebuffer import LikeBuffer
+from commands import cafes_cli, maps_cli
+from export import EXPORT_MIMETYPES, iter_export
+from search import cached_search
+from suggest import suggestions
+from tasks import map_jobs
+from images import MIMETYPES, get_derivative_path
+from imageproxy import ImageProxy, ImageProxyError
+from photos import is_remote
+from mapping import (
+    MAP_FILE, MAP_VERSION_LENGTH, get_map_etag, get_map_path, get_map_version,
+)
+from conditional import add_validators, is_conditional, is_not_modified
+from conditional import make_etag, not_modified
 
 load_dotenv()
 
@@ -18,6 +45,81 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
     "DATABASE_URL", 'postgresql:///flask_cafe')
 app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY')
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# 0 hashes inline; set it for web workers, where a pool keeps bcrypt from
+# holding up other requests
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 0))
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(
+    os.environ.get('PASSWORD_HASH_MAX_PENDING', 32))
+# 0 runs jobs in the request that enqueues them
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_RETRIES'] = int(os.environ.get('JOB_RETRIES', 3))
+app.config['JOB_BACKOFF'] = float(os.environ.get('JOB_BACKOFF', 2.0))
+app.config['CAFES_PER_PAGE'] = int(os.environ.get('CAFES_PER_PAGE', 24))
+app.config['CAFES_MAX_PER_PAGE'] = 100
+
+# 'fulltext' (ranked, whole words) or 'trigram' (substring and typos;
+# needs the pg_trgm extension)
+app.config['SEARCH_MODE'] = os.environ.get('SEARCH_MODE', 'fulltext')
+app.config['SEARCH_CACHE_SIZE'] = int(os.environ.get('SEARCH_CACHE_SIZE', 256))
+app.config['SEARCH_CACHE_TTL'] = int(os.environ.get('SEARCH_CACHE_TTL', 60))
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 30))
+
+# users whose sets of liked cafe ids are kept in memory (0, the default,
+# to always ask the database); like and unlike keep them current in this
+# process, and the TTL bounds how stale other processes' copies get
+app.config['LIKES_CACHE_SIZE'] = int(os.environ.get('LIKES_CACHE_SIZE', 0))
+app.config['LIKES_CACHE_TTL'] = int(os.environ.get('LIKES_CACHE_TTL', 60))
+
+# rendered cafe cards and page bodies kept in memory (0 to render them
+# every time); see cafe_fragment
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 2048))
+
+# seconds to hold likes and unlikes before writing them in a batch (see
+# likebuffer.py); 0 writes each one straight away
+app.config['LIKE_BUFFER_INTERVAL'] = float(
+    os.environ.get('LIKE_BUFFER_INTERVAL', 0))
+app.config['LIKE_BUFFER_MAX_PENDING'] = 500
+app.config['SUGGEST_LIMIT'] = 10
+# seconds between rebuilds of the in-memory suggestions, in the background
+# (see suggest.py); 0 builds them on first use only
+app.config['SUGGEST_MAX_AGE'] = int(os.environ.get('SUGGEST_MAX_AGE', 300))
+app.config['SUGGEST_MAX_LIMIT'] = 25
+
+# most cafes /api/likes answers for at once (a page of cafes, at most)
+app.config['LIKES_MAX_BATCH'] = app.config['CAFES_MAX_PER_PAGE']
+
+# part of the ETag of every page; change it (eg, on deploy) so browsers
+# fetch pages again after templates change
+app.config['ETAG_VERSION'] = os.environ.get('ETAG_VERSION', '')
+
+# how map images are sent: 'sendfile' (by the app, zero-copy where the
+# WSGI server supports it), 'x-sendfile' (by Apache/lighttpd) or 'x-accel'
+# (by nginx, from an internal location serving MAP_ACCEL_PREFIX)
+app.config['MAP_SEND_MODE'] = os.environ.get('MAP_SEND_MODE', 'sendfile')
+app.config['MAP_ACCEL_PREFIX'] = os.environ.get(
+    'MAP_ACCEL_PREFIX', '/internal/maps/')
+app.config['MAP_MAX_AGE'] = 365 * 24 * 60 * 60
+app.config['MAP_PLACEHOLDER_MAX_AGE'] = 60
+
+# local copies of images on other hosts (see imageproxy.py)
+app.config['IMAGE_PROXY_DIR'] = os.environ.get(
+    'IMAGE_PROXY_DIR', os.path.join(app.instance_path, 'image-cache'))
+app.config['IMAGE_PROXY_MAX_BYTES'] = int(
+    os.environ.get('IMAGE_PROXY_MAX_BYTES', 5 * 1024 * 1024))
+app.config['IMAGE_PROXY_CACHE_BYTES'] = int(
+    os.environ.get('IMAGE_PROXY_CACHE_BYTES', 500 * 1024 * 1024))
+app.config['IMAGE_PROXY_TIMEOUT'] = 5
+# hosts fetched even though they have private addresses (comma-separated);
+# others on loopback, private or link-local networks are refused
+app.config['IMAGE_PROXY_ALLOWED_HOSTS'] = [
+    host for host in os.environ.get('IMAGE_PROXY_ALLOWED_HOSTS', '').split(',')
+    if host]
+app.config['IMAGE_PROXY_MAX_AGE'] = 365 * 24 * 60 * 60
+app.config['IMAGE_PROXY_FALLBACK_MAX_AGE'] = 300
 
 if app.debug:
     app.config['SQLALCHEMY_ECHO'] = True
@@ -27,6 +129,26 @@ if app.debug:
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+map_jobs.init_app(app)
+app.cli.add_command(maps_cli)
+app.cli.add_command(cafes_cli)
+
+image_proxy = ImageProxy()
+image_proxy.init_app(app)
+like_buffer = LikeBuffer()
+like_buffer.init_app(app)
+suggestions.init_app(app)
+
+search_cache = LRUCache(
+    app.config['SEARCH_CACHE_SIZE'], ttl=app.config['SEARCH_CACHE_TTL'])
+user_cache = LRUCache(
+    app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+likes_cache = LRUCache(
+    app.config['LIKES_CACHE_SIZE'], ttl=app.config['LIKES_CACHE_TTL'],
+) if app.config['LIKES_CACHE_SIZE'] else None
+fragment_cache = LRUCache(
+    app.config['FRAGMENT_CACHE_SIZE'],
+) if app.config['FRAGMENT_CACHE_SIZE'] else None
 
 #######################################
 # auth & auth routes
@@ -34,23 +156,83 @@ connect_db(app)
 CURR_USER_KEY = "curr_user"
 NOT_LOGGED_IN_MSG = "You are not logged in."
 
+# endpoints that never look at the user or render forms
+NO_USER_ENDPOINTS = {'static', 'map_image', 'proxy_image'}
+
+
+def lazy_global(name, loader):
+    """Return a proxy for g.<name> that calls `loader` on first use.
+
+    Requests that never touch it (JSON APIs, redirects, error pages) skip
+    the work.
+    """
+
+    key = f"_lazy_{name}"
+
+    # g can outlive a request (connect_db keeps an app context pushed), so
+    # forget any value loaded for an earlier one
+    g.pop(key, None)
+
+    def load():
+        if key not in g:
+            setattr(g, key, loader())
+        return g.get(key)
+
+    return LocalProxy(load)
+
+
+def load_current_user():
+    """Return the CachedUser for the logged in user, or None."""
+
+    if CURR_USER_KEY in session:
+        return get_cached_user(session[CURR_USER_KEY])
+
+    return None
+
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    This is a CachedUser, kept for a short time in user_cache so most
+    requests don't need to query for it, and only looked up on first use.
+    Static files and images never need it.
+    """
 
-    else:
+    if request.endpoint in NO_USER_ENDPOINTS:
         g.user = None
+        return
+
+    g.user = lazy_global('user', load_current_user)
+
+
+def get_cached_user(user_id):
+    """Return a CachedUser for this id (or None if there's no such user),
+    from user_cache if we can.
+    """
+
+    cached = user_cache.get(user_id)
+    if cached:
+        return cached
+
+    user = db.session.get(User, user_id)
+    if not user:
+        return None
+
+    cached = CachedUser.from_user(user)
+    user_cache.set(user_id, cached)
+    return cached
 
 
 @app.before_request
 def form_protection():
-    """Creates Csrf form protection"""
+    """Creates Csrf form protection, on first use."""
+
+    if request.endpoint in NO_USER_ENDPOINTS:
+        g.csrf_form = None
+        return
 
-    g.csrf_form = CsrfForm()
+    g.csrf_form = lazy_global('csrf_form', CsrfForm)
 
 
 def do_login(user):
@@ -66,6 +248,88 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def with_buffered_likes(user_id, liked_ids):
+    """Returns these liked cafe ids of a user, updated by any of their likes
+    and unlikes still waiting in like_buffer.
+    """
+
+    liked_ids = set(liked_ids)
+
+    for cafe_id, liked in like_buffer.pending_for(user_id).items():
+        if liked:
+            liked_ids.add(cafe_id)
+        else:
+            liked_ids.discard(cafe_id)
+
+    return liked_ids
+
+
+def get_liked_cafe_ids(user_id):
+    """Return the set of ids of every cafe this user likes, from
+    likes_cache if we can.
+    """
+
+    liked = likes_cache.get(user_id)
+
+    if liked is None:
+        liked = frozenset(
+            with_buffered_likes(user_id, Like.cafe_ids_liked_by(user_id)))
+        likes_cache.set(user_id, liked)
+
+    return liked
+
+
+def liked_cafe_ids(cafe_ids):
+    """Returns the set of which of these cafes the current user likes: from
+    their cached liked ids if likes_cache is on, else with one query.
+    """
+
+    if likes_cache is None:
+        liked = Like.cafe_ids_liked_by(g.user.id, cafe_ids)
+        return with_buffered_likes(g.user.id, liked) & set(cafe_ids)
+
+    return get_liked_cafe_ids(g.user.id) & set(cafe_ids)
+
+
+def likes_cafe(cafe_id):
+    """Does the current user like this cafe? Checked in their cached liked
+    ids if likes_cache is on, else with an EXISTS query.
+    """
+
+    buffered = like_buffer.get(g.user.id, cafe_id)
+    if buffered is not None:
+        return buffered
+
+    if likes_cache is None:
+        return Like.exists_for(g.user.id, cafe_id)
+
+    return cafe_id in get_liked_cafe_ids(g.user.id)
+
+
+def update_liked_cafe_ids(user_id, cafe_id, liked):
+    """Keeps the cached liked ids of this user (if any) current after they
+    like or unlike a cafe.
+    """
+
+    if likes_cache is None:
+        return
+
+    cached = likes_cache.get(user_id)
+    if cached is not None:
+        likes_cache.set(
+            user_id, (cached | {cafe_id}) if liked else (cached - {cafe_id}))
+
+
+def get_per_page():
+    """Gets page size from the 'per_page' querystring param, falling back
+    to the configured default and capped at the configured maximum.
+    """
+
+    per_page = request.args.get(
+        'per_page', app.config['CAFES_PER_PAGE'], type=int)
+    return max(1, min(per_page, app.config['CAFES_MAX_PER_PAGE']))
+
+
 def get_cities_choices():
     """Gets all cities' ids and name from the database"""
 
@@ -80,7 +344,13 @@ def get_cities_choices():
 def homepage():
     """Show homepage."""
 
-    return render_template("homepage.html")
+    if g.user:
+        user = User.query_with_liked_cafes().filter_by(id=g.user.id).one()
+        liked_cafes = user.liked_cafes
+    else:
+        liked_cafes = []
+
+    return render_template("homepage.html", liked_cafes=liked_cafes)
 
 
 @app.errorhandler(404)
@@ -88,6 +358,15 @@ def not_found_error(error):
     """Returns 404.html when 404 error occurs."""
 
     return render_template('404.html')
+
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Returns 503.html when too many logins/signups are waiting."""
+
+    return render_template('503.html'), 503, {"Retry-After": "1"}
+
+
 #######################################
 # user
 
@@ -147,6 +426,8 @@ def login():
         )
 
         if user:
+            # saves the password if it was rehashed at a new cost
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -173,41 +454,312 @@ def logout():
 # cafes
 
 
+# templates/cafe/_<name>.html fragments cached by cafe_fragment
+CAFE_FRAGMENTS = ('card', 'detail')
+
+
+@app.template_global()
+def cafe_fragment(name, cafe):
+    """Returns templates/cafe/_<name>.html rendered for this cafe, from
+    fragment_cache if it's there for the cafe's current updated_at.
+
+    Fragments must only show what's the same for every user; the like
+    buttons and admin controls go outside them.
+    """
+
+    if fragment_cache is None:
+        return Markup(render_template(f'cafe/_{name}.html', cafe=cafe))
+
+    cached = fragment_cache.get((name, cafe.id))
+    if cached is not None and cached[0] == cafe.updated_at:
+        return cached[1]
+
+    html = Markup(render_template(f'cafe/_{name}.html', cafe=cafe))
+    fragment_cache.set((name, cafe.id), (cafe.updated_at, html))
+    return html
+
+
+def forget_cafe_fragments(cafe_id):
+    """Drops this cafe's cached fragments, eg once it's edited."""
+
+    if fragment_cache:
+        for name in CAFE_FRAGMENTS:
+            fragment_cache.delete((name, cafe_id))
+
+
+def may_be_not_modified():
+    """Can this page be answered with 304 Not Modified? Not if there are
+    flashed messages to show, or if the user has likes still waiting in
+    like_buffer, which the database doesn't know about yet.
+    """
+
+    return (not session.get('_flashes')
+            and not like_buffer.pending_for(g.user.id))
+
+
+def get_user_version():
+    """Returns what pages show of the current user, for their ETags."""
+
+    return tuple(getattr(g.user, field) for field in CachedUser.FIELDS)
+
+
+def get_cafe_list_validators(page):
+    """Returns (ETag, Last-Modified, liked ids) for a page of cafe cards.
+
+    One aggregate query finds which cafes are on the page, when they last
+    changed, and when the user last liked one; which of them the user
+    likes comes from liked_cafe_ids, as the page shows it. `page` is a
+    KeysetPage of the cafes' ids and updated_at.
+    """
+
+    # just the rows shown, not the extra one that tells if there's more
+    rows = page.page_query().limit(page.limit).subquery()
+
+    cafe_ids, last_changed, last_liked = db.session.execute(
+        select(
+            func.array_agg(rows.c.id),
+            func.max(rows.c.updated_at),
+            func.max(Like.updated_at),
+        )
+        .select_from(rows)
+        .outerjoin(Like, and_(
+            Like.cafe_id == rows.c.id, Like.user_id == g.user.id))
+    ).one()
+
+    cafe_ids = sorted(cafe_ids or [])
+    liked = liked_cafe_ids(cafe_ids)
+
+    etag = make_cafe_list_etag(cafe_ids, last_changed, liked)
+    last_modified = max(filter(None, [last_changed, last_liked]), default=None)
+    return etag, last_modified, liked
+
+
+def get_loaded_cafe_list_validators(cafes):
+    """Returns (ETag, Last-Modified) for a page of cafe cards, from the
+    cafes themselves, loaded with Cafe.with_liked_at; the same as
+    get_cafe_list_validators finds for them.
+    """
+
+    cafes = list(cafes)
+    liked = [cafe for cafe in cafes if cafe.liked_at]
+    last_changed = max((cafe.updated_at for cafe in cafes), default=None)
+    last_liked = max((cafe.liked_at for cafe in liked), default=None)
+
+    etag = make_cafe_list_etag(
+        [cafe.id for cafe in cafes], last_changed, [cafe.id for cafe in liked])
+    last_modified = max(filter(None, [last_changed, last_liked]), default=None)
+    return etag, last_modified
+
+
+def make_cafe_list_etag(cafe_ids, last_changed, liked):
+    """Returns the ETag of a page of cafe cards: these cafes, when the
+    last of them changed, and which of them the user likes.
+    """
+
+    return make_etag(
+        'cafe_list', app.config['ETAG_VERSION'], get_user_version(),
+        sorted(cafe_ids), last_changed, sorted(liked),
+    )
+
+
 @app.get('/cafes')
 def cafe_list():
-    """Return list of all cafes."""
+    """Return a page of cafes, ordered by name.
+
+    Takes 'after' or 'before' cursors and 'per_page' in the querystring.
+    Can also take any number of 'tag' params, to list only cafes with all
+    of those specialities (or any of them, given 'match=any').
+    The page is streamed, so the header goes out before the cafes load.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    cafes = Cafe.query.order_by('name').all()
+    tags = parse_specialities(",".join(request.args.getlist('tag')))
+    match = 'any' if request.args.get('match') == 'any' else None
 
-    return render_template(
+    query = Cafe.query_for_list()
+    if tags:
+        query = query.filter(Cafe.id.in_(
+            Speciality.cafe_ids_tagged(tags, match_all=match != 'any')))
+
+    page = dict(
+        keys=(Cafe.name, Cafe.id),
+        limit=get_per_page(),
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+    )
+
+    cafes = KeysetPage(query, **page)
+
+    validators = None
+    if not may_be_not_modified():
+        # worked out once the page of cafes has loaded, so it's in one go
+        liked_ids = lazy_global(
+            'liked_ids', lambda: liked_cafe_ids([cafe.id for cafe in cafes]))
+
+    elif is_conditional():
+        *validators, liked_ids = get_cafe_list_validators(
+            KeysetPage(query.with_entities(Cafe.id, Cafe.updated_at), **page))
+        if is_not_modified(*validators):
+            return not_modified(*validators)
+
+    else:
+        # nothing to compare with, so rather than an extra query, the
+        # validators come from the page itself, loaded (with when the user
+        # liked each cafe) before streaming so they can go in the headers
+        cafes = KeysetPage(
+            query.options(Cafe.with_liked_at(g.user.id)), **page)
+        validators = get_loaded_cafe_list_validators(cafes)
+        liked_ids = {cafe.id for cafe in cafes if cafe.liked_at}
+
+    # the session cookie is sent before a streamed body, so pop flashed
+    # messages now; the template gets the same ones back from the request
+    get_flashed_messages(with_categories=True)
+
+    response = app.response_class(stream_template(
         'cafe/list.html',
         cafes=cafes,
+        liked_ids=liked_ids,
+        tags=tags,
+        match=match,
+        per_page=request.args.get('per_page', type=int),
+    ))
+
+    if validators:
+        add_validators(response, *validators)
+
+    return response
+
+
+def get_top_cafes():
+    """Gets the page of most liked cafes asked for by the 'page' and
+    'per_page' querystring params. By page number rather than cursor,
+    since counts change as people like cafes.
+    """
+
+    return OffsetPage(
+        Cafe.query_most_liked(),
+        page=request.args.get('page', 1, type=int),
+        limit=get_per_page(),
     )
 
 
+@app.get('/cafes/top')
+def top_cafes():
+    """Show a page of cafes, most liked first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return render_template(
+        'cafe/top.html',
+        cafes=get_top_cafes(),
+        per_page=request.args.get('per_page', type=int),
+    )
+
+
+@app.get('/api/cafes/top')
+def top_cafes_api():
+    """Returns JSON of a page of cafes, most liked first:
+    {"cafes": [{"id", "name", "city", "like_count"}, ...],
+     "next_page": 2|null, "prev_page": null}
+    If the user is not logged in, returns JSON {"error": "Not logged in"}.
+    """
+
+    if not g.user:
+        return jsonify({"error": "Not logged in"}), 400
+
+    cafes = get_top_cafes()
+
+    return jsonify({
+        "cafes": [
+            {
+                "id": cafe.id,
+                "name": cafe.name,
+                "city": cafe.get_city_state(),
+                "like_count": cafe.like_count,
+            }
+            for cafe in cafes
+        ],
+        "next_page": cafes.next_page,
+        "prev_page": cafes.prev_page,
+    })
+
+
+def get_cafe_detail_validators(cafe_id, liked):
+    """Returns (ETag, Last-Modified) for a cafe's page, from one query of
+    when the cafe, its specialities and the user's like of it last
+    changed, and its like count, and whether the user likes it (`liked`,
+    as the page shows it). Returns None if there's no such cafe.
+    """
+
+    last_speciality = (
+        select(func.max(Speciality.updated_at))
+        .where(Speciality.cafe_id == Cafe.id)
+        .scalar_subquery()
+    )
+
+    row = db.session.execute(
+        select(Cafe.updated_at, last_speciality, Like.updated_at,
+               Cafe.like_count, Cafe.map_status, Cafe.map_key)
+        .outerjoin(Like, and_(
+            Like.cafe_id == Cafe.id, Like.user_id == g.user.id))
+        .where(Cafe.id == cafe_id)
+    ).one_or_none()
+
+    if row is None:
+        return None
+
+    last_changed, last_speciality, liked_at, like_count, map_status, map_key \
+        = row
+
+    # the map is replaced in place when regenerated, changing its URL
+    map_version = None
+    if map_status == Cafe.MAP_READY:
+        map_version = get_map_version(map_key or cafe_id)
+
+    etag = make_etag(
+        'cafe_detail', app.config['ETAG_VERSION'], get_user_version(),
+        cafe_id, last_changed, last_speciality, liked, like_count,
+        map_status, map_version,
+    )
+    last_modified = max(
+        filter(None, [last_changed, last_speciality, liked_at]))
+    return etag, last_modified
+
+
 @app.get('/cafes/<int:cafe_id>')
 def cafe_detail(cafe_id):
     """Show detail for cafe."""
 
-    cafe = Cafe.query.get_or_404(cafe_id)
-
     if not g.user:
         flash("Not authorized", "danger")
         return redirect("/login")
 
-    liked = cafe in g.user.liked_cafes
-    specialities = cafe.specialities
+    liked = likes_cafe(cafe_id)
 
-    return render_template(
+    validators = None
+    if may_be_not_modified():
+        validators = get_cafe_detail_validators(cafe_id, liked)
+        if validators and is_not_modified(*validators):
+            return not_modified(*validators)
+
+    # specialities are only loaded if the page body isn't cached
+    cafe = Cafe.query_for_list().get_or_404(cafe_id)
+
+    response = make_response(render_template(
         'cafe/detail.html',
         cafe=cafe,
         liked=liked,
-        specialities=specialities
-    )
+    ))
+
+    if validators:
+        add_validators(response, *validators)
+
+    return response
 
 
 @app.route('/cafes/add', methods=["GET", "POST"])
@@ -236,8 +788,13 @@ def add_cafe():
 
         db.session.add(cafe)
         db.session.flush()
-        cafe.save_map()
+        speciality_names = parse_specialities(form.specialities.data)
+        Speciality.set_for_cafe(cafe.id, speciality_names)
         db.session.commit()
+        map_jobs.enqueue('generate_map', cafe.id)
+        map_jobs.enqueue('cache_photo', cafe.id)
+        suggestions.add_cafe(cafe.name, speciality_names)
+        search_cache.clear()
 
         flash(f"{cafe.name} added.")
         return redirect(f'/cafes/{cafe.id}')
@@ -262,32 +819,64 @@ def edit_cafe(cafe_id):
     specialities = Speciality.query.filter_by(cafe_id=cafe_id).all()
 
     if form.validate_on_submit():
+        old_name = cafe.name
+        old_speciality_names = [speciality.name for speciality in specialities]
+
         cafe.name = form.name.data
         cafe.description = form.description.data
         cafe.url = form.url.data
         cafe.address = form.address.data
         cafe.city_code = form.city_code.data
+        photo_changed = cafe.image_url != form.image_url.data
         cafe.image_url = form.image_url.data
+        if photo_changed:
+            cafe.photo_key = None
 
-        for speciality in specialities:
-            db.session.delete(speciality)
+        speciality_names = parse_specialities(form.specialities.data)
+        Speciality.set_for_cafe(cafe_id, speciality_names)
 
-        if not form.specialities.data == "":
+        # only fetch a new map if the location changed (or it never worked)
+        map_changed = (cafe.map_status != Cafe.MAP_READY
+                       or cafe.get_map_key() != cafe.map_key)
+        if map_changed:
+            cafe.map_status = Cafe.MAP_PENDING
 
-            speciality = Speciality(
-                name=form.specialities.data, cafe_id=cafe_id)
-            db.session.add(speciality)
-
-        cafe.save_map()
         db.session.commit()
 
+        if map_changed:
+            map_jobs.enqueue('generate_map', cafe.id)
+        if photo_changed:
+            map_jobs.enqueue('cache_photo', cafe.id)
+
+        suggestions.remove_cafe(old_name, old_speciality_names)
+        suggestions.add_cafe(cafe.name, speciality_names)
+        forget_cafe_fragments(cafe.id)
+        search_cache.clear()
+
         flash(f"{cafe.name} edited.", "success")
         return redirect(f'/cafes/{cafe.id}')
 
     else:
+        if not form.is_submitted():
+            form.specialities.data = ", ".join(
+                speciality.name for speciality in specialities)
         return render_template('cafe/edit-form.html', form=form, cafe=cafe, specialities=specialities)
 
 
+def forget_deleted_cafes(deleted):
+    """Drops these cafes (as returned by Cafe.delete_many) from the
+    in-memory suggestions and caches.
+    """
+
+    for cafe_id, (name, speciality_names) in deleted.items():
+        suggestions.remove_cafe(name, speciality_names)
+        forget_cafe_fragments(cafe_id)
+
+    search_cache.clear()
+    if likes_cache:
+        likes_cache.clear()
+
+
 @app.post('/cafes/<int:cafe_id>/delete')
 def delete_cafe(cafe_id):
     """Deletes a cafe if the user is an admin."""
@@ -296,28 +885,52 @@ def delete_cafe(cafe_id):
         flash("Not authorized", "danger")
         return redirect("/")
 
-    cafe = Cafe.query.get_or_404(cafe_id)
-
-    for user in cafe.users_liked_cafes:
-        user.liked_cafes.remove(cafe)
-
-    specialities = Speciality.query.filter_by(cafe_id=cafe_id).all()
-    for speciality in specialities:
-        db.session.delete(speciality)
+    deleted = Cafe.delete_many([cafe_id])
+    if not deleted:
+        abort(404)
 
-    db.session.delete(cafe)
     db.session.commit()
+    forget_deleted_cafes(deleted)
 
-    flash(f"{cafe.name} deleted.", "success")
+    name, _ = deleted[cafe_id]
+    flash(f"{name} deleted.", "success")
 
     return redirect("/cafes")
 
 
+@app.post('/api/cafes/delete')
+def delete_cafes():
+    """Deletes many cafes at once, in one transaction, if the user is an
+    admin. Takes JSON {"cafe_ids": [...]} and returns JSON
+    {"deleted": [...]} of the ids of the cafes deleted (ids of cafes that
+    don't exist are skipped).
+    """
+
+    if not g.user or not g.user.admin:
+        return jsonify({"error": "Not authorized"}), 403
+
+    try:
+        cafe_ids = get_requested_cafe_ids()
+    except ValueError:
+        return jsonify({"error": "cafe_ids must be integers"}), 400
+
+    if cafe_ids is None:
+        return jsonify({"error": "cafe_ids is required"}), 400
+
+    deleted = Cafe.delete_many(cafe_ids)
+    db.session.commit()
+    forget_deleted_cafes(deleted)
+
+    return jsonify({"deleted": sorted(deleted)})
+
+
 @app.get('/search')
 def search_cafe():
     """Page with listing of cafes.
 
-    Can take a 'q' param in querystring to search by that name.
+    Can take a 'q' param in querystring to search by that name, and
+    'page' and 'per_page' params. Matches are ranked, best first; how
+    depends on the SEARCH_MODE setting.
     """
 
     if not g.user:
@@ -325,16 +938,227 @@ def search_cafe():
         return redirect("/")
 
     search = request.args.get('q')
+    page = max(request.args.get('page', 1, type=int), 1)
 
     if not search:
-        cafes = Cafe.query.all()
-        specialities = []
+        cafes = OffsetPage(
+            Cafe.query.order_by(Cafe.name, Cafe.id),
+            page=page,
+            limit=get_per_page(),
+        )
+    else:
+        cafes = cached_search(
+            search_cache,
+            search,
+            app.config['SEARCH_MODE'],
+            page=page,
+            limit=get_per_page(),
+        )
+
+    return render_template(
+        'search.html',
+        cafes=cafes,
+        liked_ids=liked_cafe_ids([cafe.id for cafe in cafes]),
+        q=search,
+        per_page=request.args.get('per_page', type=int),
+    )
+
+
+@app.get('/api/search/suggest')
+def suggest():
+    """Returns JSON {"cafes": [...], "specialities": [...]} of names with a
+    word starting with the 'q' param, up to 'limit' of each.
+
+    Served from an in-memory index so typing in the search box doesn't
+    query the database.
+    """
+
+    prefix = request.args.get('q', '')
+    limit = request.args.get('limit', app.config['SUGGEST_LIMIT'], type=int)
+    limit = max(1, min(limit, app.config['SUGGEST_MAX_LIMIT']))
+
+    return jsonify(suggestions.suggest(prefix, limit))
+
+
+@app.get('/api/cache-stats')
+def cache_stats():
+    """Returns JSON of hit/miss counts and sizes of the in-process caches,
+    for admins sizing them.
+    """
+
+    if not g.user or not g.user.admin:
+        return jsonify({"error": "Not authorized"}), 403
+
+    return jsonify({
+        "search": search_cache.stats(),
+        "users": user_cache.stats(),
+        "likes": likes_cache.stats() if likes_cache else None,
+        "fragments": fragment_cache.stats() if fragment_cache else None,
+    })
+
+#######################################
+# export
+
+
+@app.get('/api/export/<any(cafes, likes):table>.<any(jsonl, csv):file_format>')
+def export(table, file_format):
+    """Returns every cafe (with its specialities) or every like, as JSONL
+    or CSV, if the user is an admin.
+
+    The rows are streamed out as they're read, so this takes the same
+    memory however many there are.
+    """
+
+    if not g.user or not g.user.admin:
+        return jsonify({"error": "Not authorized"}), 403
+
+    return app.response_class(
+        stream_with_context(iter_export(table, file_format)),
+        mimetype=EXPORT_MIMETYPES[file_format],
+        headers={
+            "Content-Disposition":
+                f'attachment; filename="{table}.{file_format}"',
+        },
+    )
+
+
+#######################################
+# maps
+
+_map_placeholder = None
+
+
+def map_placeholder():
+    """Returns the response for a map that isn't saved: the placeholder
+    image, read from disk once, cached only briefly by browsers since the
+    map may turn up soon.
+    """
+
+    global _map_placeholder
+
+    if _map_placeholder is None:
+        path = os.path.join(app.static_folder, 'images', 'map-pending.svg')
+        with open(path, 'rb') as f:
+            _map_placeholder = f.read()
+
+    resp = app.response_class(_map_placeholder, mimetype='image/svg+xml')
+    resp.cache_control.public = True
+    resp.cache_control.max_age = app.config['MAP_PLACEHOLDER_MAX_AGE']
+    resp.add_etag()
+    return resp.make_conditional(request)
+
+
+@app.get('/maps/<filename>')
+def map_image(filename):
+    """Serves a saved map image, by key (or cafe id, for older maps), or
+    one of its derivatives (eg, /maps/<key>-500.webp).
+
+    The ETag is the sha256 of the image, so If-None-Match gets a 304. URLs
+    with the current version (?v=, see Cafe.get_map_url) are cached for
+    good; others must be revalidated. The file is sent as set by
+    MAP_SEND_MODE. A missing map gets the placeholder image; a missing
+    derivative gets the full map.
+    """
+
+    match = MAP_FILE.match(filename)
+    if not match:
+        return map_placeholder()
+
+    name, width, ext = match.group('name', 'width', 'ext')
+    original = get_map_path(name)
+    version = get_map_etag(original)
+
+    if not version:
+        return map_placeholder()
+
+    if width:
+        path = get_derivative_path(original, width, ext)
+        etag = get_map_etag(path)
+    else:
+        path, etag, ext = original, version, 'jpg'
+
+    if not etag:
+        # derivatives not made yet, or a width we don't make
+        path, etag, ext = original, version, 'jpg'
+
+    versioned = request.args.get('v') == version[:MAP_VERSION_LENGTH]
+    mode = app.config['MAP_SEND_MODE']
+
+    resp = send_file(
+        path,
+        request.environ,
+        mimetype=MIMETYPES[ext],
+        etag=etag,
+        max_age=app.config['MAP_MAX_AGE'] if versioned else 0,
+        use_x_sendfile=mode in ('x-sendfile', 'x-accel'),
+        response_class=app.response_class,
+    )
+
+    if versioned:
+        resp.cache_control.immutable = True
     else:
-        cafes = Cafe.query.filter(or_(Cafe.name.ilike(f"%{search}%"))).all()
-        specialities = Speciality.query.filter(
-            or_(Speciality.name.ilike(f"%{search}%"))).all()
+        resp.cache_control.public = True
+        resp.cache_control.must_revalidate = True
 
-    return render_template('search.html', cafes=cafes, specialities=specialities)
+    if mode == 'x-accel' and 'X-Sendfile' in resp.headers:
+        del resp.headers['X-Sendfile']
+        resp.headers['X-Accel-Redirect'] = (
+            app.config['MAP_ACCEL_PREFIX'] + os.path.basename(path))
+
+    return resp
+
+#######################################
+# images
+
+
+@app.template_filter('proxied')
+def proxied_image_url(url):
+    """Returns the URL to show an image from: through proxy_image, if it's
+    on another host.
+    """
+
+    if not url or not is_remote(url):
+        return url
+
+    return url_for('proxy_image', url=url, s=image_proxy.sign(url))
+
+
+@app.get('/images/proxy')
+def proxy_image():
+    """Serves our copy of an image on another host, fetching it the first
+    time. Only URLs signed by proxied_image_url are allowed.
+
+    Copies can be cached for good, as a URL's copy never changes. If the
+    image can't be fetched, the default picture is sent instead, cached
+    only briefly.
+    """
+
+    url = request.args.get('url', '')
+    signature = request.args.get('s', '')
+
+    if not is_remote(url) or not image_proxy.verify(url, signature):
+        abort(403)
+
+    try:
+        path, mimetype = image_proxy.get(url)
+    except ImageProxyError:
+        return send_file(
+            os.path.join(app.static_folder, 'images', 'default-pic.jpg'),
+            request.environ,
+            max_age=app.config['IMAGE_PROXY_FALLBACK_MAX_AGE'],
+            response_class=app.response_class,
+        )
+
+    resp = send_file(
+        path,
+        request.environ,
+        mimetype=mimetype,
+        etag=os.path.basename(path),
+        max_age=app.config['IMAGE_PROXY_MAX_AGE'],
+        response_class=app.response_class,
+    )
+    resp.cache_control.immutable = True
+    return resp
 
 ##############################
 # Profile
@@ -348,7 +1172,7 @@ def get_profile():
         flash(NOT_LOGGED_IN_MSG, "danger")
         return redirect("/")
     g.user_id = g.user.id
-    user = User.query.get_or_404(g.user_id)
+    user = User.query_with_liked_cafes().filter_by(id=g.user_id).first_or_404()
 
     return render_template('profile/detail.html', user=user)
 
@@ -361,16 +1185,18 @@ def profile():
         flash(NOT_LOGGED_IN_MSG, "danger")
         return redirect("/")
 
-    form = ProfileEditForm(obj=g.user)
+    user = g.user.load()
+    form = ProfileEditForm(obj=user)
 
     if form.validate_on_submit():
-        g.user.first_name = form.first_name.data
-        g.user.last_name = form.last_name.data
-        g.user.description = form.description.data
-        g.user.email = form.email.data
-        g.user.image_url = form.image_url.data or User.image_url.default.arg
+        user.first_name = form.first_name.data
+        user.last_name = form.last_name.data
+        user.description = form.description.data
+        user.email = form.email.data
+        user.image_url = form.image_url.data or User.image_url.default.arg
 
         db.session.commit()
+        user_cache.delete(user.id)
 
         flash('Profile edited.', "success")
         return redirect("/profile")
@@ -391,61 +1217,221 @@ def delete_user():
 
     do_logout()
 
-    Like.query.filter_by(user_id=g.user.id).delete()
-    db.session.delete(g.user)
+    # their likes go too, by the database's cascade
+    db.session.execute(delete(User).where(User.id == g.user.id))
     db.session.commit()
+    user_cache.delete(g.user.id)
+    if likes_cache:
+        likes_cache.delete(g.user.id)
     flash("User Deleted!", "danger")
 
     return redirect("/signup")
 
 
-@app.get('/api/likes')
+# range of the integer id columns; Postgres refuses ids outside it
+MIN_ID = -2 ** 31
+MAX_ID = 2 ** 31 - 1
+
+
+def get_requested_cafe_ids():
+    """Gets the cafe ids asked about: from the 'cafe_ids' querystring param
+    (comma-separated), or a JSON body of {"cafe_ids": [...]} if POSTed.
+    Returns None if neither is given.
+
+    Raises ValueError if they aren't all integers (or strings of them).
+    """
+
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            raise ValueError(data)
+        cafe_ids = data.get('cafe_ids')
+        if cafe_ids is None:
+            return None
+        if not isinstance(cafe_ids, list):
+            raise ValueError(cafe_ids)
+
+    else:
+        cafe_ids = request.args.get('cafe_ids')
+        if cafe_ids is None:
+            return None
+        cafe_ids = cafe_ids.split(',') if cafe_ids else []
+
+    return [parse_cafe_id(cafe_id) for cafe_id in cafe_ids]
+
+
+def parse_cafe_id(value):
+    """Returns this int (or string of one) as a cafe id.
+
+    Raises ValueError if it isn't one, or is out of the range of an id
+    column, which the database would refuse.
+    """
+
+    # int() would take floats and bools, and fail on null or lists with a
+    # TypeError
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(value)
+
+    cafe_id = int(value)
+    if not MIN_ID <= cafe_id <= MAX_ID:
+        raise ValueError(value)
+
+    return cafe_id
+
+
+def get_posted_cafe_id():
+    """Gets the cafe id from a JSON body of {"cafe_id": id}.
+
+    Raises ValueError if there isn't one, or it isn't an integer.
+    """
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ValueError(data)
+
+    return parse_cafe_id(data.get('cafe_id'))
+
+
+@app.route('/api/likes', methods=["GET", "POST"])
 def likes():
     """figures out if the current user likes that cafe,
     and returns JSON: {"likes": true|false}. If the user is not logged in,
     returns JSON {"error": "Not logged in"}.
+
+    Asked about many cafes at once (see get_requested_cafe_ids), returns
+    JSON {"likes": {"1": true, "2": false, ...}} from a single query. At
+    most LIKES_MAX_BATCH cafes can be asked about.
+
+    GETs carry an ETag, and are answered 304 Not Modified if the answer
+    hasn't changed.
     """
 
     if not g.user:
         return jsonify({"error": "Not logged in"}), 400
 
-    cafe_id = request.args.get('cafe_id')
+    try:
+        cafe_ids = get_requested_cafe_ids()
+    except ValueError:
+        return jsonify({"error": "cafe_ids must be integers"}), 400
+
+    if cafe_ids is not None:
+        if len(cafe_ids) > app.config['LIKES_MAX_BATCH']:
+            return jsonify({"error": "Too many cafe_ids"}), 400
+
+        liked = liked_cafe_ids(cafe_ids)
+        answer = {cafe_id: cafe_id in liked for cafe_id in cafe_ids}
 
-    liked = Like.query.filter_by(user_id=g.user.id, cafe_id=cafe_id).first()
+    else:
+        try:
+            cafe_id = parse_cafe_id(request.args.get('cafe_id'))
+        except ValueError:
+            return jsonify({"error": "cafe_id must be an integer"}), 400
+
+        answer = likes_cafe(cafe_id)
+
+    # the answer usually comes from likes_cache without a query, so an
+    # ETag of the answer itself is cheaper than asking when likes changed
+    etag = make_etag('likes', g.user.id, answer)
+
+    if request.method == 'GET' and is_not_modified(etag):
+        return not_modified(etag)
+
+    response = jsonify({"likes": answer})
+
+    if request.method == 'GET':
+        add_validators(response, etag)
+
+    return response
+
+
+def get_buffered_like_count(cafe_id, liked):
+    """Returns this cafe's like count as it will be once the current
+    user's like (or unlike) waiting in like_buffer is written, or None if
+    there's no such cafe. The saved count is adjusted by whether the
+    database has the user liking it yet, in the same query.
+    """
 
-    return jsonify({"likes": bool(liked)})
+    row = db.session.query(
+        Cafe.like_count,
+        db.exists().where(Like.user_id == g.user.id, Like.cafe_id == Cafe.id),
+    ).filter(Cafe.id == cafe_id).first()
+
+    if row is None:
+        return None
+
+    like_count, liked_saved = row
+    return like_count - int(liked_saved) + int(liked)
+
+
+def set_liked(cafe_id, liked):
+    """Records that the current user likes (or doesn't like) this cafe, as
+    a single idempotent INSERT or DELETE, or through like_buffer if it's
+    on. Returns the JSON response for like and unlike.
+    """
+
+    try:
+        if like_buffer.enabled:
+            like_count = get_buffered_like_count(cafe_id, liked)
+        else:
+            if liked:
+                Like.add(g.user.id, cafe_id)
+            else:
+                Like.remove(g.user.id, cafe_id)
+
+            like_count = db.session.query(Cafe.like_count).filter_by(
+                id=cafe_id).scalar()
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        like_count = None
+
+    if like_count is None:
+        return jsonify({"error": "No such cafe"}), 404
+
+    if like_buffer.enabled:
+        like_buffer.set(g.user.id, cafe_id, liked)
+
+    update_liked_cafe_ids(g.user.id, cafe_id, liked)
+
+    return jsonify({
+        "liked" if liked else "unliked": cafe_id,
+        "likes": liked,
+        "like_count": like_count,
+    })
 
 
 @app.post('/api/like')
 def like():
-    """makes the current user like a cafe. Return JSON {"liked": cafe_id}
-    If the user is not logged in, returns JSON {"error": "Not logged in"}.
+    """makes the current user like a cafe. Return JSON
+    {"liked": cafe_id, "likes": true, "like_count": n}; liking a cafe
+    twice is the same as once. If the user is not logged in, returns JSON
+    {"error": "Not logged in"}.
     """
 
     if not g.user:
         return jsonify({"error": "Not logged in"}), 400
 
-    cafe_id = request.json['cafe_id']
-    cafe = Cafe.query.get_or_404(cafe_id)
+    try:
+        cafe_id = get_posted_cafe_id()
+    except ValueError:
+        return jsonify({"error": "cafe_id must be an integer"}), 400
 
-    g.user.liked_cafes.append(cafe)
-    db.session.commit()
-
-    return jsonify({"liked": cafe_id})
+    return set_liked(cafe_id, True)
 
 
 @app.post('/api/unlike')
 def unlike():
-    """makes the current user unlike cafe #1. Return JSON {"unliked": cafe_id}
-    If the user is not logged in, returns JSON {"error": "Not logged in"}.
+    """makes the current user unlike a cafe. Return JSON
+    {"unliked": cafe_id, "likes": false, "like_count": n}. If the user is
+    not logged in, returns JSON {"error": "Not logged in"}.
     """
 
     if not g.user:
         return jsonify({"error": "Not logged in"}), 400
 
-    cafe_id = request.json['cafe_id']
-
-    Like.query.filter_by(user_id=g.user.id, cafe_id=cafe_id).delete()
-    db.session.commit()
+    try:
+        cafe_id = get_posted_cafe_id()
+    except ValueError:
+        return jsonify({"error": "cafe_id must be an integer"}), 400
 
-    return jsonify({"unliked": cafe_id})
+    return set_liked(cafe_id, False)
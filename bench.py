@@ -0,0 +1,88 @@
+"""Micro-benchmark of per-request overhead from the before_request hooks.
+
+Times requests with the hooks building g.user and g.csrf_form eagerly on
+every request, as they used to, and with the lazy proxies they use now:
+a static file, which never uses either, and a 404 page, whose navbar
+uses g.user (so lazy hooks should cost nothing there). The requests are
+made logged in as the first user in the database, so the eager hook has
+a user to look up; run with USER_CACHE_SIZE=0 to make each of those
+lookups a query, as without user_cache.
+
+    python bench.py [requests]
+"""
+
+import sys
+import time
+
+from flask import g, session
+from sqlalchemy import select
+
+from app import (
+    app, add_user_to_g, form_protection, get_cached_user, CURR_USER_KEY)
+from forms import CsrfForm
+from models import db, User
+
+PATHS = ["/api/no-such-endpoint", "/static/like.js"]
+
+
+def eager_add_user_to_g():
+    """add_user_to_g as it was: looks up the user on every request."""
+
+    if CURR_USER_KEY in session:
+        g.user = get_cached_user(session[CURR_USER_KEY])
+    else:
+        g.user = None
+
+
+def eager_form_protection():
+    """form_protection as it was: builds a form on every request."""
+
+    g.csrf_form = CsrfForm()
+
+
+def log_in(client):
+    """Log this client in as the first user in the database."""
+
+    with app.app_context():
+        user_id = db.session.scalar(select(User.id).order_by(User.id).limit(1))
+
+    if user_id is None:
+        sys.exit("No users to log in as; run seed.py first.")
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+
+
+def time_requests(client, path, count):
+    """Return mean microseconds per request for `count` GETs of `path`."""
+
+    client.get(path)
+    start = time.perf_counter()
+    for i in range(count):
+        client.get(path)
+    return (time.perf_counter() - start) / count * 1_000_000
+
+
+def run(count):
+    hooks = app.before_request_funcs[None]
+    lazy_hooks = list(hooks)
+    eager_hooks = [
+        {add_user_to_g: eager_add_user_to_g,
+         form_protection: eager_form_protection}.get(hook, hook)
+        for hook in hooks
+    ]
+
+    client = app.test_client()
+    log_in(client)
+
+    print(f"{'path':<26}{'eager (us)':>12}{'lazy (us)':>12}{'saved':>8}")
+    for path in PATHS:
+        hooks[:] = eager_hooks
+        eager = time_requests(client, path, count)
+        hooks[:] = lazy_hooks
+        lazy = time_requests(client, path, count)
+        print(f"{path:<26}{eager:>12.1f}{lazy:>12.1f}{1 - lazy / eager:>8.0%}")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
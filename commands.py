@@ -0,0 +1,524 @@
+"""Command line tools for Flask Cafe (run with `flask <group> <command>`)."""
+
+import csv
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, insert, select, tuple_, update
+from werkzeug.datastructures import MultiDict
+
+from export import iter_export
+from forms import CafeInfoForm, parse_specialities
+from images import remove_derivatives
+from mapping import get_map_key, get_map_path, save_map, unused_map_keys
+from models import db, Cafe, City, Like, Speciality
+from photos import is_remote, save_photo
+
+maps_cli = AppGroup('maps', help="Manage cafe map images.")
+cafes_cli = AppGroup('cafes', help="Manage cafes.")
+
+# key of the Postgres advisory lock held while cafes are imported
+IMPORT_LOCK_ID = 7316001
+
+
+class RateLimiter:
+    """Lets callers through at most `rate` times per second, across
+    threads. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the caller may go ahead."""
+
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+
+        if start > now:
+            time.sleep(start - now)
+
+
+def read_progress(path):
+    """Return the set of cafe ids recorded as done in this progress file."""
+
+    if not os.path.exists(path):
+        return set()
+
+    with open(path) as f:
+        return {int(line) for line in f if line.strip()}
+
+
+def save_maps(cafes, parallel, rate, on_saved=None):
+    """Fetch the map images of these cafes (rows of id, address, and city
+    name and state) in `parallel` threads, at most `rate` per second, and
+    mark them ready. Cafes at the same location share one map, so each is
+    fetched once. `on_saved` is called with the ids of cafes once their
+    map is saved and marked ready has been committed.
+
+    Returns the ids of the cafes whose maps couldn't be fetched.
+    """
+
+    locations = {}
+    for cafe in cafes:
+        key = get_map_key(cafe.address, cafe.name, cafe.state)
+        locations.setdefault(key, (cafe, []))[1].append(cafe.id)
+
+    limiter = RateLimiter(rate)
+
+    def fetch(cafe):
+        limiter.wait()
+        return save_map(cafe.address, cafe.name, cafe.state, force=True)
+
+    failed = []
+    ready = []
+
+    def mark_ready():
+        if ready:
+            db.session.execute(update(Cafe), ready)
+            db.session.commit()
+            if on_saved:
+                on_saved([row["id"] for row in ready])
+            ready.clear()
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor, \
+            click.progressbar(length=len(cafes), label="Maps") as bar:
+
+        futures = {
+            executor.submit(fetch, cafe): cafe_ids
+            for cafe, cafe_ids in locations.values()
+        }
+
+        for future in as_completed(futures):
+            cafe_ids = futures[future]
+
+            if future.exception():
+                failed.extend(cafe_ids)
+            else:
+                for cafe_id in cafe_ids:
+                    ready.append({
+                        "id": cafe_id,
+                        "map_key": future.result(),
+                        "map_status": Cafe.MAP_READY,
+                    })
+
+            if len(ready) >= 100:
+                mark_ready()
+
+            bar.update(len(cafe_ids))
+
+    mark_ready()
+
+    return failed
+
+
+@maps_cli.command('regenerate')
+@click.option('--city', 'city_code', help="Only cafes in this city code.")
+@click.option('--parallel', default=4, show_default=True,
+              help="Maps fetched at once.")
+@click.option('--rate', default=5.0, show_default=True,
+              help="Most MapQuest requests per second (0 for no limit).")
+@click.option('--progress-file', default='maps-regenerate.progress',
+              show_default=True,
+              help="File recording the ids of cafes done so far.")
+@click.option('--resume', is_flag=True,
+              help="Skip cafes already done in the progress file.")
+def regenerate_maps(city_code, parallel, rate, progress_file, resume):
+    """Fetch the map image of every cafe (or those in one city) again."""
+
+    query = (
+        db.session.query(Cafe.id, Cafe.address, City.name, City.state)
+        .join(Cafe.city)
+        .order_by(Cafe.id)
+    )
+    if city_code:
+        query = query.filter(Cafe.city_code == city_code)
+
+    done = read_progress(progress_file) if resume else set()
+    cafes = [cafe for cafe in query if cafe.id not in done]
+
+    if done:
+        click.echo(f"Skipping {len(done)} cafes done earlier.")
+
+    def record(cafe_ids):
+        for cafe_id in cafe_ids:
+            progress.write(f"{cafe_id}\n")
+        progress.flush()
+
+    with open(progress_file, 'a' if resume else 'w') as progress:
+        failed = save_maps(cafes, parallel, rate, on_saved=record)
+
+    click.echo(f"Regenerated maps for {len(cafes) - len(failed)} cafes.")
+    if failed:
+        click.echo(
+            f"{len(failed)} failed (ids {', '.join(map(str, sorted(failed)))});"
+            " run again with --resume to retry them.")
+
+
+@maps_cli.command('gc')
+@click.option('--min-age', default=3600, show_default=True,
+              help="Keep maps saved in the last this many seconds.")
+@click.option('--dry-run', is_flag=True,
+              help="List the maps that would be removed, but keep them.")
+def collect_maps(min_age, dry_run):
+    """Remove saved map images no cafe uses any more."""
+
+    used = {key for (key,) in db.session.query(Cafe.map_key).distinct()}
+    unused = unused_map_keys(used, min_age=min_age)
+
+    for key in unused:
+        if dry_run:
+            click.echo(get_map_path(key))
+        else:
+            os.remove(get_map_path(key))
+            remove_derivatives(get_map_path(key))
+
+    verb = "Would remove" if dry_run else "Removed"
+    click.echo(f"{verb} {len(unused)} unused maps.")
+
+
+@cafes_cli.command('cache-photos')
+@click.option('--parallel', default=4, show_default=True,
+              help="Photos fetched at once.")
+def cache_photos(parallel):
+    """Save copies of cafe photos not saved yet (eg, from before they were
+    saved).
+    """
+
+    cafes = [
+        cafe for cafe in
+        db.session.query(Cafe.id, Cafe.image_url)
+        .filter(Cafe.photo_key.is_(None))
+        .order_by(Cafe.id)
+        if is_remote(cafe.image_url)
+    ]
+
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor, \
+            click.progressbar(length=len(cafes), label="Photos") as bar:
+
+        futures = {
+            executor.submit(save_photo, cafe.image_url): cafe.id
+            for cafe in cafes
+        }
+
+        for future in as_completed(futures):
+            if future.exception():
+                failed.append(futures[future])
+            else:
+                db.session.execute(
+                    update(Cafe),
+                    [{"id": futures[future], "photo_key": future.result()}])
+            bar.update(1)
+
+    db.session.commit()
+
+    click.echo(f"Saved photos for {len(cafes) - len(failed)} cafes.")
+    if failed:
+        click.echo(
+            f"{len(failed)} failed (ids {', '.join(map(str, sorted(failed)))}).")
+
+
+@cafes_cli.command('recount-likes')
+def recount_likes():
+    """Set every cafe's like_count from its likes, in one statement, in
+    case the counts have drifted (eg, after editing likes by hand with the
+    triggers off).
+    """
+
+    actual = (
+        select(func.count())
+        .where(Like.cafe_id == Cafe.id)
+        .scalar_subquery()
+    )
+
+    result = db.session.execute(
+        update(Cafe)
+        .where(Cafe.like_count != actual)
+        .values(like_count=actual)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+    click.echo(f"Fixed like counts of {result.rowcount} cafes.")
+
+
+# columns an import row may have; those missing are left as they are, or
+# as for a new cafe added through the form
+IMPORT_FIELDS = (
+    'name', 'description', 'url', 'address', 'city_code', 'image_url',
+    'specialities',
+)
+
+
+def read_import_rows(file, file_format):
+    """Yield (line number, row dict) for each cafe in this CSV (with a
+    header row) or JSONL file, reading it as it goes.
+
+    A JSONL line that isn't a JSON object gives a ValueError in place of
+    the row dict, so the rest of the file is still read.
+    """
+
+    if file_format == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+
+    else:
+        for line_num, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                yield line_num, ValueError(f"not valid JSON: {error}")
+                continue
+
+            if not isinstance(row, dict):
+                yield line_num, ValueError("not a JSON object")
+                continue
+
+            if isinstance(row.get('specialities'), list):
+                row['specialities'] = ", ".join(row['specialities'])
+
+            yield line_num, row
+
+
+def validate_import_row(row, city_choices):
+    """Check an import row with the rules of CafeInfoForm.
+
+    Returns (cafe values, speciality names or None if the row has none),
+    or raises ValueError with the form's errors.
+    """
+
+    formdata = MultiDict({
+        field: "" if row.get(field) is None else str(row[field])
+        for field in IMPORT_FIELDS
+    })
+    form = CafeInfoForm(formdata=formdata, meta={'csrf': False})
+    form.city_code.choices = city_choices
+
+    if not form.validate():
+        raise ValueError("; ".join(
+            f"{field}: {' '.join(errors)}"
+            for field, errors in form.errors.items()))
+
+    values = {
+        "name": form.name.data,
+        "description": form.description.data or "",
+        "url": form.url.data or "",
+        "address": form.address.data,
+        "city_code": form.city_code.data,
+        "image_url": form.image_url.data or Cafe.image_url.default.arg,
+    }
+
+    specialities = None
+    if row.get('specialities') is not None:
+        specialities = parse_specialities(form.specialities.data)
+
+    return values, specialities
+
+
+def write_import_batch(batch):
+    """Add or update this batch of validated cafes, as a few statements
+    rather than one per cafe, and commit.
+
+    A cafe with the same name, address and city as one already saved
+    updates it; if its map isn't ready for its location (as when the
+    cafe is edited), the map is marked pending. Returns (ids of cafes
+    added, number updated, ids of updated cafes needing a map).
+    """
+
+    # the last of any repeats in the batch wins
+    batch = {
+        (values["name"], values["address"], values["city_code"]):
+        (values, specialities)
+        for values, specialities in batch
+    }
+
+    existing = {
+        (row.name, row.address, row.city_code): row
+        for row in db.session.execute(
+            select(Cafe.id, Cafe.name, Cafe.address, Cafe.city_code,
+                   Cafe.image_url, Cafe.map_key, Cafe.map_status,
+                   City.name.label("city_name"), City.state)
+            .join(Cafe.city)
+            .where(tuple_(Cafe.name, Cafe.address, Cafe.city_code)
+                   .in_(list(batch))))
+    }
+
+    added = [key for key in batch if key not in existing]
+    changed = []
+    moved_ids = []
+    specialities = {}
+
+    if added:
+        added_ids = db.session.scalars(
+            insert(Cafe).returning(Cafe.id, sort_by_parameter_order=True),
+            [batch[key][0] for key in added],
+        ).all()
+    else:
+        added_ids = []
+
+    for key, cafe_id in zip(added, added_ids):
+        if batch[key][1] is not None:
+            specialities[cafe_id] = batch[key][1]
+
+    for key, cafe in existing.items():
+        values, names = batch[key]
+        change = {**values, "id": cafe.id}
+        if values["image_url"] != cafe.image_url:
+            change["photo_key"] = None
+
+        # eg, the city was renamed, or the map never worked
+        map_key = get_map_key(cafe.address, cafe.city_name, cafe.state)
+        if cafe.map_status != Cafe.MAP_READY or cafe.map_key != map_key:
+            change["map_status"] = Cafe.MAP_PENDING
+            moved_ids.append(cafe.id)
+        changed.append(change)
+
+        if names is not None:
+            specialities[cafe.id] = names
+
+    if changed:
+        db.session.execute(update(Cafe), changed)
+    if specialities:
+        Speciality.set_for_cafes(specialities)
+
+    db.session.commit()
+
+    return added_ids, len(changed), moved_ids
+
+
+@cafes_cli.command('import')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']),
+              help="Format of FILE (default: from its extension, else csv).")
+@click.option('--batch-size', default=500, show_default=True,
+              help="Cafes written per transaction.")
+@click.option('--maps/--no-maps', default=True, show_default=True,
+              help="Fetch the maps of added (or moved) cafes once all are"
+                   " written.")
+@click.option('--parallel', default=4, show_default=True,
+              help="Maps fetched at once.")
+@click.option('--rate', default=5.0, show_default=True,
+              help="Most MapQuest requests per second (0 for no limit).")
+def import_cafes(file, file_format, batch_size, maps, parallel, rate):
+    """Add cafes from a CSV or JSONL FILE ("-" for stdin), or update those
+    already saved (with the same name, address and city).
+
+    Rows have the fields of the add cafe form: name, description, url,
+    address, city_code, image_url and specialities (comma-separated, or
+    a JSON list). Rows that don't pass the form's checks are skipped.
+
+    Only one import runs at a time, as there's no unique key to keep two
+    from adding the same cafe; a second one started meanwhile fails.
+    """
+
+    with db.engine.connect() as lock_connection:
+        locked = lock_connection.execute(
+            select(func.pg_try_advisory_lock(IMPORT_LOCK_ID))).scalar()
+        if not locked:
+            raise click.ClickException("Another import is running.")
+
+        try:
+            run_import(file, file_format, batch_size, maps, parallel, rate)
+        finally:
+            lock_connection.execute(
+                select(func.pg_advisory_unlock(IMPORT_LOCK_ID)))
+
+
+def run_import(file, file_format, batch_size, maps, parallel, rate):
+    """Import cafes, as for `flask cafes import`."""
+
+    if file_format is None:
+        file_format = 'jsonl' if file.name.endswith(
+            ('.jsonl', '.ndjson')) else 'csv'
+
+    city_choices = [
+        (code, name) for code, name in db.session.query(City.code, City.name)]
+
+    added_ids = []
+    moved_ids = []
+    updated = 0
+    invalid = 0
+    batch = []
+
+    def write_batch():
+        nonlocal updated
+        ids, n, moved = write_import_batch(batch)
+        added_ids.extend(ids)
+        moved_ids.extend(moved)
+        updated += n
+        batch.clear()
+
+    for line_num, row in read_import_rows(file, file_format):
+        try:
+            if isinstance(row, ValueError):
+                raise row
+            batch.append(validate_import_row(row, city_choices))
+        except ValueError as error:
+            invalid += 1
+            click.echo(f"line {line_num}: {error}", err=True)
+            continue
+
+        if len(batch) >= batch_size:
+            write_batch()
+
+    if batch:
+        write_batch()
+
+    click.echo(f"Added {len(added_ids)} cafes and updated {updated}.")
+    if invalid:
+        click.echo(f"Skipped {invalid} invalid rows.")
+
+    if maps and (added_ids or moved_ids):
+        cafes = (
+            db.session.query(Cafe.id, Cafe.address, City.name, City.state)
+            .join(Cafe.city)
+            .filter(Cafe.id.in_(added_ids + moved_ids))
+            .order_by(Cafe.id)
+            .all()
+        )
+        failed = save_maps(cafes, parallel, rate)
+
+        click.echo(f"Fetched maps for {len(cafes) - len(failed)} cafes.")
+        if failed:
+            click.echo(
+                f"{len(failed)} failed (ids {', '.join(map(str, sorted(failed)))});"
+                " their maps stay pending.")
+
+
+@cafes_cli.command('export')
+@click.option('--table', type=click.Choice(['cafes', 'likes']),
+              default='cafes', show_default=True, help="What to export.")
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']),
+              help="Format to write (default: from the output file's"
+                   " extension, else jsonl).")
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'),
+              default='-', help="File to write (default: stdout).")
+def export_cafes(table, file_format, output):
+    """Write every cafe (with its specialities) or every like as JSONL or
+    CSV, a batch of rows at a time. Exported cafes can be imported again
+    with `flask cafes import`.
+    """
+
+    if file_format is None:
+        file_format = 'csv' if output.name.endswith('.csv') else 'jsonl'
+
+    for line in iter_export(table, file_format):
+        output.write(line)
@@ -0,0 +1,64 @@
+"""Conditional responses (ETag and Last-Modified) for Flask Cafe.
+
+A route works out its validators from a cheap query of when the rows it
+shows last changed, and answers 304 Not Modified without rendering if
+the browser's copy is still current.
+"""
+
+import hashlib
+
+from flask import current_app, request
+
+
+def make_etag(*parts):
+    """Return an ETag value for a response made from these parts (anything
+    with a stable repr), which changes whenever any of them do.
+    """
+
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()[:32]
+
+
+def is_conditional():
+    """Did the browser send If-None-Match or If-Modified-Since? If not,
+    there's no copy to compare, so no need to query for validators first.
+    """
+
+    return bool(request.if_none_match or request.if_modified_since)
+
+
+def is_not_modified(etag, last_modified=None):
+    """Does the browser's copy, as described by this request's
+    If-None-Match or If-Modified-Since, match these validators?
+
+    If-None-Match wins when both are sent, as only the ETag notices rows
+    being removed.
+    """
+
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    if last_modified and request.if_modified_since:
+        # HTTP dates are to the second
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+
+    return False
+
+
+def add_validators(response, etag, last_modified=None):
+    """Add a weak ETag, Last-Modified and Cache-Control to this response,
+    so browsers keep it but check with us before each use.
+    """
+
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    """Return a 304 Not Modified response with these validators."""
+
+    return add_validators(
+        current_app.response_class(status=304), etag, last_modified)
@@ -1,7 +1,27 @@
 """Forms for Flask Cafe."""
 from flask_wtf import FlaskForm
 from wtforms import StringField, SelectField, PasswordField
-from wtforms.validators import InputRequired, Optional, URL, Length, Email
+from wtforms.validators import (
+    InputRequired, Optional, URL, Length, Email, ValidationError,
+)
+
+# longest name of one speciality (as for the specialities.name column)
+SPECIALITY_MAX_LENGTH = 100
+
+
+def parse_specialities(text):
+    """Return the speciality names in a comma-separated list: trimmed,
+    without blanks or repeats (ignoring case), in order.
+    """
+
+    names = {}
+    for name in (text or "").split(","):
+        name = " ".join(name.split())
+        if name:
+            names.setdefault(name.lower(), name)
+
+    return list(names.values())
+
 
 class CafeInfoForm(FlaskForm):
     """Form for adding/editing info about a cafe."""
@@ -36,11 +56,19 @@ class CafeInfoForm(FlaskForm):
     )
 
     specialities = StringField(
-        'Specialties',
+        'Specialties (comma-separated)',
         default="",
-        validators=[Optional(),  Length(max=100)],
+        validators=[Optional(),  Length(max=1000)],
     )
 
+    def validate_specialities(self, field):
+        for name in parse_specialities(field.data):
+            if len(name) > SPECIALITY_MAX_LENGTH:
+                raise ValidationError(
+                    f"Each speciality must be at most {SPECIALITY_MAX_LENGTH}"
+                    " characters.")
+
+
 class SignupForm(FlaskForm):
     """Form for user signup"""
 
@@ -0,0 +1,196 @@
+"""Local copies of images on other hosts (cafe and profile photos), so
+pages don't make a cross-origin fetch for each one.
+
+Each image is fetched once and kept on disk, and the least recently used
+copies are removed once they take up more than the space allowed.
+"""
+
+import hashlib
+import hmac
+import os
+import re
+import threading
+
+import requests
+from PIL import Image, UnidentifiedImageError
+
+from caching import LRUCache
+from images import (
+    ImageHostRefused, ImageTooLarge, check_public_url, download_image,
+)
+
+# formats we pass on, by Pillow format: (extension, mimetype)
+PROXY_FORMATS = {
+    "JPEG": ("jpg", "image/jpeg"),
+    "PNG": ("png", "image/png"),
+    "GIF": ("gif", "image/gif"),
+    "WEBP": ("webp", "image/webp"),
+}
+
+# names of finished copies (not downloads in progress)
+PROXY_FILENAME = re.compile(r"^[0-9a-f]{64}\.(?:jpg|png|gif|webp)$")
+
+
+class ImageProxyError(Exception):
+    """The image couldn't be fetched, or isn't one we'll pass on."""
+
+
+class ImageProxy:
+    """Fetches images from other hosts and keeps copies in `directory`.
+
+    Images over `max_bytes`, or whose host doesn't answer within `timeout`
+    seconds, are refused. Once the copies take up more than
+    `max_total_bytes`, the least recently used are removed. An image that
+    couldn't be fetched isn't tried again for `retry_after` seconds.
+
+    URLs are signed with `secret`, so only images our own pages link to
+    are fetched, rather than anything anyone asks for. As those include
+    URLs users give (eg, their profile picture), hosts with loopback,
+    private or link-local addresses are refused too, unless they're in
+    `allowed_hosts`.
+
+    Configure from an app with init_app, using IMAGE_PROXY_DIR,
+    IMAGE_PROXY_MAX_BYTES, IMAGE_PROXY_CACHE_BYTES, IMAGE_PROXY_TIMEOUT and
+    IMAGE_PROXY_ALLOWED_HOSTS.
+    """
+
+    def __init__(self, directory=None, secret="", max_bytes=5 * 1024 * 1024,
+                 max_total_bytes=500 * 1024 * 1024, timeout=5,
+                 retry_after=300, allowed_hosts=()):
+        self.directory = directory
+        self.secret = secret
+        self.max_bytes = max_bytes
+        self.max_total_bytes = max_total_bytes
+        self.timeout = timeout
+        self.allowed_hosts = set(allowed_hosts)
+        self._failures = LRUCache(1024, ttl=retry_after)
+        self._evict_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Configure from this app's config."""
+
+        self.directory = app.config.get('IMAGE_PROXY_DIR') or os.path.join(
+            app.instance_path, 'image-cache')
+        self.secret = app.config.get('SECRET_KEY') or ""
+        self.max_bytes = app.config.get('IMAGE_PROXY_MAX_BYTES', self.max_bytes)
+        self.max_total_bytes = app.config.get(
+            'IMAGE_PROXY_CACHE_BYTES', self.max_total_bytes)
+        self.timeout = app.config.get('IMAGE_PROXY_TIMEOUT', self.timeout)
+        self.allowed_hosts = set(app.config.get(
+            'IMAGE_PROXY_ALLOWED_HOSTS', self.allowed_hosts))
+
+    def sign(self, url):
+        """Return the signature that lets `url` through the proxy."""
+
+        return hmac.new(
+            self.secret.encode("utf-8"), url.encode("utf-8"), hashlib.sha256,
+        ).hexdigest()[:32]
+
+    def verify(self, url, signature):
+        """Is `signature` right for `url`?"""
+
+        return hmac.compare_digest(self.sign(url), signature)
+
+    def check_url(self, url):
+        """Raise images.ImageHostRefused unless `url` is http(s) on a host
+        whose addresses are all public (or one of allowed_hosts).
+        """
+
+        check_public_url(url, self.allowed_hosts)
+
+    def get_key(self, url):
+        """Return the key our copy of the image at `url` is saved under."""
+
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def find(self, key):
+        """Return (path, mimetype) of the saved copy with this key, or
+        None if there isn't one.
+        """
+
+        for ext, mimetype in PROXY_FORMATS.values():
+            path = os.path.join(self.directory, f"{key}.{ext}")
+            if os.path.exists(path):
+                return path, mimetype
+
+        return None
+
+    def get(self, url):
+        """Return (path, mimetype) of our copy of the image at `url`,
+        fetching it first if we don't have one.
+
+        Raises ImageProxyError if it can't be fetched or isn't an image.
+        """
+
+        key = self.get_key(url)
+        found = self.find(key)
+
+        if found:
+            try:
+                # mark it as recently used
+                os.utime(found[0])
+                return found
+            except FileNotFoundError:
+                pass
+
+        if self._failures.get(key):
+            raise ImageProxyError(url)
+
+        try:
+            found = self._fetch(url, key)
+        except (requests.RequestException, ImageTooLarge, ImageHostRefused,
+                ImageProxyError, UnidentifiedImageError) as error:
+            self._failures.set(key, True)
+            raise ImageProxyError(url) from error
+
+        self.evict()
+        return found
+
+    def _fetch(self, url, key):
+        os.makedirs(self.directory, exist_ok=True)
+        download_path = os.path.join(
+            self.directory, f"{key}.{threading.get_ident()}.download")
+
+        download_image(
+            url, download_path, self.timeout, self.max_bytes,
+            check_url=self.check_url)
+
+        try:
+            with Image.open(download_path) as image:
+                image_format = image.format
+
+            if image_format not in PROXY_FORMATS:
+                raise ImageProxyError(url)
+        except Exception:
+            os.remove(download_path)
+            raise
+
+        ext, mimetype = PROXY_FORMATS[image_format]
+        path = os.path.join(self.directory, f"{key}.{ext}")
+        os.replace(download_path, path)
+
+        return path, mimetype
+
+    def evict(self):
+        """Remove the least recently used copies until the rest fit in
+        max_total_bytes.
+        """
+
+        with self._evict_lock:
+            copies = []
+            for entry in os.scandir(self.directory):
+                if PROXY_FILENAME.match(entry.name):
+                    stat = entry.stat()
+                    copies.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in copies)
+
+            for _, size, path in sorted(copies):
+                if total <= self.max_total_bytes:
+                    break
+
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
@@ -0,0 +1,208 @@
+"""Resized copies ("derivatives") of saved images, for Flask Cafe.
+
+Maps and cafe photos are saved at full size; alongside each we save copies
+at a few widths, in WebP and JPEG, so pages can offer them in a `srcset`
+and phones needn't download more pixels than they show.
+"""
+
+import glob
+import ipaddress
+import os
+import re
+import socket
+import threading
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from PIL import Image, ImageOps
+
+# formats derivatives are saved in, best first: (extension, Pillow format,
+# mimetype)
+DERIVATIVE_FORMATS = [
+    ("webp", "WEBP", "image/webp"),
+    ("jpg", "JPEG", "image/jpeg"),
+]
+
+DERIVATIVE_QUALITY = 80
+
+# most redirects followed by download_image when it checks each URL
+MAX_REDIRECTS = 5
+
+MIMETYPES = {ext: mimetype for ext, _, mimetype in DERIVATIVE_FORMATS}
+
+# the end of a derivative's file name, eg "-640.webp"
+DERIVATIVE_SUFFIX = re.compile(r"-[0-9]+\.(?:webp|jpg)$")
+
+
+class ImageTooLarge(Exception):
+    """The image is bigger than we're willing to download."""
+
+
+class ImageHostRefused(Exception):
+    """The image's host is on a private network (or isn't http), so we
+    won't fetch from it.
+    """
+
+
+def check_public_url(url, allowed_hosts=()):
+    """Raise ImageHostRefused unless `url` is http(s) on a host whose
+    addresses are all public, or one of `allowed_hosts`, so a URL a user
+    gives can't have us fetch from our own network.
+    """
+
+    try:
+        parts = urlsplit(url)
+        host, port = parts.hostname, parts.port
+    except ValueError:
+        raise ImageHostRefused(url)
+
+    if parts.scheme not in ("http", "https") or not host:
+        raise ImageHostRefused(url)
+
+    if host in allowed_hosts:
+        return
+
+    try:
+        addresses = socket.getaddrinfo(
+            host, port or parts.scheme, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError):
+        raise ImageHostRefused(url)
+
+    for *_, sockaddr in addresses:
+        try:
+            address = ipaddress.ip_address(sockaddr[0])
+        except ValueError:
+            # eg, an IPv6 address with a scope, which is link-local
+            raise ImageHostRefused(url)
+
+        if not address.is_global or address.is_multicast:
+            raise ImageHostRefused(url)
+
+
+def _get(url, timeout, check_url):
+    """Start a streamed GET of `url`, following redirects. With
+    `check_url`, it's called on each URL (first and redirected) before
+    that URL is requested.
+    """
+
+    if check_url is None:
+        return requests.get(url, timeout=timeout, stream=True)
+
+    for _ in range(MAX_REDIRECTS + 1):
+        check_url(url)
+        response = requests.get(
+            url, timeout=timeout, stream=True, allow_redirects=False)
+        if not response.is_redirect:
+            return response
+
+        response.close()
+        url = urljoin(url, response.headers["Location"])
+
+    raise requests.TooManyRedirects(url)
+
+
+def download_image(url, path, timeout, max_bytes, check_url=None):
+    """Download the image at `url` to `path`, giving up if it's over
+    `max_bytes`. `timeout` is as for requests. The file only appears once
+    it's complete. `check_url`, if given, is called on `url` and any URL
+    it redirects to before fetching each, and may raise to refuse it.
+
+    Raises requests.RequestException if it can't be fetched, or
+    ImageTooLarge.
+    """
+
+    # write then rename, so a half-written image is never served
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+
+    with _get(url, timeout, check_url) as response:
+        response.raise_for_status()
+
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise ImageTooLarge(url)
+
+        try:
+            size = 0
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_content(65536):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise ImageTooLarge(url)
+                    f.write(chunk)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    os.replace(tmp_path, path)
+
+
+def get_derivative_path(path, width, ext):
+    """Return the path of the derivative of the image at `path` that's
+    `width` pixels wide, in format `ext`.
+    """
+
+    base, _ = os.path.splitext(path)
+    return f"{base}-{width}.{ext}"
+
+
+def make_derivatives(path, widths, missing_only=False):
+    """Save the derivatives of the image at `path`, at each of `widths` and
+    in each of DERIVATIVE_FORMATS, next to it.
+
+    Images are never scaled up: a derivative wider than the image is saved
+    at the image's own size. With `missing_only`, derivatives already saved
+    are kept.
+
+    Raises PIL.UnidentifiedImageError if the file isn't an image.
+    """
+
+    wanted = [
+        (width, ext, fmt)
+        for width in widths
+        for ext, fmt, _ in DERIVATIVE_FORMATS
+        if not (missing_only
+                and os.path.exists(get_derivative_path(path, width, ext)))
+    ]
+
+    if not wanted:
+        return
+
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        resized = {}
+
+        for width, ext, fmt in wanted:
+            if width not in resized:
+                height = round(image.height * min(width, image.width)
+                               / image.width)
+                resized[width] = image.resize(
+                    (min(width, image.width), height), Image.LANCZOS)
+
+            # write then rename, so a half-written image is never served
+            out_path = get_derivative_path(path, width, ext)
+            tmp_path = f"{out_path}.{threading.get_ident()}.tmp"
+            resized[width].save(tmp_path, fmt, quality=DERIVATIVE_QUALITY)
+            os.replace(tmp_path, out_path)
+
+
+def remove_derivatives(path):
+    """Remove every saved derivative of the image at `path`."""
+
+    base, _ = os.path.splitext(path)
+
+    for derivative in glob.glob(f"{glob.escape(base)}-*"):
+        if DERIVATIVE_SUFFIX.match(derivative[len(base):]):
+            os.remove(derivative)
+
+
+def get_srcset(base_url, widths, ext, version=None):
+    """Return a `srcset` listing the derivatives at `widths` in format
+    `ext`, whose URLs are `base_url` plus "-<width>.<ext>".
+    """
+
+    query = f"?v={version}" if version else ""
+    return ", ".join(
+        f"{base_url}-{width}.{ext}{query} {width}w" for width in widths)
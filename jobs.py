@@ -0,0 +1,137 @@
+"""Background job queues for Flask Cafe."""
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class JobQueue(ABC):
+    """Runs registered tasks outside the request that asked for them.
+
+    Tasks are registered by name with `task` and enqueued by name with
+    JSON-friendly arguments (eg, ids), so a queue backed by a database
+    table can store them as rows; subclasses decide where they run.
+
+    A task that raises is retried up to `retries` times, waiting `backoff`
+    seconds, then twice that, and so on. If it still fails, its
+    `on_failure` handler (if any) is called with the same arguments.
+    Tasks and handlers run inside an app context.
+    """
+
+    def __init__(self, retries=3, backoff=1.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.tasks = {}
+        self.failure_handlers = {}
+        self.app = None
+
+    def init_app(self, app):
+        """Run tasks for this app, configured by JOB_RETRIES and
+        JOB_BACKOFF.
+        """
+
+        self.app = app
+        self.retries = app.config.get('JOB_RETRIES', self.retries)
+        self.backoff = app.config.get('JOB_BACKOFF', self.backoff)
+
+    def task(self, fn=None, *, on_failure=None):
+        """Register a task under its function name (as a decorator)."""
+
+        def register(fn):
+            self.tasks[fn.__name__] = fn
+            if on_failure:
+                self.failure_handlers[fn.__name__] = on_failure
+            return fn
+
+        return register(fn) if fn else register
+
+    @abstractmethod
+    def enqueue(self, name, *args):
+        """Arrange for task `name` to be run with these arguments."""
+
+    def run(self, name, *args):
+        """Run task `name` now, retrying on errors. Returns True if it
+        succeeded.
+        """
+
+        fn = self.tasks[name]
+
+        for attempt in range(self.retries + 1):
+            try:
+                with self.app.app_context():
+                    fn(*args)
+                return True
+            except Exception:
+                self.app.logger.exception(
+                    "Job %s%r failed (attempt %d)", name, args, attempt + 1)
+
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+
+        handler = self.failure_handlers.get(name)
+        if handler:
+            with self.app.app_context():
+                handler(*args)
+
+        return False
+
+
+class ImmediateJobQueue(JobQueue):
+    """Runs each task as soon as it's enqueued, on the calling thread.
+
+    Useful for scripts (like seed.py) that want the work done before they
+    exit.
+    """
+
+    def enqueue(self, name, *args):
+        self.run(name, *args)
+
+
+class ThreadPoolJobQueue(JobQueue):
+    """Runs tasks in a pool of `workers` threads in this process, or with
+    0 workers, on the calling thread as they're enqueued (as
+    ImmediateJobQueue does).
+
+    Jobs still waiting when the process exits are lost.
+    """
+
+    def __init__(self, workers=2, retries=3, backoff=1.0):
+        super().__init__(retries=retries, backoff=backoff)
+        self.workers = workers
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        super().init_app(app)
+        self.workers = app.config.get('JOB_WORKERS', self.workers)
+
+    def enqueue(self, name, *args):
+        if name not in self.tasks:
+            raise KeyError(f"No such task: {name}")
+
+        if not self.workers:
+            self.run(name, *args)
+            return
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="job")
+            future = self._executor.submit(self.run, name, *args)
+            self._pending.add(future)
+
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def wait(self, timeout=None):
+        """Block until every job enqueued so far has finished."""
+
+        with self._lock:
+            pending = list(self._pending)
+
+        wait(pending, timeout=timeout)
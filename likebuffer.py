@@ -0,0 +1,116 @@
+"""Write-behind buffering of likes for Flask Cafe."""
+
+import atexit
+import threading
+
+from models import db, Like
+
+
+class LikeBuffer:
+    """Holds likes and unlikes for up to `interval` seconds, then writes
+    them in one batch.
+
+    Toggles of the same (user, cafe) in that time are coalesced, so only
+    the last one is written. A batch is also written as soon as
+    `max_pending` pairs are waiting, and at exit. A batch that fails is
+    kept to try again with the next one, unless newer toggles replaced it.
+
+    Until a batch is written, other processes (and like counts) don't see
+    it; `get` tells this process about toggles still waiting.
+
+    With an `interval` of 0, the buffer is off and callers should write
+    directly. Configure from an app with init_app, using
+    LIKE_BUFFER_INTERVAL and LIKE_BUFFER_MAX_PENDING.
+    """
+
+    def __init__(self, interval=0, max_pending=500):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.app = None
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Write batches for this app, configured from its config."""
+
+        self.app = app
+        self.interval = app.config.get('LIKE_BUFFER_INTERVAL', self.interval)
+        self.max_pending = app.config.get(
+            'LIKE_BUFFER_MAX_PENDING', self.max_pending)
+
+        if self.enabled:
+            atexit.register(self.flush)
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def set(self, user_id, cafe_id, liked):
+        """Record that this user now likes (or doesn't like) this cafe."""
+
+        with self._lock:
+            self._pending[(user_id, cafe_id)] = liked
+            full = len(self._pending) >= self.max_pending
+
+            if not full:
+                self._schedule()
+
+        if full:
+            self.flush()
+
+    def _schedule(self):
+        # with the lock held: flush in `interval` seconds, if not already due
+        if self._timer is None:
+            self._timer = threading.Timer(self.interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def get(self, user_id, cafe_id):
+        """Return whether this user likes this cafe as of a toggle still
+        waiting to be written, or None if there isn't one.
+        """
+
+        with self._lock:
+            return self._pending.get((user_id, cafe_id))
+
+    def pending_for(self, user_id):
+        """Return {cafe_id: liked} for this user's toggles still waiting to
+        be written.
+        """
+
+        with self._lock:
+            return {
+                cafe_id: liked
+                for (pending_user_id, cafe_id), liked in self._pending.items()
+                if pending_user_id == user_id
+            }
+
+    def flush(self):
+        """Write the waiting likes and unlikes now, in one transaction."""
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        if not pending:
+            return
+
+        with self.app.app_context():
+            try:
+                Like.add_many(
+                    [pair for pair, liked in pending.items() if liked])
+                Like.remove_many(
+                    [pair for pair, liked in pending.items() if not liked])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception(
+                    "Writing %d buffered likes failed", len(pending))
+
+                with self._lock:
+                    for pair, liked in pending.items():
+                        self._pending.setdefault(pair, liked)
+                    self._schedule()
@@ -1,23 +1,201 @@
+import hashlib
 import os
+import re
+import threading
+import time
+
 import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+from caching import LRUCache
+from images import make_derivatives
 
 API_KEY = os.environ.get("MAPQUEST_API_KEY")
+MAPQUEST_URL = os.environ.get(
+    "MAPQUEST_URL", "https://www.mapquestapi.com/staticmap/v5/map")
+
+# seconds to wait for MapQuest to connect / send the image
+MAPQUEST_TIMEOUT = (5, 30)
+
+# most connections kept open to MapQuest; more requests than this at once
+# wait for a free one
+MAPQUEST_POOL_SIZE = int(os.environ.get("MAPQUEST_POOL_SIZE", 10))
+
+MAPS_DIR = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)), "static", "maps")
+
+MAP_ZOOM = 15
+MAP_SIZE = "@2x"
+
+# widths of the smaller copies saved of each map (see images.py); maps are
+# shown 500 pixels wide
+MAP_WIDTHS = (250, 500, 1000)
+
+# file names of maps saved by key (older maps are saved by cafe id)
+MAP_KEY_FILENAME = re.compile(r"^[0-9a-f]{64}\.jpg$")
+
+# file names a map can be served under: its key (or, for older maps, its
+# cafe id), then ".jpg", or the width and format of a derivative
+MAP_FILE = re.compile(
+    r"^(?P<name>[0-9a-f]{64}|[0-9]+)"
+    r"(?:-(?P<width>[0-9]+)\.(?P<ext>jpg|webp)|\.jpg)$")
+
+# characters of the ETag used as the ?v= version in map URLs
+MAP_VERSION_LENGTH = 16
+
+# ETags of saved maps, by path, size and modification time, so each
+# version of a file is only hashed once
+_etags = LRUCache(4096)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the HTTP session shared by all map fetches in this process,
+    which keeps connections to MapQuest open between requests.
+    """
+
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=MAPQUEST_POOL_SIZE,
+                pool_block=True,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+
+    return _session
+
+
+def get_map_key(address, city, state, zoom=MAP_ZOOM, size=MAP_SIZE):
+    """Return the key for the map of this location: a hash of the
+    normalized address and map options, so the same place always gets
+    the same key (and the same image file).
+    """
+
+    parts = [address, city, state, str(zoom), size]
+    normalized = "|".join(" ".join(part.casefold().split()) for part in parts)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def get_map_path(key):
+    """Return the path of the saved map image with this key."""
 
-def get_map_url(address, city, state):
+    return os.path.join(MAPS_DIR, f"{key}.jpg")
+
+
+def get_map_etag(path):
+    """Return a strong ETag for the map image at `path`: the sha256 of its
+    contents. Returns None if there's no such file.
+    """
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    cache_key = (path, stat.st_size, stat.st_mtime_ns)
+    etag = _etags.get(cache_key)
+
+    if etag is None:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                digest.update(chunk)
+        etag = digest.hexdigest()
+        _etags.set(cache_key, etag)
+
+    return etag
+
+
+def get_map_version(name):
+    """Return the version of the saved map `name` (key or cafe id) to put
+    in its URL, which changes whenever the image does; None if it isn't
+    saved.
+    """
+
+    etag = get_map_etag(get_map_path(name))
+    return etag and etag[:MAP_VERSION_LENGTH]
+
+
+def get_map_url(address, city, state, zoom=MAP_ZOOM, size=MAP_SIZE):
     """Get MapQuest URL for a static map for this location."""
 
-    base = f"https://www.mapquestapi.com/staticmap/v5/map?key={API_KEY}"
+    base = f"{MAPQUEST_URL}?key={API_KEY}"
     where = f"{address},{city},{state}"
-    return f"{base}&center={where}&size=@2x&zoom=15&locations={where}"
+    return f"{base}&center={where}&size={size}&zoom={zoom}&locations={where}"
+
 
+def save_map(address, city, state, force=False):
+    """Get static map and save in static/maps directory of this app, named
+    by its key, with its derivatives. Returns the key.
 
-def save_map(id, address, city, state):
-    """Get static map and save in static/maps directory of this app."""
+    If a map for this key is already saved, it's reused rather than
+    fetched again, unless `force` is true.
+
+    Raises requests.RequestException if MapQuest can't be reached or
+    returns an error, or PIL.UnidentifiedImageError if it doesn't return
+    an image.
+    """
+
+    key = get_map_key(address, city, state)
+    path = get_map_path(key)
+
+    if os.path.exists(path) and not force:
+        make_derivatives(path, MAP_WIDTHS, missing_only=True)
+        return key
 
-    path = os.path.abspath(os.path.dirname(__file__))
     map_url = get_map_url(address, city, state)
-    response = requests.get(map_url)
+    response = get_session().get(map_url, timeout=MAPQUEST_TIMEOUT)
+    response.raise_for_status()
+
+    # write then rename, so a half-written map is never served; and only
+    # once it's an image, or it would be reused for this key from then on
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(response.content)
+        with Image.open(tmp_path) as image:
+            image.verify()
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+    try:
+        make_derivatives(path, MAP_WIDTHS)
+    except Exception:
+        os.remove(path)
+        raise
+
+    return key
+
+
+def unused_map_keys(used_keys, min_age=0):
+    """Return keys of saved maps not in `used_keys`, skipping any saved in
+    the last `min_age` seconds (they may be about to be used).
+    """
+
+    cutoff = time.time() - min_age
+    unused = []
+
+    for filename in os.listdir(MAPS_DIR):
+        if not MAP_KEY_FILENAME.match(filename):
+            continue
+
+        key = filename[:-len(".jpg")]
+        if key in used_keys:
+            continue
 
-    with open(f"{path}/static/maps/{id}.jpg", "wb") as f:
-        f.write(response.content)
+        if os.path.getmtime(os.path.join(MAPS_DIR, filename)) <= cutoff:
+            unused.append(key)
 
+    return unused
@@ -0,0 +1,83 @@
+-- Full-text search for cafes: weighted tsvector column, GIN index and the
+-- triggers that keep it current. For databases created before this column
+-- existed; new databases get all of this from db.create_all().
+--
+--     psql flask_cafe < migrations/001_cafe_search_vector.sql
+
+BEGIN;
+
+ALTER TABLE cafes ADD COLUMN search_vector tsvector;
+
+CREATE OR REPLACE FUNCTION cafe_search_vector(
+    cafe_name text, cafe_description text, cafe_city_code text, cafe_id int
+) RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('english', coalesce(cafe_name, '')), 'A')
+        || setweight(to_tsvector('english', coalesce(
+            (SELECT string_agg(name, ' ') FROM specialities
+             WHERE cafe_id = cafe_search_vector.cafe_id), '')), 'B')
+        || setweight(to_tsvector('english', coalesce(
+            (SELECT name FROM cities WHERE code = cafe_city_code), '')), 'C')
+        || setweight(to_tsvector('english', coalesce(cafe_description, '')), 'D')
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION cafes_search_vector_trigger() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := cafe_search_vector(
+        NEW.name, NEW.description, NEW.city_code, NEW.id);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cafes_search_vector
+    BEFORE INSERT OR UPDATE OF name, description, city_code ON cafes
+    FOR EACH ROW EXECUTE FUNCTION cafes_search_vector_trigger();
+
+CREATE OR REPLACE FUNCTION specialities_search_vector_trigger()
+RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE cafes
+        SET search_vector = cafe_search_vector(name, description, city_code, id)
+        WHERE id IN (SELECT cafe_id FROM new_rows);
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE cafes
+        SET search_vector = cafe_search_vector(name, description, city_code, id)
+        WHERE id IN (SELECT cafe_id FROM old_rows);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER specialities_insert_search_vector
+    AFTER INSERT ON specialities REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION specialities_search_vector_trigger();
+
+CREATE TRIGGER specialities_update_search_vector
+    AFTER UPDATE ON specialities
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION specialities_search_vector_trigger();
+
+CREATE TRIGGER specialities_delete_search_vector
+    AFTER DELETE ON specialities REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION specialities_search_vector_trigger();
+
+CREATE OR REPLACE FUNCTION cities_search_vector_trigger() RETURNS trigger AS $$
+BEGIN
+    UPDATE cafes
+    SET search_vector = cafe_search_vector(name, description, city_code, id)
+    WHERE city_code = NEW.code;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cities_search_vector
+    AFTER UPDATE OF name ON cities
+    FOR EACH ROW EXECUTE FUNCTION cities_search_vector_trigger();
+
+UPDATE cafes
+SET search_vector = cafe_search_vector(name, description, city_code, id);
+
+CREATE INDEX ix_cafes_search_vector ON cafes USING gin (search_vector);
+
+COMMIT;
@@ -0,0 +1,18 @@
+-- Trigram indexes on cafe and speciality names, used by SEARCH_MODE
+-- 'trigram' for substring and typo-tolerant matching. Needs the pg_trgm
+-- extension (in postgresql-contrib). New databases get these from
+-- db.create_all() when pg_trgm is available.
+--
+--     psql flask_cafe < migrations/002_trigram_search.sql
+
+BEGIN;
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX ix_cafes_name_trgm
+    ON cafes USING gin (name gin_trgm_ops);
+
+CREATE INDEX ix_specialities_name_trgm
+    ON specialities USING gin (name gin_trgm_ops);
+
+COMMIT;
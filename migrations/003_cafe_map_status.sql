@@ -0,0 +1,7 @@
+-- Map generation status for cafes. Maps of existing cafes were made when
+-- they were saved, so they start out ready.
+--
+--     psql flask_cafe < migrations/003_cafe_map_status.sql
+
+ALTER TABLE cafes ADD COLUMN map_status text NOT NULL DEFAULT 'ready';
+ALTER TABLE cafes ALTER COLUMN map_status DROP DEFAULT;
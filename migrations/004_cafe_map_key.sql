@@ -0,0 +1,7 @@
+-- Key of each cafe's saved map image (see mapping.get_map_key). Existing
+-- maps are named by cafe id and keep being served from there until the
+-- cafe's map is next saved.
+--
+--     psql flask_cafe < migrations/004_cafe_map_key.sql
+
+ALTER TABLE cafes ADD COLUMN map_key text;
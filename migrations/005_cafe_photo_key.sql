@@ -0,0 +1,7 @@
+-- Key of the saved copy of each cafe's photo (see photos.save_photo).
+-- Until it's set, pages show the photo from its own host; to save copies
+-- of existing photos, run `flask cafes cache-photos`.
+--
+--     psql flask_cafe < migrations/005_cafe_photo_key.sql
+
+ALTER TABLE cafes ADD COLUMN photo_key text;
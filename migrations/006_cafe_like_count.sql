@@ -0,0 +1,50 @@
+-- Number of likes of each cafe, kept up to date by triggers on likes (see
+-- LIKE_COUNT_DDL in models.py), and indexes for ranking cafes by it and
+-- finding a cafe's likes. `flask cafes recount-likes` fixes any counts
+-- that drift.
+--
+--     psql flask_cafe < migrations/006_cafe_like_count.sql
+
+BEGIN;
+
+-- no likes change while they're counted and the triggers go in
+LOCK TABLE likes IN SHARE MODE;
+
+ALTER TABLE cafes ADD COLUMN like_count integer NOT NULL DEFAULT 0;
+
+UPDATE cafes
+SET like_count = counted.n
+FROM (SELECT cafe_id, count(*) AS n FROM likes GROUP BY cafe_id) AS counted
+WHERE cafes.id = counted.cafe_id;
+
+CREATE INDEX ix_cafes_like_count ON cafes (like_count DESC, id);
+CREATE INDEX ix_likes_cafe_id ON likes (cafe_id);
+
+CREATE OR REPLACE FUNCTION likes_like_count_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE cafes
+        SET like_count = like_count + added.n
+        FROM (SELECT cafe_id, count(*) AS n FROM new_rows GROUP BY cafe_id)
+            AS added
+        WHERE cafes.id = added.cafe_id;
+    ELSE
+        UPDATE cafes
+        SET like_count = like_count - removed.n
+        FROM (SELECT cafe_id, count(*) AS n FROM old_rows GROUP BY cafe_id)
+            AS removed
+        WHERE cafes.id = removed.cafe_id;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER likes_insert_like_count
+    AFTER INSERT ON likes REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION likes_like_count_trigger();
+
+CREATE TRIGGER likes_delete_like_count
+    AFTER DELETE ON likes REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION likes_like_count_trigger();
+
+COMMIT;
@@ -0,0 +1,19 @@
+-- Cafes can have many specialities, used as tags: at most one of each
+-- name per cafe, and an index to find cafes by tag (see
+-- Speciality.cafe_ids_tagged).
+--
+--     psql flask_cafe < migrations/007_speciality_tags.sql
+
+BEGIN;
+
+DELETE FROM specialities a
+    USING specialities b
+    WHERE a.cafe_id = b.cafe_id AND a.name = b.name AND a.id > b.id;
+
+ALTER TABLE specialities
+    ADD CONSTRAINT uq_specialities_cafe_id_name UNIQUE (cafe_id, name);
+
+CREATE INDEX ix_specialities_lower_name_cafe_id
+    ON specialities (lower(name), cafe_id);
+
+COMMIT;
@@ -0,0 +1,44 @@
+-- When each cafe (or its specialities) last changed, kept up to date by
+-- triggers (see UPDATED_AT_DDL in models.py); caches of rendered cafes
+-- are keyed on it.
+--
+--     psql flask_cafe < migrations/008_cafe_updated_at.sql
+
+BEGIN;
+
+ALTER TABLE cafes
+    ADD COLUMN updated_at timestamp with time zone NOT NULL DEFAULT now();
+
+CREATE OR REPLACE FUNCTION cafes_updated_at_trigger() RETURNS trigger AS $$
+BEGIN
+    IF to_jsonb(NEW) - 'like_count' - 'updated_at'
+            IS DISTINCT FROM to_jsonb(OLD) - 'like_count' - 'updated_at' THEN
+        NEW.updated_at := clock_timestamp();
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cafes_updated_at
+    BEFORE UPDATE ON cafes
+    FOR EACH ROW EXECUTE FUNCTION cafes_updated_at_trigger();
+
+CREATE OR REPLACE FUNCTION specialities_cafe_updated_at_trigger()
+RETURNS trigger AS $$
+BEGIN
+    UPDATE cafes
+    SET updated_at = clock_timestamp()
+    WHERE id IN (SELECT cafe_id FROM changed_rows);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER specialities_insert_cafe_updated_at
+    AFTER INSERT ON specialities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION specialities_cafe_updated_at_trigger();
+
+CREATE TRIGGER specialities_delete_cafe_updated_at
+    AFTER DELETE ON specialities REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION specialities_cafe_updated_at_trigger();
+
+COMMIT;
@@ -0,0 +1,15 @@
+-- When each speciality and like last changed, for the ETag and
+-- Last-Modified headers of cafe pages and /api/likes. Existing rows get
+-- the time of the migration.
+--
+--     psql flask_cafe < migrations/009_updated_at.sql
+
+BEGIN;
+
+ALTER TABLE specialities
+    ADD COLUMN updated_at timestamp with time zone NOT NULL DEFAULT now();
+
+ALTER TABLE likes
+    ADD COLUMN updated_at timestamp with time zone NOT NULL DEFAULT now();
+
+COMMIT;
@@ -1,13 +1,20 @@
 """Data models for Flask Cafe"""
 
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import (
+    DDL, column, delete, event, func, select, text, tuple_, values,
+)
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert
+from sqlalchemy.orm import joinedload, selectinload, with_expression
 
-from mapping import save_map
+from images import get_srcset
+from mapping import MAP_WIDTHS, get_map_key, get_map_version, save_map
+from photos import PHOTO_WIDTHS, is_remote, save_photo
+from passwords import PasswordHasher
 
 
-bcrypt = Bcrypt()
+password_hasher = PasswordHasher()
 db = SQLAlchemy()
 
 
@@ -37,6 +44,12 @@ class Cafe(db.Model):
 
     __tablename__ = 'cafes'
 
+    MAP_PENDING = "pending"
+    MAP_READY = "ready"
+    MAP_FAILED = "failed"
+
+    MAP_PLACEHOLDER_URL = "/static/images/map-pending.svg"
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -74,11 +87,119 @@ class Cafe(db.Model):
         default="/static/images/default-cafe.jpg",
     )
 
+    # whether the map image has been made yet (see tasks.generate_map)
+    map_status = db.Column(
+        db.Text,
+        nullable=False,
+        default=MAP_PENDING,
+    )
+
+    # key of the saved map image (see mapping.get_map_key); maps saved
+    # before keys were used are named by cafe id instead
+    map_key = db.Column(
+        db.Text,
+    )
+
+    # key of the saved copy of image_url (see photos.save_photo), once
+    # it's been fetched; until then pages use image_url itself
+    photo_key = db.Column(
+        db.Text,
+    )
+
+    # number of likes; maintained by the triggers in LIKE_COUNT_DDL
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # when anything shown about the cafe last changed (its like count
+    # aside); maintained by the triggers in UPDATED_AT_DDL
+    updated_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        server_default=func.now(),
+    )
+
+    # weighted full-text document over name, specialities, city and
+    # description; maintained by the triggers in SEARCH_DDL. Deferred, as
+    # only search filters on it, so loading a cafe doesn't fetch it
+    search_vector = db.deferred(db.Column(
+        TSVECTOR,
+    ))
+
+    # when a given user liked the cafe (None if they don't); only loaded
+    # by a query with the with_liked_at option
+    liked_at = db.query_expression()
+
     city = db.relationship("City", backref='cafes')
 
+    __table_args__ = (
+        db.Index(
+            'ix_cafes_search_vector',
+            'search_vector',
+            postgresql_using='gin',
+        ),
+        # most liked first (see query_most_liked)
+        db.Index(
+            'ix_cafes_like_count',
+            like_count.desc(),
+            id,
+        ),
+    )
+
     def __repr__(self):
         return f'<Cafe id={self.id} name="{self.name}">'
 
+    @classmethod
+    def query_for_list(cls):
+        """Query for cafe cards: loads each cafe's city in the same query."""
+
+        return cls.query.options(joinedload(cls.city))
+
+    @classmethod
+    def with_liked_at(cls, user_id):
+        """Query option loading each cafe's liked_at for this user, in the
+        same query as the cafes.
+        """
+
+        return with_expression(cls.liked_at, (
+            select(Like.updated_at)
+            .where(Like.cafe_id == cls.id, Like.user_id == user_id)
+            .scalar_subquery()
+        ))
+
+    @classmethod
+    def query_most_liked(cls):
+        """Query for cafes, most liked first, with their cities loaded."""
+
+        return cls.query_for_list().order_by(cls.like_count.desc(), cls.id)
+
+    @classmethod
+    def delete_many(cls, cafe_ids):
+        """Delete these cafes. Their likes and specialities go with them,
+        by the ON DELETE CASCADE of their foreign keys, rather than being
+        loaded and deleted one by one.
+
+        Returns {cafe_id: (name, [speciality names])} of the cafes
+        deleted; ids of cafes that don't exist are skipped.
+        """
+
+        speciality_names = {}
+        for cafe_id, name in db.session.execute(
+                select(Speciality.cafe_id, Speciality.name)
+                .where(Speciality.cafe_id.in_(cafe_ids))):
+            speciality_names.setdefault(cafe_id, []).append(name)
+
+        deleted = db.session.execute(
+            delete(cls).where(cls.id.in_(cafe_ids)).returning(cls.id, cls.name))
+
+        return {
+            cafe_id: (name, speciality_names.get(cafe_id, []))
+            for cafe_id, name in deleted
+        }
+
     def get_city_state(self):
         """Return 'city, state' for cafe."""
 
@@ -88,14 +209,84 @@ class Cafe(db.Model):
     def is_liked_by(self, other_user):
         """Is this cafe liked by user?"""
 
-        liked_user_list = [
-            user for user in self.users_liked_cafe if user.id == other_user.id]
-        return len(liked_user_list) == 1
+        return Like.exists_for(other_user.id, self.id)
+
+    def get_map_key(self):
+        """Return the key the map for this cafe's address should have."""
+
+        # by code, as the city relationship may not reflect an edit yet
+        city = db.session.get(City, self.city_code)
+        return get_map_key(self.address, city.name, city.state)
 
     def save_map(self):
-        """Saves the map image for this cafe."""
+        """Saves the map image for this cafe, now.
+
+        Routes should enqueue tasks.generate_map instead, so the request
+        doesn't wait on MapQuest.
+        """
+
+        self.map_key = save_map(self.address, self.city.name, self.city.state)
+        self.map_status = self.MAP_READY
+
+    def get_map_url(self):
+        """Return URL of the map image, or a placeholder until it's made.
+
+        The URL carries the image's version, so browsers can cache it for
+        good (see the map_image route).
+        """
+
+        if self.map_status != self.MAP_READY:
+            return self.MAP_PLACEHOLDER_URL
+
+        name = self.map_key or self.id
+        version = get_map_version(name)
+
+        if not version:
+            return f"/maps/{name}.jpg"
+
+        return f"/maps/{name}.jpg?v={version}"
+
+    def get_map_srcset(self, ext):
+        """Return a srcset of the smaller copies of the map in format `ext`
+        (eg, 'webp'), or None until it's made.
+        """
+
+        if self.map_status != self.MAP_READY:
+            return None
+
+        name = self.map_key or self.id
+        return get_srcset(
+            f"/maps/{name}", MAP_WIDTHS, ext, get_map_version(name))
+
+    def save_photo(self):
+        """Saves a copy of this cafe's photo, with smaller copies, now (if
+        it's on another host).
+
+        Routes should enqueue tasks.cache_photo instead.
+        """
+
+        if is_remote(self.image_url):
+            self.photo_key = save_photo(self.image_url)
+        else:
+            self.photo_key = None
+
+    def get_photo_url(self):
+        """Return URL of this cafe's photo: our copy, if we have one."""
+
+        if not self.photo_key:
+            return self.image_url
+
+        return f"/static/photos/{self.photo_key}.jpg"
 
-        save_map(self.id, self.address, self.city.name, self.city.state)
+    def get_photo_srcset(self, ext):
+        """Return a srcset of the smaller copies of this cafe's photo in
+        format `ext`, or None if we don't have them.
+        """
+
+        if not self.photo_key:
+            return None
+
+        return get_srcset(f"/static/photos/{self.photo_key}", PHOTO_WIDTHS, ext)
 
 
 class Like(db.Model):
@@ -115,6 +306,101 @@ class Like(db.Model):
         primary_key=True
     )
 
+    # when the cafe was liked (likes are never changed, only removed)
+    updated_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        server_default=func.now(),
+    )
+
+    # the primary key covers lookups by user; this covers them by cafe
+    # (counting a cafe's likes, deleting a cafe)
+    __table_args__ = (
+        db.Index('ix_likes_cafe_id', 'cafe_id'),
+    )
+
+    @classmethod
+    def add(cls, user_id, cafe_id):
+        """Make this user like this cafe, if they don't already: a single
+        INSERT ... ON CONFLICT DO NOTHING, so repeating it is harmless.
+
+        Raises IntegrityError if there's no such user or cafe.
+        """
+
+        db.session.execute(
+            insert(cls)
+            .values(user_id=user_id, cafe_id=cafe_id)
+            .on_conflict_do_nothing()
+        )
+
+    @classmethod
+    def remove(cls, user_id, cafe_id):
+        """Make this user not like this cafe (a single DELETE)."""
+
+        db.session.execute(
+            delete(cls).where(cls.user_id == user_id, cls.cafe_id == cafe_id))
+
+    @classmethod
+    def add_many(cls, pairs):
+        """Add likes for these (user_id, cafe_id) pairs in one statement,
+        skipping any already there, or whose user or cafe is gone.
+        """
+
+        if not pairs:
+            return
+
+        pending = values(
+            column('user_id', db.Integer),
+            column('cafe_id', db.Integer),
+            name='pending',
+        ).data(list(pairs))
+
+        db.session.execute(
+            insert(cls)
+            .from_select(
+                ['user_id', 'cafe_id'],
+                select(pending.c.user_id, pending.c.cafe_id)
+                .join(User, User.id == pending.c.user_id)
+                .join(Cafe, Cafe.id == pending.c.cafe_id),
+            )
+            .on_conflict_do_nothing()
+        )
+
+    @classmethod
+    def remove_many(cls, pairs):
+        """Remove likes for these (user_id, cafe_id) pairs in one statement."""
+
+        if not pairs:
+            return
+
+        db.session.execute(
+            delete(cls).where(tuple_(cls.user_id, cls.cafe_id).in_(list(pairs))))
+
+    @classmethod
+    def exists_for(cls, user_id, cafe_id):
+        """Does this user like this cafe? One EXISTS query on the primary
+        key, without loading either.
+        """
+
+        return db.session.query(
+            db.exists().where(cls.user_id == user_id, cls.cafe_id == cafe_id)
+        ).scalar()
+
+    @classmethod
+    def cafe_ids_liked_by(cls, user_id, cafe_ids=None):
+        """Return the set of which of `cafe_ids` this user likes (or, with
+        no `cafe_ids`, the ids of every cafe they like), in one query.
+        """
+
+        if cafe_ids is not None and not cafe_ids:
+            return set()
+
+        query = db.session.query(cls.cafe_id).filter(cls.user_id == user_id)
+        if cafe_ids is not None:
+            query = query.filter(cls.cafe_id.in_(cafe_ids))
+
+        return {cafe_id for (cafe_id,) in query}
+
 
 class Speciality(db.Model):
     """Specialties for cafes."""
@@ -137,7 +423,113 @@ class Speciality(db.Model):
         nullable=False
     )
 
-    cafe = db.relationship("Cafe", backref='specialities')
+    updated_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        server_default=func.now(),
+        onupdate=func.now(),
+    )
+
+    # deleting a cafe leaves its specialities to the database's cascade
+    cafe = db.relationship(
+        "Cafe",
+        backref=db.backref('specialities', passive_deletes=True),
+    )
+
+    __table_args__ = (
+        db.UniqueConstraint(
+            'cafe_id', 'name', name='uq_specialities_cafe_id_name'),
+        # cafes by tag, case-insensitively (see cafe_ids_tagged)
+        db.Index(
+            'ix_specialities_lower_name_cafe_id',
+            func.lower(name),
+            cafe_id,
+        ),
+    )
+
+    @classmethod
+    def set_for_cafe(cls, cafe_id, names):
+        """Make `names` this cafe's specialities, inserting and deleting
+        only those that changed rather than rewriting them all.
+
+        Returns (added, removed) lists of names.
+        """
+
+        current = set(
+            db.session.scalars(select(cls.name).where(cls.cafe_id == cafe_id)))
+
+        added = [name for name in names if name not in current]
+        removed = sorted(current.difference(names))
+
+        if removed:
+            db.session.execute(
+                delete(cls)
+                .where(cls.cafe_id == cafe_id, cls.name.in_(removed))
+                .execution_options(synchronize_session=False)
+            )
+
+        if added:
+            db.session.execute(
+                insert(cls)
+                .values([{"cafe_id": cafe_id, "name": name} for name in added])
+                .on_conflict_do_nothing()
+            )
+
+        return added, removed
+
+    @classmethod
+    def set_for_cafes(cls, names_by_cafe_id):
+        """Like set_for_cafe, for many cafes at once, given
+        {cafe_id: names}: one statement deletes the specialities no longer
+        wanted and one inserts those that are new.
+        """
+
+        pairs = [
+            (cafe_id, name)
+            for cafe_id, names in names_by_cafe_id.items()
+            for name in names
+        ]
+
+        stale = delete(cls).where(cls.cafe_id.in_(list(names_by_cafe_id)))
+        if pairs:
+            stale = stale.where(tuple_(cls.cafe_id, cls.name).not_in(pairs))
+        db.session.execute(stale.execution_options(synchronize_session=False))
+
+        if pairs:
+            db.session.execute(
+                insert(cls)
+                .values([
+                    {"cafe_id": cafe_id, "name": name}
+                    for cafe_id, name in pairs
+                ])
+                .on_conflict_do_nothing()
+            )
+
+    @classmethod
+    def cafe_ids_tagged(cls, tags, match_all=True):
+        """Select the ids of cafes with all of these specialities (or, if
+        not `match_all`, any of them), ignoring case.
+        """
+
+        tags = {tag.lower() for tag in tags}
+
+        query = (
+            select(cls.cafe_id)
+            .where(func.lower(cls.name).in_(tags))
+            .group_by(cls.cafe_id)
+        )
+
+        if match_all:
+            query = query.having(
+                func.count(func.distinct(func.lower(cls.name))) == len(tags))
+
+        return query
+
+    @classmethod
+    def query_with_cafe(cls):
+        """Query for specialities with their cafe loaded in the same query."""
+
+        return cls.query.options(joinedload(cls.cafe))
 
 
 class User(db.Model):
@@ -192,12 +584,23 @@ class User(db.Model):
         nullable=False,
     )
 
+    # deleting a user or cafe leaves their likes to the database's cascade
     liked_cafes = db.relationship(
-    "Cafe",
-    secondary="likes",
-    backref="users_liked_cafes"
+        "Cafe",
+        secondary="likes",
+        backref=db.backref("users_liked_cafes", passive_deletes=True),
+        passive_deletes=True,
     )
 
+    @classmethod
+    def query_with_liked_cafes(cls):
+        """Query for users with their liked cafes (and cities) loaded up
+        front, rather than one query per cafe.
+        """
+
+        return cls.query.options(
+            selectinload(cls.liked_cafes).joinedload(Cafe.city))
+
     def get_full_name(self):
         """Returns a string of full name of the user"""
 
@@ -207,7 +610,7 @@ class User(db.Model):
     def register(cls, username, email, first_name, last_name, description, password, admin=False, image_url='/static/images/default-pic.jpg'):
         """Registers a user, hashes password, and adds user to session."""
 
-        hashed_password = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_password = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -232,17 +635,237 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If this can't find matching user (or if password is wrong), returns
-        False.
+        False. Unknown usernames take as long as wrong passwords.
+
+        If the password was hashed at a different cost than we use now, it
+        is rehashed; the caller should commit.
         """
 
         user = cls.query.filter_by(username=username).one_or_none()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if not user:
+            return password_hasher.check_dummy(password)
+
+        if not password_hasher.check(user.password, password):
+            return False
+
+        if password_hasher.needs_rehash(user.password):
+            user.password = password_hasher.hash(password)
+
+        return user
+
+#######################################
+# full-text search triggers
+
+# Keep in sync with migrations/001_cafe_search_vector.sql
+
+SEARCH_DDL = DDL("""
+CREATE OR REPLACE FUNCTION cafe_search_vector(
+    cafe_name text, cafe_description text, cafe_city_code text, cafe_id int
+) RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('english', coalesce(cafe_name, '')), 'A')
+        || setweight(to_tsvector('english', coalesce(
+            (SELECT string_agg(name, ' ') FROM specialities
+             WHERE cafe_id = cafe_search_vector.cafe_id), '')), 'B')
+        || setweight(to_tsvector('english', coalesce(
+            (SELECT name FROM cities WHERE code = cafe_city_code), '')), 'C')
+        || setweight(to_tsvector('english', coalesce(cafe_description, '')), 'D')
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION cafes_search_vector_trigger() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := cafe_search_vector(
+        NEW.name, NEW.description, NEW.city_code, NEW.id);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cafes_search_vector
+    BEFORE INSERT OR UPDATE OF name, description, city_code ON cafes
+    FOR EACH ROW EXECUTE FUNCTION cafes_search_vector_trigger();
+
+CREATE OR REPLACE FUNCTION specialities_search_vector_trigger()
+RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE cafes
+        SET search_vector = cafe_search_vector(name, description, city_code, id)
+        WHERE id IN (SELECT cafe_id FROM new_rows);
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE cafes
+        SET search_vector = cafe_search_vector(name, description, city_code, id)
+        WHERE id IN (SELECT cafe_id FROM old_rows);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER specialities_insert_search_vector
+    AFTER INSERT ON specialities REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION specialities_search_vector_trigger();
+
+CREATE TRIGGER specialities_update_search_vector
+    AFTER UPDATE ON specialities
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION specialities_search_vector_trigger();
+
+CREATE TRIGGER specialities_delete_search_vector
+    AFTER DELETE ON specialities REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION specialities_search_vector_trigger();
+
+CREATE OR REPLACE FUNCTION cities_search_vector_trigger() RETURNS trigger AS $$
+BEGIN
+    UPDATE cafes
+    SET search_vector = cafe_search_vector(name, description, city_code, id)
+    WHERE city_code = NEW.code;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cities_search_vector
+    AFTER UPDATE OF name ON cities
+    FOR EACH ROW EXECUTE FUNCTION cities_search_vector_trigger();
+""")
+
+# Keeps cafes.like_count equal to the number of likes rows for each cafe,
+# whether likes are added or removed directly or by deleting a user or
+# cafe (likes rows are never updated). Keep in sync with
+# migrations/006_cafe_like_count.sql
+
+LIKE_COUNT_DDL = DDL("""
+CREATE OR REPLACE FUNCTION likes_like_count_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE cafes
+        SET like_count = like_count + added.n
+        FROM (SELECT cafe_id, count(*) AS n FROM new_rows GROUP BY cafe_id)
+            AS added
+        WHERE cafes.id = added.cafe_id;
+    ELSE
+        UPDATE cafes
+        SET like_count = like_count - removed.n
+        FROM (SELECT cafe_id, count(*) AS n FROM old_rows GROUP BY cafe_id)
+            AS removed
+        WHERE cafes.id = removed.cafe_id;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER likes_insert_like_count
+    AFTER INSERT ON likes REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION likes_like_count_trigger();
+
+CREATE TRIGGER likes_delete_like_count
+    AFTER DELETE ON likes REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION likes_like_count_trigger();
+""")
+
+# Sets cafes.updated_at whenever a cafe or its specialities change, but not
+# when only its like count does, so caches keyed on it (eg, of rendered
+# cafe cards) survive likes. Keep in sync with
+# migrations/008_cafe_updated_at.sql
+
+UPDATED_AT_DDL = DDL("""
+CREATE OR REPLACE FUNCTION cafes_updated_at_trigger() RETURNS trigger AS $$
+BEGIN
+    IF to_jsonb(NEW) - 'like_count' - 'updated_at'
+            IS DISTINCT FROM to_jsonb(OLD) - 'like_count' - 'updated_at' THEN
+        NEW.updated_at := clock_timestamp();
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cafes_updated_at
+    BEFORE UPDATE ON cafes
+    FOR EACH ROW EXECUTE FUNCTION cafes_updated_at_trigger();
+
+CREATE OR REPLACE FUNCTION specialities_cafe_updated_at_trigger()
+RETURNS trigger AS $$
+BEGIN
+    UPDATE cafes
+    SET updated_at = clock_timestamp()
+    WHERE id IN (SELECT cafe_id FROM changed_rows);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER specialities_insert_cafe_updated_at
+    AFTER INSERT ON specialities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION specialities_cafe_updated_at_trigger();
+
+CREATE TRIGGER specialities_delete_cafe_updated_at
+    AFTER DELETE ON specialities REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION specialities_cafe_updated_at_trigger();
+""")
+
+# Trigram indexes for substring and fuzzy name matching (SEARCH_MODE
+# 'trigram'). Keep in sync with migrations/002_trigram_search.sql
+
+TRIGRAM_DDL = DDL("""
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX ix_cafes_name_trgm
+    ON cafes USING gin (name gin_trgm_ops);
+
+CREATE INDEX ix_specialities_name_trgm
+    ON specialities USING gin (name gin_trgm_ops);
+""")
+
+
+def pg_trgm_available(ddl, target, bind, **kw):
+    """Is the pg_trgm extension installable on this database server?"""
+
+    available = bind.execute(text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"))
+    return available.first() is not None
+
+
+# runs once all tables exist, since the functions refer to several of them
+event.listen(db.metadata, 'after_create', SEARCH_DDL)
+event.listen(db.metadata, 'after_create', LIKE_COUNT_DDL)
+event.listen(db.metadata, 'after_create', UPDATED_AT_DDL)
+event.listen(
+    db.metadata,
+    'after_create',
+    TRIGRAM_DDL.execute_if(callable_=pg_trgm_available),
+)
+
+
+class CachedUser:
+    """The fields of a User that most requests need, safe to keep in a
+    cache between requests.
+
+    Use `load()` to get the User itself when other attributes (eg,
+    `liked_cafes`) are needed, or to change or delete it.
+    """
+
+    FIELDS = ('id', 'username', 'admin', 'first_name', 'last_name', 'image_url')
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        return f'<CachedUser id={self.id} username="{self.username}">'
+
+    @classmethod
+    def from_user(cls, user):
+        """Make a CachedUser from a User."""
+
+        return cls(**{field: getattr(user, field) for field in cls.FIELDS})
+
+    def load(self):
+        """Return the User for this id, from the database."""
+
+        return db.session.get(User, self.id)
+
+    def get_full_name(self):
+        """Returns a string of full name of the user"""
+
+        return f"{self.first_name} {self.last_name}"
 
-        return False
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -253,3 +876,4 @@ def connect_db(app):
     app.app_context().push()
     db.app = app
     db.init_app(app)
+    password_hasher.init_app(app)
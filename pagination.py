@@ -0,0 +1,219 @@
+"""Keyset (cursor) pagination for Flask Cafe."""
+
+import base64
+import json
+
+from sqlalchemy import tuple_
+
+
+def encode_cursor(values):
+    """Encode a list of key values as an opaque, URL-safe cursor string."""
+
+    raw = json.dumps(list(values), separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by `encode_cursor`.
+
+    Returns the list of key values, or None if the cursor is missing or
+    can't be read.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, TypeError):
+        return None
+
+    if not isinstance(values, list):
+        return None
+
+    return values
+
+
+def _fits(key, value):
+    """Is `value` of the Python type of column `key`?"""
+
+    python_type = key.type.python_type
+    # bool is a subclass of int, but JSON true isn't an id
+    if isinstance(value, bool) and python_type is not bool:
+        return False
+    # Postgres text can't hold NUL
+    if isinstance(value, str) and "\x00" in value:
+        return False
+    return isinstance(value, python_type)
+
+
+class KeysetPage:
+    """One page of `query`, ordered ascending by the columns in `keys`.
+
+    Pass the cursor of the last row seen as `after` for the next page, or
+    the cursor of the first row seen as `before` for the previous page.
+    The last key should be unique (eg, the primary key) so every row has
+    a distinct position.
+
+    Rows are fetched on first use, so a streamed template can send its
+    header before the query runs.
+    """
+
+    def __init__(self, query, keys, limit, after=None, before=None):
+        self.query = query
+        self.keys = keys
+        self.limit = limit
+        self.after = self._valid(decode_cursor(after))
+        self.before = None if self.after else self._valid(decode_cursor(before))
+        self._rows = None
+        self._has_more = False
+
+    def _valid(self, values):
+        """Return cursor values if they fit our keys, else None.
+
+        Each value must be of its key column's Python type (eg, str for a
+        name, int for an id), so a doctored cursor reads as no cursor
+        rather than failing in the database.
+        """
+
+        if values is None or len(values) != len(self.keys):
+            return None
+        if not all(map(_fits, self.keys, values)):
+            return None
+        return values
+
+    def page_query(self):
+        """Return the query for the rows of this page, plus one to tell if
+        there are more (in reverse order for a `before` page).
+        """
+
+        query = self.query
+        position = tuple_(*self.keys)
+
+        if self.before:
+            query = query.filter(position < tuple_(*self.before))
+            query = query.order_by(*[key.desc() for key in self.keys])
+        else:
+            if self.after:
+                query = query.filter(position > tuple_(*self.after))
+            query = query.order_by(*self.keys)
+
+        return query.limit(self.limit + 1)
+
+    def _fetch(self):
+        """Run the query for this page (once)."""
+
+        if self._rows is not None:
+            return self._rows
+
+        rows = self.page_query().all()
+        self._has_more = len(rows) > self.limit
+        rows = rows[:self.limit]
+
+        if self.before:
+            rows.reverse()
+
+        self._rows = rows
+        return rows
+
+    def __iter__(self):
+        return iter(self._fetch())
+
+    def __len__(self):
+        return len(self._fetch())
+
+    def cursor_for(self, row):
+        """Return the cursor for this row's position."""
+
+        return encode_cursor(getattr(row, key.key) for key in self.keys)
+
+    @property
+    def has_next(self):
+        self._fetch()
+        return bool(self.before) or self._has_more
+
+    @property
+    def has_prev(self):
+        self._fetch()
+        return bool(self.after) or (bool(self.before) and self._has_more)
+
+    @property
+    def next_cursor(self):
+        """Cursor for the page after this one, or None."""
+
+        rows = self._fetch()
+        if not rows or not self.has_next:
+            return None
+        return self.cursor_for(rows[-1])
+
+    @property
+    def prev_cursor(self):
+        """Cursor for the page before this one, or None."""
+
+        rows = self._fetch()
+        if not rows or not self.has_prev:
+            return None
+        return self.cursor_for(rows[0])
+
+
+class OffsetPage:
+    """One numbered page of an already-ordered `query`.
+
+    For orderings a cursor can't follow, like search rank. Fetches one
+    extra row to tell whether there is a next page, rather than counting.
+    """
+
+    def __init__(self, query, page, limit):
+        self.query = query
+        self.page = max(page, 1)
+        self.limit = limit
+        self._rows = None
+        self._has_more = False
+
+    @classmethod
+    def from_rows(cls, rows, page, limit, has_more):
+        """Make a page from rows already fetched (eg, from a cache)."""
+
+        instance = cls(None, page, limit)
+        instance._rows = list(rows)
+        instance._has_more = has_more
+        return instance
+
+    @property
+    def has_more(self):
+        """Are there rows after this page?"""
+
+        self._fetch()
+        return self._has_more
+
+    def _fetch(self):
+        """Run the query for this page (once)."""
+
+        if self._rows is not None:
+            return self._rows
+
+        offset = (self.page - 1) * self.limit
+        rows = self.query.offset(offset).limit(self.limit + 1).all()
+        self._has_more = len(rows) > self.limit
+        self._rows = rows[:self.limit]
+        return self._rows
+
+    def __iter__(self):
+        return iter(self._fetch())
+
+    def __len__(self):
+        return len(self._fetch())
+
+    @property
+    def next_page(self):
+        """Number of the page after this one, or None."""
+
+        self._fetch()
+        return self.page + 1 if self._has_more else None
+
+    @property
+    def prev_page(self):
+        """Number of the page before this one, or None."""
+
+        return self.page - 1 if self.page > 1 else None
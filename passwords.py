@@ -0,0 +1,129 @@
+"""Password hashing for Flask Cafe.
+
+bcrypt is slow on purpose, so hashes are worked out in a pool of worker
+processes rather than on the thread handling the request.
+"""
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+
+class PasswordHasherBusy(Exception):
+    """Too many passwords are already waiting to be hashed."""
+
+
+def hash_password(password, rounds):
+    """Return the bcrypt hash of `password` at cost `rounds`, as text."""
+
+    salt = bcrypt.gensalt(rounds)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt hash `hashed`?"""
+
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def hash_rounds(hashed):
+    """Return the cost a bcrypt hash was made with (eg, 12 for $2b$12$...)."""
+
+    return int(hashed.split('$')[2])
+
+
+class PasswordHasher:
+    """Hashes and checks passwords, in up to `workers` processes.
+
+    With `workers` of 0, work runs on the calling thread. Either way, at
+    most `max_pending` hashes can be running or waiting at once; past that
+    PasswordHasherBusy is raised so the caller can turn requests away
+    instead of tying up every worker.
+
+    Configure from an app with init_app, using BCRYPT_LOG_ROUNDS,
+    PASSWORD_HASH_WORKERS and PASSWORD_HASH_MAX_PENDING.
+    """
+
+    def __init__(self, rounds=12, workers=0, max_pending=32):
+        self.configure(rounds, workers, max_pending)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def configure(self, rounds, workers, max_pending):
+        """Set the cost, number of worker processes and queue size."""
+
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._dummy_hash = None
+
+    def init_app(self, app):
+        """Configure from this app's config."""
+
+        self.configure(
+            rounds=app.config.get('BCRYPT_LOG_ROUNDS', 12),
+            workers=app.config.get('PASSWORD_HASH_WORKERS', 0),
+            max_pending=app.config.get('PASSWORD_HASH_MAX_PENDING', 32),
+        )
+
+    def _get_executor(self):
+        # started on first use, so each web server process gets its own;
+        # spawned (not forked) so workers don't inherit db connections
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+            return self._executor
+
+    def _run(self, fn, *args):
+        """Run fn(*args) in the pool (or inline), waiting for the result."""
+
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+
+        try:
+            if not self.workers:
+                return fn(*args)
+            return self._get_executor().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        return self._run(hash_password, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match `hashed`?"""
+
+        return self._run(check_password, hashed, password)
+
+    def check_dummy(self, password):
+        """Spend the same work as `check`, for a user that doesn't exist,
+        so response times don't reveal which usernames are real. Always
+        returns False.
+        """
+
+        if self._dummy_hash is None:
+            self._dummy_hash = self.hash("not anyone's password")
+
+        self.check(self._dummy_hash, password)
+        return False
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than we use now?"""
+
+        return hash_rounds(hashed) != self.rounds
+
+    def shutdown(self):
+        """Stop the worker processes, if started."""
+
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
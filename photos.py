@@ -0,0 +1,76 @@
+import hashlib
+import os
+
+from images import check_public_url, download_image, make_derivatives
+
+PHOTOS_DIR = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)), "static", "photos")
+
+# seconds to wait for the photo's host to connect / send the image
+PHOTO_TIMEOUT = (5, 30)
+
+# photos bigger than this aren't saved
+PHOTO_MAX_BYTES = 10 * 1024 * 1024
+
+# hosts fetched from even though they have private addresses, as for the
+# image proxy; others on loopback, private or link-local networks aren't
+PHOTO_ALLOWED_HOSTS = {
+    host for host in os.environ.get('IMAGE_PROXY_ALLOWED_HOSTS', '').split(',')
+    if host}
+
+# widths of the smaller copies saved of each photo (see images.py); cards
+# show photos up to about 350 pixels wide, the detail page up to 300
+PHOTO_WIDTHS = (320, 640, 960)
+
+
+def is_remote(url):
+    """Is this image URL on another host (rather than one of our files)?"""
+
+    return url.startswith(("http://", "https://"))
+
+
+def get_photo_key(url):
+    """Return the key for the saved copy of the photo at this URL."""
+
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def get_photo_path(key):
+    """Return the path of the saved photo with this key."""
+
+    return os.path.join(PHOTOS_DIR, f"{key}.jpg")
+
+
+def save_photo(url, force=False):
+    """Get the photo at `url` and save it in the static/photos directory of
+    this app, named by its key, with its derivatives. Returns the key.
+
+    If the photo is already saved, it's reused rather than fetched again,
+    unless `force` is true.
+
+    Raises requests.RequestException if the photo can't be fetched,
+    images.ImageHostRefused if its host (or one it redirects to) is on a
+    private network, images.ImageTooLarge if it's over PHOTO_MAX_BYTES,
+    or PIL.UnidentifiedImageError if it isn't an image.
+    """
+
+    key = get_photo_key(url)
+    path = get_photo_path(key)
+
+    if os.path.exists(path) and not force:
+        make_derivatives(path, PHOTO_WIDTHS, missing_only=True)
+        return key
+
+    os.makedirs(PHOTOS_DIR, exist_ok=True)
+
+    download_image(
+        url, path, PHOTO_TIMEOUT, PHOTO_MAX_BYTES,
+        check_url=lambda url: check_public_url(url, PHOTO_ALLOWED_HOSTS))
+
+    try:
+        make_derivatives(path, PHOTO_WIDTHS)
+    except Exception:
+        os.remove(path)
+        raise
+
+    return key
@@ -0,0 +1,103 @@
+"""Cafe search for Flask Cafe."""
+
+from sqlalchemy import func, or_, union
+
+from models import db, Cafe, Speciality
+from pagination import OffsetPage
+
+# Postgres text search configuration used to build and query the vectors
+SEARCH_CONFIG = 'english'
+
+
+def fulltext_search(term):
+    """Query for cafes matching `term` in their name, specialities, city or
+    description, best match first.
+
+    `term` uses web search syntax: quoted phrases, "or" and "-word".
+    """
+
+    tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, term)
+    rank = func.ts_rank(Cafe.search_vector, tsquery)
+
+    return (
+        Cafe.query
+        .filter(Cafe.search_vector.op('@@')(tsquery))
+        .order_by(rank.desc(), Cafe.id)
+    )
+
+
+def contains_pattern(term):
+    """Return an ILIKE pattern matching `term` anywhere, taken literally."""
+
+    escaped = (
+        term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+    return f"%{escaped}%"
+
+
+def trigram_search(term):
+    """Query for cafes whose name or a speciality contains `term`, or is
+    close to it (so "perch cofee" finds Perch Coffee), closest name first.
+
+    Needs the pg_trgm extension; both kinds of match use its GIN indexes.
+    """
+
+    pattern = contains_pattern(term)
+
+    def matches(column):
+        return or_(column.ilike(pattern, escape="\\"), column.op('%')(term))
+
+    cafe_ids = union(
+        db.select(Cafe.id).where(matches(Cafe.name)),
+        db.select(Speciality.cafe_id).where(matches(Speciality.name)),
+    )
+
+    return (
+        Cafe.query
+        .filter(Cafe.id.in_(cafe_ids))
+        .order_by(func.similarity(Cafe.name, term).desc(), Cafe.name, Cafe.id)
+    )
+
+
+SEARCH_MODES = {
+    'fulltext': fulltext_search,
+    'trigram': trigram_search,
+}
+
+
+def search_cafes(term, mode='fulltext'):
+    """Query for cafes matching `term`, using the named search mode."""
+
+    return SEARCH_MODES[mode](term)
+
+
+def normalize_query(term):
+    """Return `term` case-folded with runs of whitespace collapsed, so
+    "Perch  Coffee" and "perch coffee" are the same search.
+    """
+
+    return " ".join(term.casefold().split())
+
+
+def cached_search(cache, term, mode, page, limit):
+    """Return an OffsetPage of cafes matching `term`.
+
+    The ids on each page of results are kept in `cache` (an LRUCache),
+    keyed by the normalized term, mode and page; the cafes themselves are
+    loaded fresh. Clear the cache when cafes are added, edited or deleted.
+    """
+
+    term = normalize_query(term)
+    key = (mode, term, page, limit)
+    cached = cache.get(key)
+
+    if cached is None:
+        ids_page = OffsetPage(
+            search_cafes(term, mode).with_entities(Cafe.id), page, limit)
+        cached = ([cafe_id for (cafe_id,) in ids_page], ids_page.has_more)
+        cache.set(key, cached)
+
+    ids, has_more = cached
+    cafes = {cafe.id: cafe for cafe in Cafe.query.filter(Cafe.id.in_(ids))}
+    rows = [cafes[cafe_id] for cafe_id in ids if cafe_id in cafes]
+
+    return OffsetPage.from_rows(rows, page, limit, has_more)
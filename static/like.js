@@ -1,30 +1,47 @@
 "use strict";
 
-const $likeButton = $("#like-button");
-const $unlikeButton = $("#unlike-button");
-const $likeForm = $("#like-form");
-const $unlikeForm = ($("#unlike-form"));
-const cafeId = $('#unlike-button').data('id');
-
-/**The function is for the initial page. If the user liked the cafe before,
- * it only shows the unlike button. It shows the like button otherwise.
+/** Like and unlike buttons, for one cafe (the detail page) or many (cafe
+ * cards). Each cafe's pair of buttons is wrapped in an element with the
+ * class "like-buttons" and the cafe's id in data-cafe-id.
  */
-async function displayButton() {
-  let response = await fetch(`/api/likes?cafe_id=${cafeId}`, {
+
+const $likeButtons = $(".like-buttons");
+
+
+/** Shows the unlike button if the cafe is liked, the like button if not. */
+
+function showLiked($buttons, liked) {
+  $buttons.find(".like-button").toggle(!liked);
+  $buttons.find(".unlike-button").toggle(liked);
+}
+
+
+/**The function is for the initial page. Buttons rendered with data-liked
+ * already show the right one; for any others, it asks in one request which
+ * of their cafes the user has liked, then shows the unlike button for those
+ * and the like button for the rest.
+ */
+
+async function displayButtons() {
+  const $unknown = $likeButtons.filter(
+    (i, el) => $(el).data("liked") === undefined);
+  if ($unknown.length === 0) return;
+
+  const cafeIds = $unknown.map((i, el) => $(el).data("cafe-id")).get();
+
+  const response = await fetch(`/api/likes?cafe_ids=${cafeIds.join(",")}`, {
     method: "GET",
     headers: {
       "content-type": "application/json",
     }
-  })
+  });
 
   const result = await response.json();
-  if (result.likes) {
-    $likeButton.hide();
-    $unlikeButton.show();
-  } else {
-    $unlikeButton.hide();
-    $likeButton.show();
-  }
+  if (!result.likes) return;
+
+  $unknown.each(function () {
+    showLiked($(this), result.likes[$(this).data("cafe-id")]);
+  });
 }
 
 
@@ -34,21 +51,22 @@ async function displayButton() {
 
 async function addLike(evt) {
   evt.preventDefault();
+  const $buttons = $(evt.target).closest(".like-buttons");
+
   const response = await fetch("/api/like", {
     method: "POST",
     body: JSON.stringify({
-      cafe_id: cafeId,
+      cafe_id: $buttons.data("cafe-id"),
     }),
     headers: {
       "content-type": "application/json",
     }
-  })
+  });
 
   const result = await response.json();
 
   if (result.liked) {
-    $likeButton.hide();
-    $unlikeButton.show();
+    showLiked($buttons, true);
   }
 }
 
@@ -58,24 +76,25 @@ async function addLike(evt) {
 
 async function removeLike(evt) {
   evt.preventDefault();
+  const $buttons = $(evt.target).closest(".like-buttons");
 
   const response = await fetch("/api/unlike", {
     method: "POST",
     body: JSON.stringify({
-      cafe_id: cafeId,
+      cafe_id: $buttons.data("cafe-id"),
     }),
     headers: {
       "content-type": "application/json",
     }
-  })
+  });
 
   const result = await response.json();
 
-  if (!result.liked) {
-    $unlikeButton.hide();
-    $likeButton.show();
+  if (result.unliked) {
+    showLiked($buttons, false);
   }
 }
-$(document).ready(displayButton);
-$unlikeForm.on("submit", removeLike);
-$likeForm.on("submit", addLike);
\ No newline at end of file
+
+$(document).ready(displayButtons);
+$likeButtons.on("click", ".like-button", addLike);
+$likeButtons.on("click", ".unlike-button", removeLike);
@@ -0,0 +1,233 @@
+"""In-memory typeahead suggestions for Flask Cafe.
+
+Cafe and speciality names are kept in sorted arrays in each process, so
+suggestions for a prefix are a binary search away and never touch the
+database.
+"""
+
+import threading
+import time
+from bisect import bisect_left, insort
+
+from models import db, Cafe, Speciality
+
+
+class PrefixIndex:
+    """Sorted index of names, searchable by the prefix of any word.
+
+    "Perch Coffee" is found by "per", "perch c" and "cof". The same name
+    can be added more than once (eg, two cafes called "Starbucks"); it
+    stays in the index until it has been removed as many times.
+    """
+
+    def __init__(self, names=()):
+        self._counts = {}
+        for name in names:
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+        # sorted once, rather than an insort per name
+        self._entries = [
+            (key, name) for name in self._counts for key in self._keys(name)]
+        self._entries.sort()
+
+    @staticmethod
+    def _keys(name):
+        """Return the lowercased name starting at each of its words."""
+
+        words = name.lower().split()
+        return [" ".join(words[i:]) for i in range(len(words))]
+
+    def add(self, name):
+        """Add a name to the index."""
+
+        count = self._counts.get(name, 0)
+        self._counts[name] = count + 1
+
+        if count == 0:
+            for key in self._keys(name):
+                insort(self._entries, (key, name))
+
+    def remove(self, name):
+        """Remove one occurrence of a name from the index."""
+
+        count = self._counts.get(name, 0)
+        if count == 0:
+            return
+
+        if count > 1:
+            self._counts[name] = count - 1
+            return
+
+        del self._counts[name]
+        for key in self._keys(name):
+            i = bisect_left(self._entries, (key, name))
+            if i < len(self._entries) and self._entries[i] == (key, name):
+                del self._entries[i]
+
+    def search(self, prefix, limit):
+        """Return up to `limit` names with a word starting with `prefix`,
+        in alphabetical order of the matching text.
+        """
+
+        prefix = " ".join(prefix.lower().split())
+        if not prefix:
+            return []
+
+        names = []
+        i = bisect_left(self._entries, (prefix,))
+
+        while i < len(self._entries) and len(names) < limit:
+            key, name = self._entries[i]
+            if not key.startswith(prefix):
+                break
+            if name not in names:
+                names.append(name)
+            i += 1
+
+        return names
+
+
+class Suggestions:
+    """Prefix indexes of cafe and speciality names for one process.
+
+    Once init_app has run, a background thread builds them when the app
+    serves its first request, then rebuilds them every `max_age` seconds
+    to pick up writes handled by other processes, so suggestions never
+    wait on the database. (Not at import, as CLI commands like `flask
+    cafes import` and seed.py import the app too.) Without it, or until
+    the first build is done, they're built on first use; only one thread
+    builds at a time.
+
+    Writes in this process should call `add_cafe`/`remove_cafe` so
+    suggestions are current right away. Those made during a rebuild are
+    applied to the new indexes too, before they replace the old ones.
+    """
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self.app = None
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._cafes = None
+        self._specialities = None
+        self._changes = None
+        self._refresher = None
+
+    def init_app(self, app):
+        """Keep the indexes for this app built in the background,
+        rebuilding them every SUGGEST_MAX_AGE seconds (0 to only build on
+        first use).
+        """
+
+        self.app = app
+        self.max_age = app.config.get('SUGGEST_MAX_AGE', self.max_age)
+
+        if self.max_age > 0:
+            app.before_request(self._start_refresher)
+
+    def _start_refresher(self):
+        if self._refresher is not None:
+            return
+
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(
+                target=self._refresh, name="suggestions", daemon=True)
+            self._refresher.start()
+
+    def _refresh(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    with self._build_lock:
+                        self.rebuild()
+                except Exception:
+                    self.app.logger.exception("Rebuilding suggestions failed")
+
+            time.sleep(self.max_age)
+
+    def rebuild(self):
+        """Reload all names from the database."""
+
+        # writes made while we read are applied to the new indexes too;
+        # one the read already saw is then counted twice until next time
+        with self._lock:
+            self._changes = []
+
+        try:
+            cafe_names = [name for (name,) in db.session.query(Cafe.name)]
+            speciality_names = [
+                name for (name,) in db.session.query(Speciality.name)]
+
+            cafes = PrefixIndex(cafe_names)
+            specialities = PrefixIndex(speciality_names)
+
+            with self._lock:
+                for change in self._changes:
+                    self._apply(cafes, specialities, *change)
+                self._cafes = cafes
+                self._specialities = specialities
+        finally:
+            with self._lock:
+                self._changes = None
+
+    def reset(self):
+        """Drop the indexes; they are rebuilt on next use."""
+
+        with self._lock:
+            self._cafes = None
+            self._specialities = None
+
+    def _ensure_built(self):
+        if self._cafes is not None:
+            return
+
+        with self._build_lock:
+            if self._cafes is None:
+                self.rebuild()
+
+    def suggest(self, prefix, limit=10):
+        """Return {"cafes": [...], "specialities": [...]} of names for
+        this prefix, up to `limit` of each.
+        """
+
+        self._ensure_built()
+
+        with self._lock:
+            return {
+                "cafes": self._cafes.search(prefix, limit),
+                "specialities": self._specialities.search(prefix, limit),
+            }
+
+    @staticmethod
+    def _apply(cafes, specialities, added, name, speciality_names):
+        """Add (or remove) a cafe's names in these indexes."""
+
+        for index, names in [(cafes, [name]), (specialities, speciality_names)]:
+            for each in names:
+                if added:
+                    index.add(each)
+                else:
+                    index.remove(each)
+
+    def _record(self, added, name, speciality_names):
+        with self._lock:
+            change = (added, name, list(speciality_names))
+            if self._changes is not None:
+                self._changes.append(change)
+            if self._cafes is not None:
+                self._apply(self._cafes, self._specialities, *change)
+
+    def add_cafe(self, name, speciality_names=()):
+        """Record a cafe (and its specialities) added to the database."""
+
+        self._record(True, name, speciality_names)
+
+    def remove_cafe(self, name, speciality_names=()):
+        """Record a cafe (and its specialities) removed from the database."""
+
+        self._record(False, name, speciality_names)
+
+
+suggestions = Suggestions()
@@ -0,0 +1,43 @@
+"""Background tasks for Flask Cafe."""
+
+from jobs import ThreadPoolJobQueue
+from models import db, Cafe
+
+map_jobs = ThreadPoolJobQueue()
+
+
+def map_failed(cafe_id):
+    """Mark this cafe's map as failed, after the last retry."""
+
+    cafe = db.session.get(Cafe, cafe_id)
+    if cafe:
+        cafe.map_status = Cafe.MAP_FAILED
+        db.session.commit()
+
+
+@map_jobs.task(on_failure=map_failed)
+def generate_map(cafe_id):
+    """Save the map image for this cafe (fetching it only if no cafe at
+    this address has one yet), then mark it ready.
+    """
+
+    cafe = db.session.get(Cafe, cafe_id)
+    if not cafe:
+        return
+
+    cafe.save_map()
+    db.session.commit()
+
+
+@map_jobs.task
+def cache_photo(cafe_id):
+    """Save a copy of this cafe's photo, with smaller copies; until this
+    works, pages show the photo from its own host.
+    """
+
+    cafe = db.session.get(Cafe, cafe_id)
+    if not cafe:
+        return
+
+    cafe.save_photo()
+    db.session.commit()
@@ -1,18 +1,47 @@
 """Tests for Flask Cafe."""
 
 
+import io
+import json
 import os
 import re
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 os.environ["DATABASE_URL"] = "postgresql:///flaskcafe_test"
 os.environ["FLASK_DEBUG"] = "0"
+os.environ["JOB_BACKOFF"] = "0.01"
+# suggestions are built on first use, not by a background thread
+os.environ["SUGGEST_MAX_AGE"] = "0"
+# the fake photo host below is on 127.0.0.1
+os.environ["IMAGE_PROXY_ALLOWED_HOSTS"] = "127.0.0.1"
 
 import re
-from unittest import TestCase
+from contextlib import contextmanager
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
 
+import mapping
+import photos
+from PIL import Image
 from flask import session
-from app import app, CURR_USER_KEY
-from models import db, Cafe, City, connect_db, User, Like
+from sqlalchemy import event, func, select, text
+from app import app, CURR_USER_KEY, search_cache, user_cache, image_proxy
+from app import proxied_image_url, fragment_cache
+from models import db, Cafe, City, connect_db, User, Like, Speciality
+from models import password_hasher
+from commands import IMPORT_LOCK_ID, save_maps
+from pagination import encode_cursor
+from passwords import hash_password, hash_rounds
+from caching import LRUCache
+from likebuffer import LikeBuffer
+from search import fulltext_search, trigram_search
+from suggest import PrefixIndex, Suggestions, suggestions
+from tasks import map_jobs
+from images import get_derivative_path, make_derivatives, remove_derivatives
+from images import ImageHostRefused
 
 # Make Flask errors be real errors, rather than HTML pages with error info
 app.config['TESTING'] = True
@@ -23,6 +52,93 @@ app.config['WTF_CSRF_ENABLED'] = False
 db.drop_all()
 db.create_all()
 
+HAS_PG_TRGM = db.session.execute(text(
+    "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+
+
+#######################################
+# fake MapQuest (and photo host), so jobs run without the network
+
+
+def make_jpeg(width, height):
+    """Return the bytes of a JPEG of this size."""
+
+    f = io.BytesIO()
+    Image.new("RGB", (width, height), "green").save(f, "JPEG")
+    return f.getvalue()
+
+
+FAKE_MAP = make_jpeg(800, 800)
+FAKE_PHOTO = make_jpeg(1200, 900)
+
+
+class FakeMapQuestHandler(BaseHTTPRequestHandler):
+    """Serves FAKE_PHOTO for paths under /photos/ and FAKE_MAP for every
+    other request, after failing the next `failures` of them with a 500
+    and answering the next `garbled` with a body that isn't an image.
+
+    Paths under /slow/ wait a second first; paths under /text/ get text;
+    /redirect/<url> redirects to <url>.
+    """
+
+    failures = 0
+    garbled = 0
+    requests = []
+
+    def do_GET(self):
+        FakeMapQuestHandler.requests.append(self.path)
+
+        if FakeMapQuestHandler.failures:
+            FakeMapQuestHandler.failures -= 1
+            self.send_response(500)
+            self.end_headers()
+            return
+
+        if FakeMapQuestHandler.garbled:
+            FakeMapQuestHandler.garbled -= 1
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.end_headers()
+            self.wfile.write(b"not an image")
+            return
+
+        if self.path.startswith("/redirect/"):
+            self.send_response(302)
+            self.send_header("Location", self.path[len("/redirect/"):])
+            self.end_headers()
+            return
+
+        if self.path.startswith("/slow/"):
+            time.sleep(1)
+
+        if self.path.startswith("/text/"):
+            image = b"not an image"
+        elif self.path.startswith(("/photos/", "/slow/")):
+            image = FAKE_PHOTO
+        else:
+            image = FAKE_MAP
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(image)))
+        self.end_headers()
+        self.wfile.write(image)
+
+    def log_message(self, format, *args):
+        pass
+
+
+fake_mapquest = ThreadingHTTPServer(("127.0.0.1", 0), FakeMapQuestHandler)
+threading.Thread(target=fake_mapquest.serve_forever, daemon=True).start()
+
+mapping.MAPQUEST_URL = (
+    f"http://127.0.0.1:{fake_mapquest.server_port}/staticmap/v5/map")
+mapping.MAPS_DIR = tempfile.mkdtemp()
+photos.PHOTOS_DIR = tempfile.mkdtemp()
+
+FAKE_HOST = f"http://127.0.0.1:{fake_mapquest.server_port}"
+FAKE_PHOTO_URL = f"{FAKE_HOST}/photos/cafe.jpg"
+
 
 #######################################
 # helper functions for tests
@@ -36,6 +152,28 @@ def debug_html(response, label="DEBUGGING"):  # pragma: no cover
     print("\n\n")
 
 
+@contextmanager
+def count_queries():
+    """Collects the SQL statements run inside the block, so a test can
+    check that a route stays within its query budget:
+
+        with count_queries() as queries:
+            client.get("/cafes")
+        self.assertLessEqual(len(queries), 2)
+    """
+
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        queries.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
 def login_for_test(client, user_id):
     """Log in this user."""
 
@@ -59,7 +197,7 @@ CAFE_DATA = dict(
     url="http://testcafe.com/",
     address="500 Sansome St",
     city_code="sf",
-    image_url="http://testcafeimg.com/"
+    image_url=FAKE_PHOTO_URL,
 )
 
 CAFE_DATA_EDIT = dict(
@@ -68,7 +206,7 @@ CAFE_DATA_EDIT = dict(
     url="http://new-image.com/",
     address="500 Sansome St",
     city_code="sf",
-    image_url="http://new-image.com/"
+    image_url=FAKE_PHOTO_URL,
 )
 
 TEST_USER_DATA = dict(
@@ -190,6 +328,18 @@ class CafeModelTestCase(TestCase):
     def test_get_city_state(self):
         self.assertEqual(self.cafe.get_city_state(), "San Francisco, CA")
 
+    def test_is_liked_by(self):
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+        self.assertFalse(self.cafe.is_liked_by(user))
+
+        db.session.add(Like(user_id=user.id, cafe_id=self.cafe.id))
+        db.session.commit()
+        self.assertTrue(self.cafe.is_liked_by(user))
+
+        db.session.delete(user)
+        db.session.commit()
+
 
 class CafeViewsTestCase(TestCase):
     """Tests for views on cafes."""
@@ -212,112 +362,1433 @@ class CafeViewsTestCase(TestCase):
         db.session.commit()
 
         self.cafe_id = cafe.id
-        self.admin_id = admin.id
+        self.admin_id = admin.id
+        search_cache.clear()
+
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_list(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get("/cafes")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Test Cafe", resp.data)
+
+    def test_list_by_tag(self):
+        cafes = [Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}) for i in range(3)]
+        db.session.add_all(cafes)
+        db.session.commit()
+        Speciality.set_for_cafe(cafes[0].id, ["Espresso", "wifi"])
+        Speciality.set_for_cafe(cafes[1].id, ["espresso"])
+        Speciality.set_for_cafe(cafes[2].id, ["wifi", "pour over"])
+        db.session.commit()
+
+        def listed(query):
+            html = client.get(f"/cafes?{query}").get_data(as_text=True)
+            return [i for i, cafe in enumerate(cafes)
+                    if f'href="/cafes/{cafe.id}"' in html]
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            self.assertEqual(listed("tag=espresso"), [0, 1])
+            self.assertEqual(listed("tag=espresso&tag=WiFi"), [0])
+            self.assertEqual(listed("tag=espresso&tag=wifi&match=any"), [0, 1, 2])
+            self.assertEqual(listed("tag=latte"), [])
+
+            resp = client.get("/cafes?tag=espresso&tag=wifi&match=any&per_page=1")
+            self.assertIn(
+                "tag=espresso&amp;tag=wifi&amp;match=any",
+                resp.get_data(as_text=True))
+
+    def test_fragment_cache(self):
+        fragment_cache.clear()
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            client.get("/cafes").get_data()
+            hits = fragment_cache.hits
+
+            resp = client.get("/cafes")
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertEqual(fragment_cache.hits, hits + 1)
+
+            # a change made anywhere gives the cafe a new updated_at
+            cafe = db.session.get(Cafe, self.cafe_id)
+            cafe.description = "Changed elsewhere"
+            db.session.commit()
+
+            resp = client.get("/cafes")
+            self.assertIn(b"Changed elsewhere", resp.data)
+
+    def test_fragment_cache_not_per_user(self):
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+        db.session.add(Like(user_id=user.id, cafe_id=self.cafe_id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, user.id)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(b'data-liked="true"', resp.data)
+            self.assertIn(b"1 likes", resp.data)
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(b'data-liked="false"', resp.data)
+            self.assertIn(b"Edit Cafe", resp.data)
+
+    def test_updated_at(self):
+        cafe = db.session.get(Cafe, self.cafe_id)
+        first = cafe.updated_at
+
+        # likes change the like count, but nothing cached
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+        db.session.add(Like(user_id=user.id, cafe_id=self.cafe_id))
+        db.session.commit()
+        self.assertEqual(cafe.like_count, 1)
+        self.assertEqual(cafe.updated_at, first)
+
+        Speciality.set_for_cafe(self.cafe_id, ["Espresso"])
+        db.session.commit()
+        second = cafe.updated_at
+        self.assertGreater(second, first)
+
+        Speciality.set_for_cafe(self.cafe_id, ["espresso"])
+        db.session.commit()
+        self.assertGreater(cafe.updated_at, second)
+
+    def test_list_query_budget(self):
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        for i in range(5):
+            db.session.add(Cafe(**{**CAFE_DATA, "city_code": "oak"}))
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            with count_queries() as queries:
+                resp = client.get("/cafes")
+            self.assertIn(b"Oakland, CA", resp.data)
+            # current user + one page of cafes with their cities
+            self.assertLessEqual(len(queries), 2)
+
+    def test_search_query_budget(self):
+        for i in range(5):
+            cafe = Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"})
+            cafe.specialities.append(Speciality(name="espresso"))
+            db.session.add(cafe)
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            with count_queries() as queries:
+                resp = client.get("/search?q=espresso")
+            self.assertIn(b"Cafe 4", resp.data)
+            # user, matches, cafes and the user's likes
+            self.assertLessEqual(len(queries), 4)
+
+    def test_search_ranked(self):
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.add(Cafe(**{
+            **CAFE_DATA,
+            "name": "Perch Coffee",
+            "description": "Coffee and cardamom lattes.",
+            "city_code": "oak",
+        }))
+        described = Cafe(**{**CAFE_DATA, "name": "Bernie's"})
+        described.description = "Some say the coffee is fine."
+        db.session.add(described)
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get("/search?q=coffee")
+            html = resp.get_data(as_text=True)
+            # name matches outrank description matches
+            self.assertLess(html.index("Perch Coffee"), html.index("Bernie"))
+            self.assertEqual(html.count("Perch Coffee"), 1)
+            self.assertNotIn("Test Cafe", html)
+
+            resp = client.get("/search?q=oakland")
+            self.assertIn(b"Perch Coffee", resp.data)
+
+            resp = client.get("/search?q=coffee&per_page=1")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Perch Coffee", html)
+            self.assertNotIn("Bernie", html)
+            self.assertIn("page=2", html)
+
+    def test_search_speciality_changes(self):
+        cafe = Cafe.query.get(self.cafe_id)
+        cafe.specialities.append(Speciality(name="pour over"))
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get("/search?q=pour over")
+            self.assertIn(b"Test Cafe", resp.data)
+
+            Speciality.query.filter_by(cafe_id=self.cafe_id).delete()
+            db.session.commit()
+            # writes outside the cafe routes don't invalidate cached searches
+            search_cache.clear()
+
+            resp = client.get("/search?q=pour over")
+            self.assertIn(b"no cafes found", resp.data)
+
+    def test_search_cache(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            stats = search_cache.stats()
+
+            resp = client.get("/search?q=Test  Cafe")
+            self.assertIn(b"Test Cafe", resp.data)
+            resp = client.get("/search?q=test cafe")
+            self.assertIn(b"Test Cafe", resp.data)
+
+            self.assertEqual(search_cache.hits, stats["hits"] + 1)
+            self.assertEqual(search_cache.misses, stats["misses"] + 1)
+
+            client.post(f"/cafes/{self.cafe_id}/delete")
+            resp = client.get("/search?q=test cafe")
+            self.assertIn(b"no cafes found", resp.data)
+
+            resp = client.get("/api/cache-stats")
+            self.assertEqual(resp.json["search"]["size"], 1)
+
+    def test_search_trigram_mode(self):
+        if not HAS_PG_TRGM:
+            self.skipTest("pg_trgm extension not available")
+
+        db.session.add(Cafe(**{**CAFE_DATA, "name": "Perch Coffee"}))
+        db.session.commit()
+
+        app.config['SEARCH_MODE'] = 'trigram'
+        try:
+            with app.test_client() as client:
+                login_for_test(client, self.admin_id)
+                resp = client.get("/search?q=perch cofee")
+                self.assertIn(b"Perch Coffee", resp.data)
+
+                resp = client.get("/search?q=st caf")
+                self.assertIn(b"Test Cafe", resp.data)
+                self.assertNotIn(b"Perch Coffee", resp.data)
+        finally:
+            app.config['SEARCH_MODE'] = 'fulltext'
+
+    def test_list_pagination(self):
+        for name in ["Alpha Cafe", "Beta Cafe"]:
+            db.session.add(Cafe(**{**CAFE_DATA, "name": name}))
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get("/cafes?per_page=2")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Alpha Cafe", html)
+            self.assertIn("Beta Cafe", html)
+            self.assertNotIn("Test Cafe", html)
+            self.assertNotIn("Previous", html)
+
+            next_url = re.search(r'href="([^"]*after=[^"]*)"', html).group(1)
+            resp = client.get(next_url.replace("&amp;", "&"))
+            html = resp.get_data(as_text=True)
+            self.assertIn("Test Cafe", html)
+            self.assertNotIn("Alpha Cafe", html)
+            self.assertNotIn("Next", html)
+
+            prev_url = re.search(r'href="([^"]*before=[^"]*)"', html).group(1)
+            resp = client.get(prev_url.replace("&amp;", "&"))
+            html = resp.get_data(as_text=True)
+            self.assertIn("Alpha Cafe", html)
+            self.assertIn("Beta Cafe", html)
+            self.assertNotIn("Test Cafe", html)
+
+    def test_list_bad_cursor(self):
+        for values in [["Alpha", "1"], [1, 2], [{"a": 1}, 1], ["Alpha", True],
+                       ["Al\x00pha", 1]]:
+            with app.test_client() as client:
+                login_for_test(client, self.admin_id)
+                resp = client.get(
+                    f"/cafes?after={encode_cursor(values)}")
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("Test Cafe", resp.get_data(as_text=True))
+
+    def test_detail(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertIn(b'testcafe.com', resp.data)
+
+
+class CafeAdminViewsTestCase(TestCase):
+    """Tests for add/edit views on cafes."""
+
+    def setUp(self):
+        """Before each test, add sample city, users, and cafes"""
+
+        City.query.delete()
+        Cafe.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        admin = User(**ADMIN_USER_DATA)
+        db.session.add(admin)
+
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.admin_id = admin.id
+    def tearDown(self):
+        """After each test, delete the cities."""
+
+        map_jobs.wait()
+        FakeMapQuestHandler.failures = 0
+        FakeMapQuestHandler.garbled = 0
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_add(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get(f"/cafes/add")
+            self.assertIn(b'Add Cafe', resp.data)
+
+            resp = client.post(
+                f"/cafes/add",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b'added', resp.data)
+
+    def test_add_generates_map(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.post(f"/cafes/add", data=CAFE_DATA_EDIT)
+            cafe_id = int(resp.location.rsplit("/", 1)[1])
+
+            map_jobs.wait()
+            cafe = db.session.get(Cafe, cafe_id)
+            db.session.refresh(cafe)
+            self.assertEqual(cafe.map_status, Cafe.MAP_READY)
+
+            with open(mapping.get_map_path(cafe.map_key), "rb") as f:
+                self.assertEqual(f.read(), FAKE_MAP)
+
+            resp = client.get(f"/cafes/{cafe_id}")
+            version = mapping.get_map_version(cafe.map_key)
+            self.assertIn(
+                f"/maps/{cafe.map_key}.jpg?v={version}".encode(), resp.data)
+            self.assertIn(
+                f"/maps/{cafe.map_key}-500.webp?v={version} 500w".encode(),
+                resp.data)
+
+            for width in mapping.MAP_WIDTHS:
+                self.assertTrue(os.path.exists(get_derivative_path(
+                    mapping.get_map_path(cafe.map_key), width, "webp")))
+
+    def test_add_caches_photo(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.post(f"/cafes/add", data=CAFE_DATA_EDIT)
+            cafe_id = int(resp.location.rsplit("/", 1)[1])
+
+            map_jobs.wait()
+            cafe = db.session.get(Cafe, cafe_id)
+            db.session.refresh(cafe)
+            self.assertEqual(cafe.photo_key, photos.get_photo_key(FAKE_PHOTO_URL))
+
+            resp = client.get(f"/cafes/{cafe_id}")
+            self.assertIn(
+                f"/static/photos/{cafe.photo_key}-640.webp 640w".encode(),
+                resp.data)
+            self.assertNotIn(FAKE_PHOTO_URL.encode(), resp.data)
+
+    def test_photo_on_private_host_not_cached(self):
+        local_url = f"http://localhost:{fake_mapquest.server_port}/photos/a.jpg"
+        cafe = db.session.get(Cafe, self.cafe_id)
+        cafe.image_url = local_url
+        db.session.commit()
+
+        FakeMapQuestHandler.requests = []
+        with patch.object(map_jobs, "retries", 0):
+            self.assertFalse(map_jobs.run('cache_photo', self.cafe_id))
+
+        # nor reached by a redirect from an allowed host
+        with self.assertRaises(ImageHostRefused):
+            photos.save_photo(f"{FAKE_HOST}/redirect/{local_url}")
+
+        self.assertEqual(
+            FakeMapQuestHandler.requests, [f"/redirect/{local_url}"])
+        cafe = db.session.get(Cafe, self.cafe_id)
+        db.session.refresh(cafe)
+        self.assertIsNone(cafe.photo_key)
+
+    def test_photo_from_host_until_cached(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            with app.test_request_context():
+                proxied = proxied_image_url(FAKE_PHOTO_URL)
+            self.assertIn(f'src="{proxied}"'.replace("&", "&amp;").encode(), resp.data)
+            self.assertNotIn(b"/static/photos/", resp.data)
+
+    def test_maps_shared_by_location(self):
+        FakeMapQuestHandler.requests = []
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            for name in ["One", "Two"]:
+                client.post(f"/cafes/add", data={**CAFE_DATA_EDIT, "name": name})
+                map_jobs.wait()
+
+        map_requests = [path for path in FakeMapQuestHandler.requests
+                        if path.startswith("/staticmap/")]
+        self.assertEqual(len(map_requests), 1)
+        keys = {cafe.map_key for cafe in Cafe.query.filter(Cafe.name.in_(["One", "Two"]))}
+        self.assertEqual(len(keys), 1)
+
+    def test_edit_keeps_map_if_location_same(self):
+        map_jobs.run('generate_map', self.cafe_id)
+        FakeMapQuestHandler.requests = []
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            client.post(f"/cafes/{self.cafe_id}/edit", data=CAFE_DATA_EDIT)
+            map_jobs.wait()
+
+        self.assertEqual(FakeMapQuestHandler.requests, [])
+        cafe = db.session.get(Cafe, self.cafe_id)
+        db.session.refresh(cafe)
+        self.assertEqual(cafe.map_status, Cafe.MAP_READY)
+
+    def test_jobs_run_inline_without_workers(self):
+        with patch.object(map_jobs, "workers", 0):
+            map_jobs.enqueue('generate_map', self.cafe_id)
+
+        cafe = db.session.get(Cafe, self.cafe_id)
+        db.session.refresh(cafe)
+        self.assertEqual(cafe.map_status, Cafe.MAP_READY)
+
+    def test_map_placeholder_until_ready(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(Cafe.MAP_PLACEHOLDER_URL.encode(), resp.data)
+
+    def test_map_retries_then_fails(self):
+        FakeMapQuestHandler.failures = 2
+        self.assertTrue(map_jobs.run('generate_map', self.cafe_id))
+        self.assertEqual(
+            db.session.get(Cafe, self.cafe_id).map_status, Cafe.MAP_READY)
+
+        # a map that's already saved isn't fetched again
+        cafe = db.session.get(Cafe, self.cafe_id)
+        os.remove(mapping.get_map_path(cafe.map_key))
+
+        FakeMapQuestHandler.failures = map_jobs.retries + 1
+        self.assertFalse(map_jobs.run('generate_map', self.cafe_id))
+        cafe = db.session.get(Cafe, self.cafe_id)
+        db.session.refresh(cafe)
+        self.assertEqual(cafe.map_status, Cafe.MAP_FAILED)
+
+    def test_map_not_an_image_retried(self):
+        # saved by an earlier test, maybe
+        path = mapping.get_map_path(
+            db.session.get(Cafe, self.cafe_id).get_map_key())
+        if os.path.exists(path):
+            os.remove(path)
+
+        FakeMapQuestHandler.garbled = 1
+        with patch.object(map_jobs, "retries", 0):
+            self.assertFalse(map_jobs.run('generate_map', self.cafe_id))
+        self.assertFalse(os.path.exists(path))
+
+        self.assertTrue(map_jobs.run('generate_map', self.cafe_id))
+        cafe = db.session.get(Cafe, self.cafe_id)
+        db.session.refresh(cafe)
+        self.assertEqual(cafe.map_status, Cafe.MAP_READY)
+
+    def test_dynamic_cities_vocab(self):
+        id = self.cafe_id
+
+        # the following is a regular expression for the HTML for the drop-down
+        # menu pattern we want to check for
+        choices_pattern = re.compile(
+            r'<select [^>]*name="city_code"[^>]*><option [^>]*value="sf">' +
+            r'San Francisco</option></select>')
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get(f"/cafes/add")
+            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+
+            resp = client.get(f"/cafes/{id}/edit")
+            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+
+    def test_edit(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
+            self.assertIn(b'Edit Test Cafe', resp.data)
+
+            resp = client.post(
+                f"/cafes/{id}/edit",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b'edited', resp.data)
+
+    def test_delete(self):
+        users = [
+            User.register(**{**TEST_USER_DATA, "username": f"u{i}",
+                             "email": f"u{i}@test.com"})
+            for i in range(5)
+        ]
+        db.session.add(Speciality(name="pour over", cafe_id=self.cafe_id))
+        db.session.commit()
+        db.session.add_all(
+            [Like(user_id=user.id, cafe_id=self.cafe_id) for user in users])
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            with count_queries() as queries:
+                resp = client.post(
+                    f"/cafes/{self.cafe_id}/delete", follow_redirects=False)
+            self.assertEqual(resp.status_code, 302)
+            # admin, specialities, the delete itself; none per like
+            self.assertLessEqual(len(queries), 3)
+
+        self.assertIsNone(db.session.get(Cafe, self.cafe_id))
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(Speciality.query.count(), 0)
+        self.assertEqual(User.query.count(), 6)
+
+    def test_delete_missing(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.post(f"/cafes/{self.cafe_id + 1000}/delete")
+            self.assertIn(b"404 - Not Found", resp.data)
+
+        self.assertEqual(Cafe.query.count(), 1)
+
+    def test_bulk_delete(self):
+        cafes = [Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}) for i in range(3)]
+        db.session.add_all(cafes)
+        db.session.commit()
+        db.session.add(Like(user_id=self.admin_id, cafe_id=cafes[0].id))
+        db.session.commit()
+
+        doomed = [self.cafe_id, cafes[0].id, cafes[1].id]
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.post(
+                "/api/cafes/delete",
+                json={"cafe_ids": doomed + [cafes[2].id + 1000]})
+            self.assertEqual(resp.json, {"deleted": sorted(doomed)})
+
+            self.assertEqual(
+                [cafe.id for cafe in Cafe.query], [cafes[2].id])
+            self.assertEqual(Like.query.count(), 0)
+
+            for cafe_ids in [["x"], [None], [[1]]]:
+                resp = client.post(
+                    "/api/cafes/delete", json={"cafe_ids": cafe_ids})
+                self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_delete_not_admin(self):
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, user.id)
+            resp = client.post(
+                "/api/cafes/delete", json={"cafe_ids": [self.cafe_id]})
+            self.assertEqual(resp.status_code, 403)
+
+        self.assertIsNotNone(db.session.get(Cafe, self.cafe_id))
+
+    def test_edit_specialities(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            client.post(
+                f"/cafes/{self.cafe_id}/edit",
+                data={**CAFE_DATA_EDIT, "specialities": "espresso, wifi,,Wifi"})
+            before = {
+                s.name: s.id
+                for s in Speciality.query.filter_by(cafe_id=self.cafe_id)}
+            self.assertEqual(set(before), {"espresso", "wifi"})
+
+            resp = client.get(f"/cafes/{self.cafe_id}/edit")
+            self.assertIn(b'value="espresso, wifi"', resp.data)
+
+            with count_queries() as queries:
+                client.post(
+                    f"/cafes/{self.cafe_id}/edit",
+                    data={**CAFE_DATA_EDIT, "specialities": "wifi, pour over"})
+            self.assertFalse(any(
+                q.startswith("UPDATE specialities") for q in queries))
+
+            after = {
+                s.name: s.id
+                for s in Speciality.query.filter_by(cafe_id=self.cafe_id)}
+            self.assertEqual(set(after), {"wifi", "pour over"})
+            # the unchanged one was kept, not rewritten
+            self.assertEqual(after["wifi"], before["wifi"])
+
+            resp = client.post(
+                f"/cafes/{self.cafe_id}/edit",
+                data={**CAFE_DATA_EDIT, "specialities": "x" * 101})
+            self.assertIn(b"at most 100 characters", resp.data)
+
+    def test_add_specialities(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            client.post(
+                "/cafes/add",
+                data={**CAFE_DATA_EDIT, "specialities": "espresso, wifi"})
+
+        cafe = Cafe.query.filter_by(name=CAFE_DATA_EDIT["name"]).one()
+        self.assertEqual(
+            sorted(s.name for s in cafe.specialities), ["espresso", "wifi"])
+
+    def test_edit_updates_cached_detail(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            client.get(f"/cafes/{self.cafe_id}")
+
+            client.post(f"/cafes/{self.cafe_id}/edit", data=CAFE_DATA_EDIT)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(b"new-description", resp.data)
+
+    def test_edit_form_shows_curr_data(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
+            self.assertIn(b'Test description', resp.data)
+
+
+class SearchIndexTestCase(TestCase):
+    """Tests that search queries are served by their indexes."""
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def explain(self, query):
+        """Return the query plan for this ORM query as one string."""
+
+        compiled = query.statement.compile(
+            dialect=db.engine.dialect,
+            compile_kwargs={"render_postcompile": True},
+        )
+        connection = db.session.connection()
+        # tables are tiny in tests, so make the planner show its index choice
+        connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        rows = connection.exec_driver_sql(
+            f"EXPLAIN {compiled}", compiled.params)
+        return "\n".join(row[0] for row in rows)
+
+    def test_fulltext_index_used(self):
+        plan = self.explain(fulltext_search("coffee"))
+        self.assertIn("ix_cafes_search_vector", plan)
+
+    def test_tag_index_used(self):
+        query = Cafe.query.filter(Cafe.id.in_(
+            Speciality.cafe_ids_tagged(["espresso", "wifi"])))
+        plan = self.explain(query)
+        self.assertIn("ix_specialities_lower_name_cafe_id", plan)
+
+    def test_search_vector_not_loaded(self):
+        columns = str(Cafe.query.statement).split(" FROM ")[0]
+        self.assertNotIn("search_vector", columns)
+
+    @skipUnless(HAS_PG_TRGM, "pg_trgm extension not available")
+    def test_trigram_indexes_used(self):
+        plan = self.explain(trigram_search("perch cofee"))
+        self.assertIn("ix_cafes_name_trgm", plan)
+        self.assertIn("ix_specialities_name_trgm", plan)
+
+
+class LRUCacheTestCase(TestCase):
+    """Tests for the in-process LRU cache."""
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats(), {
+            "hits": 2, "misses": 1, "size": 2, "maxsize": 2})
+
+    def test_ttl(self):
+        cache = LRUCache(2, ttl=-1)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+
+class PrefixIndexTestCase(TestCase):
+    """Tests for the in-memory typeahead index."""
+
+    def test_search_word_prefixes(self):
+        index = PrefixIndex(["Perch Coffee", "Bernie's", "Coffee Bar"])
+        self.assertEqual(index.search("COF", 10), ["Perch Coffee", "Coffee Bar"])
+        self.assertEqual(index.search("perch  c", 10), ["Perch Coffee"])
+        self.assertEqual(index.search("cof", 1), ["Perch Coffee"])
+        self.assertEqual(index.search("", 10), [])
+
+    def test_add_remove(self):
+        index = PrefixIndex(["Starbucks", "Starbucks"])
+        index.remove("Starbucks")
+        self.assertEqual(index.search("star", 10), ["Starbucks"])
+        index.remove("Starbucks")
+        self.assertEqual(index.search("star", 10), [])
+
+        index.add("Starbucks")
+        self.assertEqual(index.search("star", 10), ["Starbucks"])
+
+    def test_rebuild_once_at_a_time(self):
+        index = Suggestions()
+        rebuilds = []
+
+        def rebuild():
+            rebuilds.append(threading.current_thread())
+            time.sleep(0.05)
+            index._cafes = PrefixIndex(["Perch Coffee"])
+            index._specialities = PrefixIndex()
+
+        with patch.object(index, "rebuild", rebuild):
+            threads = [
+                threading.Thread(target=index.suggest, args=("per",))
+                for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(rebuilds), 1)
+
+
+class SuggestionsTestCase(TestCase):
+    """Tests for rebuilding suggestions from the database."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.add(City(**CITY_DATA))
+        db.session.add(Cafe(**CAFE_DATA))
+        db.session.commit()
+
+    def tearDown(self):
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_built_in_background(self):
+        index = Suggestions(max_age=3600)
+        index.app = app
+        index._start_refresher()
+
+        for _ in range(100):
+            if index._cafes is not None:
+                break
+            time.sleep(0.05)
+
+        with count_queries() as queries:
+            self.assertEqual(index.suggest("test")["cafes"], ["Test Cafe"])
+        self.assertEqual(queries, [])
+
+    def test_add_during_rebuild_kept(self):
+        index = Suggestions()
+        query = db.session.query
+
+        def add_while_reading(*args):
+            # as if another request added a cafe meanwhile
+            index.add_cafe("Perch Coffee", ["espresso"])
+            return query(*args)
+
+        with patch.object(db.session, "query", add_while_reading):
+            index.rebuild()
+
+        self.assertEqual(index.suggest("per")["cafes"], ["Perch Coffee"])
+        self.assertEqual(index.suggest("esp")["specialities"], ["espresso"])
+        self.assertEqual(index.suggest("test")["cafes"], ["Test Cafe"])
+
+
+class SuggestViewsTestCase(TestCase):
+    """Tests for the typeahead suggestion API."""
+
+    def setUp(self):
+        """Before each test, add a cafe with a speciality and an admin."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**{**CAFE_DATA, "name": "Perch Coffee"})
+        cafe.specialities.append(Speciality(name="Pour over"))
+        db.session.add(cafe)
+
+        admin = User(**ADMIN_USER_DATA)
+        db.session.add(admin)
+
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.admin_id = admin.id
+        suggestions.reset()
+
+    def tearDown(self):
+        """After each test, remove all cafes and users."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+        suggestions.reset()
+
+    def test_suggest(self):
+        with app.test_client() as client:
+            resp = client.get("/api/search/suggest?q=p")
+            self.assertEqual(
+                resp.json, {"cafes": ["Perch Coffee"], "specialities": ["Pour over"]})
+
+            with count_queries() as queries:
+                resp = client.get("/api/search/suggest?q=coff")
+            self.assertEqual(resp.json["cafes"], ["Perch Coffee"])
+            self.assertEqual(queries, [])
+
+    def test_suggest_skips_current_user(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            client.get("/api/search/suggest?q=p")
+            user_cache.clear()
+
+            # g.user is never used, so it's never looked up
+            with count_queries() as queries:
+                client.get("/api/search/suggest?q=p")
+            self.assertEqual(queries, [])
+
+    def test_suggest_after_delete(self):
+        with app.test_client() as client:
+            login_for_test(client, self.admin_id)
+            client.get("/api/search/suggest?q=p")
+            client.post(f"/cafes/{self.cafe_id}/delete")
+
+            resp = client.get("/api/search/suggest?q=p")
+            self.assertEqual(resp.json, {"cafes": [], "specialities": []})
+
+
+class ImagesTestCase(TestCase):
+    """Tests for saving smaller copies of images."""
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "photo.jpg")
+        with open(self.path, "wb") as f:
+            f.write(FAKE_PHOTO)
+
+    def test_make_derivatives(self):
+        make_derivatives(self.path, [300, 2000])
+
+        for ext, format in [("webp", "WEBP"), ("jpg", "JPEG")]:
+            with Image.open(get_derivative_path(self.path, 300, ext)) as image:
+                self.assertEqual(image.format, format)
+                self.assertEqual(image.size, (300, 225))
+
+            # never scaled up
+            with Image.open(get_derivative_path(self.path, 2000, ext)) as image:
+                self.assertEqual(image.size, (1200, 900))
+
+    def test_make_missing_derivatives(self):
+        make_derivatives(self.path, [300])
+        derivative = get_derivative_path(self.path, 300, "jpg")
+        os.utime(derivative, ns=(0, 0))
+
+        make_derivatives(self.path, [300, 600], missing_only=True)
+        self.assertEqual(os.stat(derivative).st_mtime_ns, 0)
+        self.assertTrue(
+            os.path.exists(get_derivative_path(self.path, 600, "webp")))
+
+    def test_remove_derivatives(self):
+        make_derivatives(self.path, [300, 600])
+        remove_derivatives(self.path)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["photo.jpg"])
+
+
+class MapImageViewsTestCase(TestCase):
+    """Tests for serving map images."""
+
+    def setUp(self):
+        """Before each test, save a map image."""
+
+        self.key = "a" * 64
+        with open(mapping.get_map_path(self.key), "wb") as f:
+            f.write(FAKE_MAP)
+
+        self.etag = mapping.get_map_etag(mapping.get_map_path(self.key))
+        self.url = f"/maps/{self.key}.jpg"
+
+    def tearDown(self):
+        """After each test, remove the map and reset the send mode."""
+
+        os.remove(mapping.get_map_path(self.key))
+        remove_derivatives(mapping.get_map_path(self.key))
+        app.config['MAP_SEND_MODE'] = 'sendfile'
+
+    def test_map_image(self):
+        with app.test_client() as client:
+            resp = client.get(self.url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.data, FAKE_MAP)
+            self.assertEqual(resp.get_etag(), (self.etag, False))
+            self.assertTrue(resp.cache_control.must_revalidate)
+            self.assertEqual(resp.cache_control.max_age, 0)
+
+    def test_versioned_map_cached_for_good(self):
+        version = mapping.get_map_version(self.key)
+        self.assertEqual(self.etag[:len(version)], version)
+
+        with app.test_client() as client:
+            resp = client.get(f"{self.url}?v={version}")
+            self.assertEqual(resp.cache_control.max_age, app.config['MAP_MAX_AGE'])
+            self.assertTrue(resp.cache_control.immutable)
+
+            # an old version must still be revalidated
+            resp = client.get(f"{self.url}?v=0123456789abcdef")
+            self.assertFalse(resp.cache_control.immutable)
+
+    def test_map_not_modified(self):
+        with app.test_client() as client:
+            resp = client.get(self.url, headers={"If-None-Match": f'"{self.etag}"'})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+    def test_map_changed_gets_new_etag(self):
+        with open(mapping.get_map_path(self.key), "wb") as f:
+            f.write(b"a different map")
+        os.utime(mapping.get_map_path(self.key), ns=(0, 0))
+
+        with app.test_client() as client:
+            resp = client.get(self.url, headers={"If-None-Match": f'"{self.etag}"'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.data, b"a different map")
+
+    def test_missing_map_placeholder(self):
+        with app.test_client() as client:
+            for url in ["/maps/12345.jpg", f"/maps/{'b' * 64}.jpg", "/maps/..jpg"]:
+                resp = client.get(url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.mimetype, "image/svg+xml")
+                self.assertEqual(
+                    resp.cache_control.max_age,
+                    app.config['MAP_PLACEHOLDER_MAX_AGE'])
+
+            etag, _ = resp.get_etag()
+            resp = client.get(url, headers={"If-None-Match": f'"{etag}"'})
+            self.assertEqual(resp.status_code, 304)
+
+    def test_map_derivative(self):
+        make_derivatives(mapping.get_map_path(self.key), mapping.MAP_WIDTHS)
+
+        with app.test_client() as client:
+            resp = client.get(f"/maps/{self.key}-250.webp")
+            self.assertEqual(resp.mimetype, "image/webp")
+            self.assertEqual(Image.open(io.BytesIO(resp.data)).width, 250)
+
+            # versioned by the full map, so they change together
+            version = mapping.get_map_version(self.key)
+            resp = client.get(f"/maps/{self.key}-250.jpg?v={version}")
+            self.assertEqual(resp.mimetype, "image/jpeg")
+            self.assertTrue(resp.cache_control.immutable)
+
+    def test_missing_derivative_gets_map(self):
+        with app.test_client() as client:
+            resp = client.get(f"/maps/{self.key}-500.webp")
+            self.assertEqual(resp.mimetype, "image/jpeg")
+            self.assertEqual(resp.data, FAKE_MAP)
+
+    def test_map_x_sendfile(self):
+        app.config['MAP_SEND_MODE'] = 'x-sendfile'
+        with app.test_client() as client:
+            resp = client.get(self.url)
+            self.assertEqual(
+                resp.headers["X-Sendfile"], mapping.get_map_path(self.key))
+            self.assertEqual(resp.data, b"")
+
+    def test_map_x_accel_redirect(self):
+        app.config['MAP_SEND_MODE'] = 'x-accel'
+        with app.test_client() as client:
+            resp = client.get(self.url)
+            self.assertEqual(
+                resp.headers["X-Accel-Redirect"],
+                f"{app.config['MAP_ACCEL_PREFIX']}{self.key}.jpg")
+            self.assertNotIn("X-Sendfile", resp.headers)
+            self.assertEqual(resp.get_etag(), (self.etag, False))
+
+
+class ImageProxyViewsTestCase(TestCase):
+    """Tests for serving images on other hosts through the proxy."""
+
+    def setUp(self):
+        self.directory = image_proxy.directory
+        image_proxy.directory = tempfile.mkdtemp()
+        image_proxy._failures.clear()
+        FakeMapQuestHandler.requests = []
+
+    def tearDown(self):
+        image_proxy.directory = self.directory
+        image_proxy.max_bytes = app.config['IMAGE_PROXY_MAX_BYTES']
+        image_proxy.max_total_bytes = app.config['IMAGE_PROXY_CACHE_BYTES']
+        image_proxy.timeout = app.config['IMAGE_PROXY_TIMEOUT']
+
+    def proxied(self, url):
+        with app.test_request_context():
+            return proxied_image_url(url)
+
+    def test_proxy_image(self):
+        with app.test_client() as client:
+            for i in range(2):
+                resp = client.get(self.proxied(FAKE_PHOTO_URL))
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.mimetype, "image/jpeg")
+                self.assertEqual(resp.data, FAKE_PHOTO)
+                self.assertEqual(
+                    resp.cache_control.max_age, app.config['IMAGE_PROXY_MAX_AGE'])
+                self.assertTrue(resp.cache_control.immutable)
+
+            etag, _ = resp.get_etag()
+            resp = client.get(
+                self.proxied(FAKE_PHOTO_URL), headers={"If-None-Match": f'"{etag}"'})
+            self.assertEqual(resp.status_code, 304)
+
+        # fetched just once
+        self.assertEqual(FakeMapQuestHandler.requests, ["/photos/cafe.jpg"])
+
+    def test_local_images_not_proxied(self):
+        self.assertEqual(
+            self.proxied("/static/images/default-pic.jpg"),
+            "/static/images/default-pic.jpg")
+
+    def test_unsigned_url(self):
+        with app.test_client() as client:
+            resp = client.get(
+                "/images/proxy", query_string={"url": FAKE_PHOTO_URL, "s": "x"})
+            self.assertEqual(resp.status_code, 403)
+
+        self.assertEqual(FakeMapQuestHandler.requests, [])
+
+    def assert_fallback(self, resp):
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            resp.cache_control.max_age,
+            app.config['IMAGE_PROXY_FALLBACK_MAX_AGE'])
+        with open(os.path.join(app.static_folder, "images", "default-pic.jpg"), "rb") as f:
+            self.assertEqual(resp.data, f.read())
+
+    def test_too_large(self):
+        image_proxy.max_bytes = len(FAKE_PHOTO) - 1
+        with app.test_client() as client:
+            self.assert_fallback(client.get(self.proxied(FAKE_PHOTO_URL)))
+
+            # not tried again for a while
+            self.assert_fallback(client.get(self.proxied(FAKE_PHOTO_URL)))
+
+        self.assertEqual(len(FakeMapQuestHandler.requests), 1)
+        self.assertEqual(os.listdir(image_proxy.directory), [])
+
+    def test_timeout(self):
+        image_proxy.timeout = 0.2
+        with app.test_client() as client:
+            self.assert_fallback(client.get(self.proxied(f"{FAKE_HOST}/slow/a.jpg")))
+
+    def test_not_an_image(self):
+        with app.test_client() as client:
+            self.assert_fallback(client.get(self.proxied(f"{FAKE_HOST}/text/a.jpg")))
+
+        self.assertEqual(os.listdir(image_proxy.directory), [])
+
+    def test_least_recently_used_removed(self):
+        image_proxy.max_total_bytes = len(FAKE_PHOTO) * 2
+        urls = [f"{FAKE_PHOTO_URL}?{i}" for i in range(3)]
+
+        with app.test_client() as client:
+            client.get(self.proxied(urls[0]))
+            client.get(self.proxied(urls[1]))
+            os.utime(image_proxy.find(image_proxy.get_key(urls[1]))[0], (0, 0))
+            client.get(self.proxied(urls[2]))
+
+        kept = [url for url in urls if image_proxy.find(image_proxy.get_key(url))]
+        self.assertEqual(kept, [urls[0], urls[2]])
+
+    def test_private_hosts_refused(self):
+        local_url = f"http://localhost:{fake_mapquest.server_port}/photos/a.jpg"
+
+        with app.test_client() as client:
+            for url in [
+                local_url,
+                "http://169.254.169.254/latest/meta-data/",
+                "http://10.0.0.1/a.jpg",
+                "http://[::1]/a.jpg",
+            ]:
+                self.assert_fallback(client.get(self.proxied(url)))
+
+            self.assertEqual(FakeMapQuestHandler.requests, [])
+
+            # nor reached by a redirect from an allowed host
+            self.assert_fallback(client.get(
+                self.proxied(f"{FAKE_HOST}/redirect/{local_url}")))
+
+        self.assertEqual(
+            FakeMapQuestHandler.requests, [f"/redirect/{local_url}"])
+
+    def test_redirect_followed(self):
+        with app.test_client() as client:
+            resp = client.get(
+                self.proxied(f"{FAKE_HOST}/redirect/{FAKE_PHOTO_URL}"))
+            self.assertEqual(resp.data, FAKE_PHOTO)
+
+
+class MapsCommandTestCase(TestCase):
+    """Tests for the `flask maps regenerate` command."""
+
+    def setUp(self):
+        """Before each test, add cafes in two cities."""
+
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        cafes = [Cafe(**{**CAFE_DATA, "address": f"{i} Main St"})
+                 for i in range(3)]
+        cafes.append(Cafe(**{**CAFE_DATA, "city_code": "oak"}))
+        db.session.add_all(cafes)
+        db.session.commit()
+
+        self.cafe_ids = [cafe.id for cafe in cafes]
+        self.progress_file = os.path.join(tempfile.mkdtemp(), "progress")
+        FakeMapQuestHandler.requests = []
+
+        self.maps_dir = mapping.MAPS_DIR
+        mapping.MAPS_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        mapping.MAPS_DIR = self.maps_dir
+        FakeMapQuestHandler.failures = 0
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def regenerate(self, *args):
+        runner = app.test_cli_runner()
+        return runner.invoke(args=[
+            "maps", "regenerate", "--rate", "0",
+            "--progress-file", self.progress_file, *args])
+
+    def test_regenerate(self):
+        result = self.regenerate("--parallel", "2")
+        self.assertIn("Regenerated maps for 4 cafes.", result.output)
+        self.assertEqual(len(FakeMapQuestHandler.requests), 4)
+
+        for cafe in Cafe.query.all():
+            db.session.refresh(cafe)
+            self.assertEqual(cafe.map_status, Cafe.MAP_READY)
+
+    def test_progress_recorded_after_commit(self):
+        cafes = (
+            db.session.query(Cafe.id, Cafe.address, City.name, City.state)
+            .join(Cafe.city)
+            .all()
+        )
+        recorded = []
+
+        def on_saved(cafe_ids):
+            # on another connection, so it only sees what's committed
+            with db.engine.connect() as connection:
+                statuses = connection.execute(
+                    select(Cafe.map_status).where(Cafe.id.in_(cafe_ids)))
+                self.assertEqual(
+                    {status for (status,) in statuses}, {Cafe.MAP_READY})
+            recorded.extend(cafe_ids)
+
+        failed = save_maps(cafes, 2, 0, on_saved=on_saved)
+
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(recorded), sorted(self.cafe_ids))
+
+    def test_regenerate_city(self):
+        result = self.regenerate("--city", "oak")
+        self.assertIn("Regenerated maps for 1 cafes.", result.output)
+
+    def test_regenerate_shared_location(self):
+        db.session.add(Cafe(**{**CAFE_DATA, "address": "0  main st"}))
+        db.session.commit()
+
+        result = self.regenerate()
+        self.assertIn("Regenerated maps for 5 cafes.", result.output)
+        self.assertEqual(len(FakeMapQuestHandler.requests), 4)
+
+    def test_gc(self):
+        self.regenerate()
+        cafe = db.session.get(Cafe, self.cafe_ids[0])
+        db.session.refresh(cafe)
+        kept = mapping.get_map_path(cafe.map_key)
+        removed = db.session.get(Cafe, self.cafe_ids[1]).map_key
+        db.session.delete(db.session.get(Cafe, self.cafe_ids[1]))
+        db.session.commit()
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["maps", "gc", "--min-age", "0"])
+        self.assertIn("Removed 1 unused maps.", result.output)
+        self.assertTrue(os.path.exists(kept))
+        self.assertTrue(os.path.exists(get_derivative_path(kept, 500, "webp")))
+
+        # its smaller copies go too
+        self.assertEqual(
+            [name for name in os.listdir(mapping.MAPS_DIR)
+             if name.startswith(removed)], [])
+
+    def test_regenerate_resume(self):
+        FakeMapQuestHandler.failures = 1
+        result = self.regenerate("--parallel", "1")
+        self.assertIn("1 failed", result.output)
+
+        FakeMapQuestHandler.requests = []
+        result = self.regenerate("--resume")
+        self.assertIn("Skipping 3 cafes", result.output)
+        self.assertIn("Regenerated maps for 1 cafes.", result.output)
+        self.assertEqual(len(FakeMapQuestHandler.requests), 1)
+
+
+class ImportCommandTestCase(TestCase):
+    """Tests for the `flask cafes import` command."""
+
+    def setUp(self):
+        """Before each test, add a city and one cafe."""
+
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.dir = tempfile.mkdtemp()
+        FakeMapQuestHandler.requests = []
+
+        self.maps_dir = mapping.MAPS_DIR
+        mapping.MAPS_DIR = tempfile.mkdtemp()
 
     def tearDown(self):
         """After each test, remove all cafes."""
 
+        mapping.MAPS_DIR = self.maps_dir
         Cafe.query.delete()
         City.query.delete()
-        User.query.delete()
         db.session.commit()
 
-    def test_list(self):
-        with app.test_client() as client:
-            login_for_test(client, self.admin_id)
-            resp = client.get("/cafes")
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn(b"Test Cafe", resp.data)
-
-    def test_detail(self):
-        with app.test_client() as client:
-            login_for_test(client, self.admin_id)
-            resp = client.get(f"/cafes/{self.cafe_id}")
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn(b"Test Cafe", resp.data)
-            self.assertIn(b'testcafe.com', resp.data)
-
+    def run_import(self, filename, content, *args):
+        path = os.path.join(self.dir, filename)
+        with open(path, "w") as f:
+            f.write(content)
+
+        runner = app.test_cli_runner()
+        return runner.invoke(
+            args=["cafes", "import", path, "--rate", "0", *args])
+
+    def test_import_csv(self):
+        result = self.run_import(
+            "cafes.csv",
+            "name,address,city_code,specialities\n" + "".join(
+                f'Cafe {i},{i} Main St,sf,"espresso, wifi"\n'
+                for i in range(5)),
+            "--batch-size", "2")
+
+        self.assertIn("Added 5 cafes and updated 0.", result.output)
+        self.assertIn("Fetched maps for 5 cafes.", result.output)
+        self.assertEqual(len(FakeMapQuestHandler.requests), 5)
+
+        cafe = Cafe.query.filter_by(name="Cafe 3").one()
+        self.assertEqual(cafe.map_status, Cafe.MAP_READY)
+        self.assertEqual(cafe.image_url, "/static/images/default-cafe.jpg")
+        self.assertEqual(
+            sorted(s.name for s in cafe.specialities), ["espresso", "wifi"])
+
+    def test_import_jsonl_updates(self):
+        rows = [
+            {**CAFE_DATA, "description": "Updated", "specialities": ["tea"]},
+            {**CAFE_DATA, "name": "New Cafe"},
+            {**CAFE_DATA, "name": "Bad Cafe", "city_code": "nowhere"},
+            {**CAFE_DATA, "name": "Bad URL", "url": "not a url"},
+        ]
+        result = self.run_import(
+            "cafes.jsonl",
+            "".join(json.dumps(row) + "\n" for row in rows),
+            "--no-maps")
+
+        self.assertIn("Added 1 cafes and updated 1.", result.output)
+        self.assertIn("Skipped 2 invalid rows.", result.output)
+        self.assertIn("line 3: city_code", result.stderr)
+        self.assertIn("line 4: url", result.stderr)
+        self.assertEqual(FakeMapQuestHandler.requests, [])
+
+        cafe = db.session.get(Cafe, self.cafe_id)
+        db.session.refresh(cafe)
+        self.assertEqual(cafe.description, "Updated")
+        self.assertEqual([s.name for s in cafe.specialities], ["tea"])
+        self.assertEqual(Cafe.query.count(), 2)
+
+    def test_import_jsonl_bad_lines(self):
+        lines = [
+            "{not json",
+            json.dumps(["a list"]),
+            json.dumps({**CAFE_DATA, "name": "New Cafe"}),
+        ]
+        result = self.run_import(
+            "cafes.jsonl", "\n".join(lines) + "\n", "--no-maps")
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Added 1 cafes and updated 0.", result.output)
+        self.assertIn("Skipped 2 invalid rows.", result.output)
+        self.assertIn("line 1: not valid JSON", result.stderr)
+        self.assertIn("line 2: not a JSON object", result.stderr)
+
+    def test_import_refetches_map_of_moved_cafe(self):
+        cafe = db.session.get(Cafe, self.cafe_id)
+        cafe.map_key = "somewhere-else"
+        cafe.map_status = Cafe.MAP_READY
+        db.session.commit()
 
-class CafeAdminViewsTestCase(TestCase):
-    """Tests for add/edit views on cafes."""
+        content = json.dumps(CAFE_DATA) + "\n"
+        result = self.run_import("cafes.jsonl", content)
+        self.assertIn("Added 0 cafes and updated 1.", result.output)
+        self.assertIn("Fetched maps for 1 cafes.", result.output)
+
+        cafe = db.session.get(Cafe, self.cafe_id)
+        db.session.refresh(cafe)
+        self.assertEqual(cafe.map_key, cafe.get_map_key())
+        self.assertEqual(cafe.map_status, Cafe.MAP_READY)
+
+        # its map is right now, so it isn't fetched again
+        FakeMapQuestHandler.requests = []
+        result = self.run_import("cafes.jsonl", content)
+        self.assertNotIn("Fetched maps", result.output)
+        self.assertEqual(FakeMapQuestHandler.requests, [])
+
+    def test_one_import_at_a_time(self):
+        with db.engine.connect() as connection:
+            connection.execute(
+                select(func.pg_advisory_lock(IMPORT_LOCK_ID)))
+            try:
+                result = self.run_import(
+                    "cafes.jsonl", json.dumps(CAFE_DATA) + "\n")
+            finally:
+                connection.execute(
+                    select(func.pg_advisory_unlock(IMPORT_LOCK_ID)))
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Another import is running.", result.output)
+        self.assertEqual(Cafe.query.count(), 1)
+
+
+class ExportTestCase(TestCase):
+    """Tests for exporting cafes and likes."""
 
     def setUp(self):
-        """Before each test, add sample city, users, and cafes"""
+        """Before each test, add cafes with specialities, and likes."""
 
-        City.query.delete()
         Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
 
-        sf = City(**CITY_DATA)
-        db.session.add(sf)
-
-        cafe = Cafe(**CAFE_DATA)
-        db.session.add(cafe)
-
+        db.session.add(City(**CITY_DATA))
+        cafes = [Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}) for i in range(3)]
         admin = User(**ADMIN_USER_DATA)
-        db.session.add(admin)
+        db.session.add_all([*cafes, admin])
+        db.session.commit()
 
+        Speciality.set_for_cafe(cafes[0].id, ["wifi", "espresso"])
+        db.session.add(Like(user_id=admin.id, cafe_id=cafes[1].id))
         db.session.commit()
 
-        self.cafe_id = cafe.id
+        self.cafe_ids = [cafe.id for cafe in cafes]
         self.admin_id = admin.id
+
     def tearDown(self):
-        """After each test, delete the cities."""
+        """After each test, remove everything."""
 
         Cafe.query.delete()
         City.query.delete()
         User.query.delete()
         db.session.commit()
 
-    def test_add(self):
+    def test_export_jsonl(self):
         with app.test_client() as client:
             login_for_test(client, self.admin_id)
-            resp = client.get(f"/cafes/add")
-            self.assertIn(b'Add Cafe', resp.data)
-
-            resp = client.post(
-                f"/cafes/add",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'added', resp.data)
-
-    def test_dynamic_cities_vocab(self):
-        id = self.cafe_id
-
-        # the following is a regular expression for the HTML for the drop-down
-        # menu pattern we want to check for
-        choices_pattern = re.compile(
-            r'<select [^>]*name="city_code"[^>]*><option [^>]*value="sf">' +
-            r'San Francisco</option></select>')
-
+            resp = client.get("/api/export/cafes.jsonl")
+
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        rows = [
+            json.loads(line)
+            for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([row["id"] for row in rows], self.cafe_ids)
+        self.assertEqual(rows[0]["specialities"], "espresso, wifi")
+        self.assertEqual(rows[1]["like_count"], 1)
+
+    def test_export_likes_csv(self):
         with app.test_client() as client:
             login_for_test(client, self.admin_id)
-            resp = client.get(f"/cafes/add")
-            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
-
-            resp = client.get(f"/cafes/{id}/edit")
-            self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+            resp = client.get("/api/export/likes.csv")
 
-    def test_edit(self):
-        id = self.cafe_id
+        self.assertEqual(
+            resp.get_data(as_text=True).splitlines(),
+            ["user_id,cafe_id", f"{self.admin_id},{self.cafe_ids[1]}"])
 
+    def test_export_not_admin(self):
         with app.test_client() as client:
-            login_for_test(client, self.admin_id)
-            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
-            self.assertIn(b'Edit Test Cafe', resp.data)
+            resp = client.get("/api/export/cafes.csv")
+            self.assertEqual(resp.status_code, 403)
 
-            resp = client.post(
-                f"/cafes/{id}/edit",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'edited', resp.data)
+    def test_export_command_round_trip(self):
+        path = os.path.join(tempfile.mkdtemp(), "cafes.csv")
+        runner = app.test_cli_runner()
+        runner.invoke(args=["cafes", "export", "-o", path])
 
-    def test_edit_form_shows_curr_data(self):
-        id = self.cafe_id
+        with open(path) as f:
+            self.assertEqual(len(f.readlines()), 4)
 
-        with app.test_client() as client:
-            login_for_test(client, self.admin_id)
-            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
-            self.assertIn(b'Test description', resp.data)
+        # importing the export changes nothing
+        result = runner.invoke(args=["cafes", "import", path, "--no-maps"])
+        self.assertIn("Added 0 cafes and updated 3.", result.output)
+        self.assertEqual(
+            sorted(s.name for s in Speciality.query), ["espresso", "wifi"])
 
 
 #######################################
@@ -356,6 +1827,25 @@ class UserModelTestCase(TestCase):
         rez = User.authenticate("test", "password")
         self.assertFalse(rez)
 
+    def test_authenticate_rehashes(self):
+        self.user.password = hash_password("secret", 4)
+        db.session.commit()
+
+        rez = User.authenticate("test", "secret")
+        self.assertEqual(rez, self.user)
+        self.assertEqual(
+            hash_rounds(self.user.password), password_hasher.rounds)
+
+    def test_authenticate_unknown_user_checks_password(self):
+        checked = []
+        check = password_hasher.check
+        password_hasher.check = lambda *args: checked.append(args) or False
+        try:
+            self.assertFalse(User.authenticate("no-such-user", "secret"))
+        finally:
+            password_hasher.check = check
+        self.assertEqual(len(checked), 1)
+
     def test_full_name(self):
         self.assertEqual(self.user.get_full_name(), "Testy MacTest")
 
@@ -438,6 +1928,19 @@ class AuthViewsTestCase(TestCase):
             self.assertIn(b"Hello, test", resp.data)
             self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
 
+    def test_login_busy(self):
+        slots = password_hasher._slots
+        password_hasher._slots = threading.BoundedSemaphore(1)
+        password_hasher._slots.acquire()
+        try:
+            with app.test_client() as client:
+                resp = client.post(
+                    "/login", data={"username": "test", "password": "secret"})
+                self.assertEqual(resp.status_code, 503)
+                self.assertEqual(resp.headers["Retry-After"], "1")
+        finally:
+            password_hasher._slots = slots
+
     def test_logout(self):
         with app.test_client() as client:
             client.post(
@@ -548,6 +2051,59 @@ class ProfileViewsTestCase(TestCase):
             html = resp.get_data(as_text=True)
             self.assertIn("Edit Your Profile", html)
 
+    def test_current_user_cached(self):
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+            # loads the current user and the suggestion index
+            c.get('/api/search/suggest?q=x')
+
+            with count_queries() as queries:
+                resp = c.get('/api/search/suggest?q=x')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(queries, [])
+
+    def test_profile_edit_updates_cached_user(self):
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+            resp = c.get('/')
+            self.assertIn(b"Testy MacTest", resp.data)
+
+            c.post('/profile/edit', data=TEST_USER_DATA_EDIT)
+
+            resp = c.get('/')
+            self.assertIn(b"new-fn new-ln", resp.data)
+            self.assertEqual(user_cache.get(self.user_id).first_name, "new-fn")
+
+    def test_delete_user_removes_likes(self):
+        sf = City(**CITY_DATA)
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add_all([sf, cafe])
+        db.session.commit()
+        db.session.add(Like(user_id=self.user_id, cafe_id=cafe.id))
+        db.session.commit()
+
+        try:
+            with app.test_client() as c:
+                login_for_test(c, self.user_id)
+                c.post('/profile/delete')
+
+            self.assertIsNone(db.session.get(User, self.user_id))
+            self.assertEqual(Like.query.count(), 0)
+            db.session.refresh(cafe)
+            self.assertEqual(cafe.like_count, 0)
+        finally:
+            Cafe.query.delete()
+            City.query.delete()
+            db.session.commit()
+
+    def test_delete_user_uncaches(self):
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+            c.get('/')
+            c.post('/profile/delete')
+
+            self.assertIsNone(user_cache.get(self.user_id))
+
 
 
 #######################################
@@ -605,6 +2161,19 @@ class LikeViewsTestCase(TestCase):
             html = resp.get_data(as_text=True)
             self.assertIn(f'{self.cafe.name}', html)
 
+    def test_profile_query_budget(self):
+        user = User.query.get(self.user_id)
+        for i in range(5):
+            user.liked_cafes.append(Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}))
+        db.session.commit()
+
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+            with count_queries() as queries:
+                resp = c.get('/profile')
+            self.assertIn(b"Cafe 4", resp.data)
+            self.assertLessEqual(len(queries), 3)
+
     def test_api_likes(self):
         """Tests if a user like adds that cafe to the list."""
 
@@ -618,6 +2187,168 @@ class LikeViewsTestCase(TestCase):
             resp = c.get(f"/api/likes?cafe_id={self.cafe_id}")
             self.assertEqual(resp.json, {"likes": True})
 
+    def test_api_likes_batch(self):
+        other = Cafe(**{**CAFE_DATA, "name": "Other"})
+        db.session.add(other)
+        db.session.add(Like(user_id=self.user_id, cafe_id=self.cafe_id))
+        db.session.commit()
+        expected = {"likes": {str(self.cafe_id): True, str(other.id): False}}
+
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+
+            with count_queries() as queries:
+                resp = c.get(f"/api/likes?cafe_ids={self.cafe_id},{other.id}")
+            self.assertEqual(resp.json, expected)
+            like_queries = [query for query in queries if "FROM likes" in query]
+            self.assertEqual(len(like_queries), 1)
+
+            resp = c.post("/api/likes", json={"cafe_ids": [self.cafe_id, other.id]})
+            self.assertEqual(resp.json, expected)
+
+    def test_api_likes_batch_invalid(self):
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+
+            resp = c.get("/api/likes?cafe_ids=1,x")
+            self.assertEqual(resp.status_code, 400)
+
+            for cafe_ids in ["1", [None], [[1]], [True], [1.5], [2 ** 31]]:
+                resp = c.post("/api/likes", json={"cafe_ids": cafe_ids})
+                self.assertEqual(resp.status_code, 400)
+
+            resp = c.post("/api/likes", json=[1])
+            self.assertEqual(resp.status_code, 400)
+
+            too_many = ",".join(["1"] * (app.config['LIKES_MAX_BATCH'] + 1))
+            resp = c.get(f"/api/likes?cafe_ids={too_many}")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_like_buttons_on_list(self):
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+            resp = c.get("/cafes")
+            self.assertIn(f'data-cafe-id="{self.cafe_id}"'.encode(), resp.data)
+            self.assertIn(b"/static/like.js", resp.data)
+
+    def test_liked_rendered(self):
+        db.session.add(Like(user_id=self.user_id, cafe_id=self.cafe_id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+            for url in [f"/cafes/{self.cafe_id}", "/cafes", "/search"]:
+                html = c.get(url).get_data(as_text=True)
+                self.assertIn('data-liked="true"', html)
+                self.assertIn(
+                    'type="button">Unlike</button>', html)
+
+            c.post('/api/unlike', json={"cafe_id": self.cafe_id})
+            html = c.get(f"/cafes/{self.cafe_id}").get_data(as_text=True)
+            self.assertIn('data-liked="false"', html)
+            self.assertIn('type="button">Like</button>', html)
+
+    def test_liked_ids_cached(self):
+        likes_cache = LRUCache(16, ttl=60)
+        with patch("app.likes_cache", likes_cache), app.test_client() as c:
+            login_for_test(c, self.user_id)
+            c.get(f"/cafes/{self.cafe_id}")
+
+            c.post('/api/like', json={"cafe_id": self.cafe_id})
+            with count_queries() as queries:
+                resp = c.get(f"/api/likes?cafe_id={self.cafe_id}")
+            self.assertEqual(resp.json, {"likes": True})
+            self.assertEqual(queries, [])
+
+    def test_liked_without_cache(self):
+        db.session.add(Like(user_id=self.user_id, cafe_id=self.cafe_id))
+        db.session.commit()
+
+        with patch("app.likes_cache", None), app.test_client() as c:
+            login_for_test(c, self.user_id)
+            with count_queries() as queries:
+                resp = c.get(f"/api/likes?cafe_id={self.cafe_id}")
+            self.assertEqual(resp.json, {"likes": True})
+            self.assertIn("EXISTS", queries[-1])
+
+            html = c.get(f"/cafes/{self.cafe_id}").get_data(as_text=True)
+            self.assertIn('data-liked="true"', html)
+
+    def like_count(self, cafe_id=None):
+        return db.session.execute(
+            text("SELECT like_count FROM cafes WHERE id = :id"),
+            {"id": cafe_id or self.cafe_id},
+        ).scalar()
+
+    def test_like_count(self):
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+
+            c.post('/api/like', json={"cafe_id": self.cafe_id})
+            self.assertEqual(self.like_count(), 1)
+
+            c.post('/api/unlike', json={"cafe_id": self.cafe_id})
+            self.assertEqual(self.like_count(), 0)
+
+    def test_like_count_user_deleted(self):
+        other = User.register(**{**TEST_USER_DATA, "username": "other", "email": "o@o.com"})
+        db.session.commit()
+        db.session.add_all([
+            Like(user_id=self.user_id, cafe_id=self.cafe_id),
+            Like(user_id=other.id, cafe_id=self.cafe_id),
+        ])
+        db.session.commit()
+        self.assertEqual(self.like_count(), 2)
+
+        db.session.delete(other)
+        db.session.commit()
+        self.assertEqual(self.like_count(), 1)
+
+    def test_top_cafes(self):
+        cafes = [Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}) for i in range(3)]
+        db.session.add_all(cafes)
+        db.session.commit()
+        db.session.add_all([
+            Like(user_id=self.user_id, cafe_id=cafes[1].id),
+            Like(user_id=self.user_id, cafe_id=cafes[2].id),
+        ])
+        db.session.commit()
+        other = User.register(**{**TEST_USER_DATA, "username": "other", "email": "o@o.com"})
+        db.session.commit()
+        db.session.add(Like(user_id=other.id, cafe_id=cafes[2].id))
+        db.session.commit()
+        db.session.expire_all()
+
+        with app.test_client() as c:
+            resp = c.get('/api/cafes/top')
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json, {"error": "Not logged in"})
+
+            login_for_test(c, self.user_id)
+            resp = c.get('/api/cafes/top?per_page=2')
+            self.assertEqual(
+                [(cafe["name"], cafe["like_count"]) for cafe in resp.json["cafes"]],
+                [("Cafe 2", 2), ("Cafe 1", 1)])
+            self.assertEqual(resp.json["next_page"], 2)
+
+            resp = c.get('/api/cafes/top?per_page=2&page=2')
+            self.assertEqual(
+                [cafe["like_count"] for cafe in resp.json["cafes"]], [0, 0])
+            self.assertIsNone(resp.json["next_page"])
+
+            resp = c.get('/cafes/top')
+            self.assertIn(b"2 likes", resp.data)
+
+    def test_recount_likes(self):
+        db.session.add(Like(user_id=self.user_id, cafe_id=self.cafe_id))
+        db.session.commit()
+        db.session.execute(text("UPDATE cafes SET like_count = 7"))
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["cafes", "recount-likes"])
+        self.assertIn("Fixed like counts of 1 cafes.", result.output)
+        self.assertEqual(self.like_count(), 1)
+
     def test_api_like(self):
         """Tests if a user can like a cafe"""
 
@@ -625,7 +2356,93 @@ class LikeViewsTestCase(TestCase):
             login_for_test(c, self.user_id)
 
             resp = c.post('/api/like', json={"cafe_id": self.cafe_id})
-            self.assertEqual(resp.json, {"liked": self.cafe_id})
+            self.assertEqual(
+                resp.json,
+                {"liked": self.cafe_id, "likes": True, "like_count": 1})
+
+            # a double click is harmless
+            resp = c.post('/api/like', json={"cafe_id": self.cafe_id})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["like_count"], 1)
+
+    def test_api_like_no_such_cafe(self):
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+
+            resp = c.post('/api/like', json={"cafe_id": self.cafe_id + 1})
+            self.assertEqual(resp.status_code, 404)
+
+            resp = c.post('/api/unlike', json={"cafe_id": self.cafe_id + 1})
+            self.assertEqual(resp.status_code, 404)
+
+    def test_api_like_bad_cafe_id(self):
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+
+            for body in [{}, {"cafe_id": "x"}, {"cafe_id": None},
+                         {"cafe_id": 2 ** 31}, {"cafe_id": True}, [1]]:
+                for url in ['/api/like', '/api/unlike']:
+                    resp = c.post(url, json=body)
+                    self.assertEqual(resp.status_code, 400)
+
+            resp = c.get(f"/api/likes?cafe_id={2 ** 31}")
+            self.assertEqual(resp.status_code, 400)
+
+            # the session is still usable
+            resp = c.post('/api/like', json={"cafe_id": self.cafe_id})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_like_buffer(self):
+        cafe_ids = [self.cafe_id]
+        for i in range(2):
+            cafe = Cafe(**CAFE_DATA)
+            db.session.add(cafe)
+            db.session.commit()
+            cafe_ids.append(cafe.id)
+        db.session.add(Like(user_id=self.user_id, cafe_id=cafe_ids[2]))
+        db.session.commit()
+
+        buffer = LikeBuffer()
+        with patch.dict(app.config, LIKE_BUFFER_INTERVAL=60):
+            buffer.init_app(app)
+
+        with patch("app.like_buffer", buffer), app.test_client() as c:
+            login_for_test(c, self.user_id)
+
+            with count_queries() as queries:
+                for i in range(3):
+                    c.post('/api/like', json={"cafe_id": cafe_ids[0]})
+                    c.post('/api/unlike', json={"cafe_id": cafe_ids[0]})
+                liked = c.post('/api/like', json={"cafe_id": cafe_ids[1]})
+                unliked = c.post('/api/unlike', json={"cafe_id": cafe_ids[2]})
+
+            self.assertFalse([query for query in queries if "INSERT" in query])
+            # counts include the toggles still waiting in the buffer
+            self.assertEqual(liked.json["like_count"], 1)
+            self.assertEqual(unliked.json["like_count"], 0)
+            resp = c.get(f"/api/likes?cafe_ids={','.join(map(str, cafe_ids))}")
+            self.assertEqual(list(resp.json["likes"].values()), [False, True, False])
+
+            with count_queries() as queries:
+                buffer.flush()
+            self.assertEqual(
+                len([query for query in queries if "INSERT" in query or "DELETE" in query]), 2)
+
+        self.assertEqual(Like.cafe_ids_liked_by(self.user_id), {cafe_ids[1]})
+
+    def test_like_buffer_keeps_failed_batch(self):
+        buffer = LikeBuffer()
+        with patch.dict(app.config, LIKE_BUFFER_INTERVAL=60):
+            buffer.init_app(app)
+        buffer.set(self.user_id, self.cafe_id, True)
+
+        with patch.object(Like, "add_many", side_effect=RuntimeError):
+            buffer.flush()
+        self.assertTrue(buffer.get(self.user_id, self.cafe_id))
+
+        buffer.flush()
+        self.assertIsNone(buffer.get(self.user_id, self.cafe_id))
+        self.assertEqual(Like.cafe_ids_liked_by(self.user_id), {self.cafe_id})
 
     def test_api_unlike(self):
         """Tests if a user can unlike a cafe."""
@@ -638,4 +2455,192 @@ class LikeViewsTestCase(TestCase):
             login_for_test(c, self.user_id)
 
             resp = c.post('/api/unlike', json={"cafe_id": self.cafe_id})
-            self.assertEqual(resp.json, {"unliked": self.cafe_id})
\ No newline at end of file
+            self.assertEqual(
+                resp.json,
+                {"unliked": self.cafe_id, "likes": False, "like_count": 0})
+
+            resp = c.post('/api/unlike', json={"cafe_id": self.cafe_id})
+            self.assertEqual(resp.json["like_count"], 0)
+
+
+class ConditionalViewsTestCase(TestCase):
+    """Tests for ETag / Last-Modified and 304 responses."""
+
+    def setUp(self):
+        """Before each test, add a user and a cafe."""
+
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        other = User.register(
+            **{**TEST_USER_DATA, "username": "other", "email": "o@o.com"})
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.user_id = user.id
+        self.other_id = other.id
+
+    def tearDown(self):
+        """After each test, remove everything."""
+
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def assert_not_modified(self, client, url, resp):
+        etag = resp.headers["ETag"]
+        self.assertTrue(etag.startswith("W/"))
+        self.assertIn("no-cache", resp.headers["Cache-Control"])
+
+        again = client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.data, b"")
+        self.assertEqual(again.headers["ETag"], etag)
+        return again
+
+    def assert_modified(self, client, url, resp):
+        again = client.get(
+            url, headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(again.status_code, 200)
+        return again
+
+    def test_cafe_list(self):
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+            resp = c.get("/cafes")
+            resp.get_data()
+            self.assertIsNotNone(resp.last_modified)
+
+            with count_queries() as queries:
+                self.assert_not_modified(c, "/cafes", resp)
+            # the page's validators and the user's likes
+            self.assertLessEqual(len(queries), 2)
+
+            again = c.get("/cafes", headers={
+                "If-Modified-Since": resp.headers["Last-Modified"]})
+            self.assertEqual(again.status_code, 304)
+
+            c.post("/api/like", json={"cafe_id": self.cafe_id})
+            resp = self.assert_modified(c, "/cafes", resp)
+            self.assertIn(b'data-liked="true"', resp.data)
+
+            cafe = db.session.get(Cafe, self.cafe_id)
+            cafe.name = "Renamed Cafe"
+            db.session.commit()
+            resp = self.assert_modified(c, "/cafes", resp)
+            self.assertIn(b"Renamed Cafe", resp.data)
+
+            db.session.add(Cafe(**{**CAFE_DATA, "name": "Another Cafe"}))
+            db.session.commit()
+            resp = self.assert_modified(c, "/cafes", resp)
+            self.assertIn(b"Another Cafe", resp.data)
+
+    def test_cafe_list_with_more_pages(self):
+        for i in range(3):
+            db.session.add(Cafe(**{**CAFE_DATA, "name": f"Cafe {i}"}))
+        db.session.commit()
+
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+            for url in ["/cafes?per_page=1", "/cafes?per_page=2"]:
+                resp = c.get(url)
+                resp.get_data()
+                self.assert_not_modified(c, url, resp)
+
+    def test_cafe_detail(self):
+        url = f"/cafes/{self.cafe_id}"
+
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+            resp = c.get(url)
+            self.assert_not_modified(c, url, resp)
+
+            # someone else's like changes the count shown
+            db.session.add(Like(user_id=self.other_id, cafe_id=self.cafe_id))
+            db.session.commit()
+            resp = self.assert_modified(c, url, resp)
+            self.assertIn(b"1 likes", resp.data)
+
+            Speciality.set_for_cafe(self.cafe_id, ["espresso"])
+            db.session.commit()
+            resp = self.assert_modified(c, url, resp)
+            self.assertIn(b"espresso", resp.data)
+
+        # another user sees their own name and like buttons
+        with app.test_client() as c:
+            login_for_test(c, self.other_id)
+            resp = self.assert_modified(c, url, resp)
+            self.assertIn(b'data-liked="true"', resp.data)
+
+    def test_flashed_message_not_skipped(self):
+        url = f"/cafes/{self.cafe_id}"
+
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+            resp = c.get(url)
+
+            with c.session_transaction() as sess:
+                sess["_flashes"] = [("success", "Hello there")]
+
+            resp = self.assert_modified(c, url, resp)
+            self.assertIn(b"Hello there", resp.data)
+
+    def test_api_likes(self):
+        url = f"/api/likes?cafe_ids={self.cafe_id}"
+
+        with app.test_client() as c:
+            login_for_test(c, self.user_id)
+            resp = c.get(url)
+            self.assert_not_modified(c, url, resp)
+
+            c.post("/api/like", json={"cafe_id": self.cafe_id})
+            resp = self.assert_modified(c, url, resp)
+            self.assertEqual(resp.json, {"likes": {str(self.cafe_id): True}})
+
+
+#######################################
+# seed data
+
+
+class SeedTestCase(TestCase):
+    """Tests for seed.py."""
+
+    def tearDown(self):
+        Speciality.query.delete()
+        Like.query.delete()
+        Cafe.query.delete()
+        User.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_import_does_nothing(self):
+        city = City(**CITY_DATA)
+        db.session.add(city)
+        db.session.commit()
+
+        import seed
+
+        self.assertEqual(City.query.count(), 1)
+
+    def test_seed_with_hash_workers(self):
+        import seed
+
+        hasher = password_hasher
+        settings = (hasher.rounds, hasher.workers, hasher.max_pending)
+        hasher.configure(hasher.rounds, 1, hasher.max_pending)
+        try:
+            seed.seed()
+        finally:
+            hasher.shutdown()
+            hasher.configure(*settings)
+
+        self.assertEqual(Cafe.query.count(), 2)
+        self.assertTrue(User.query.filter_by(username="admin").one().admin)
+        self.assertEqual(
+            {cafe.map_status for cafe in Cafe.query}, {Cafe.MAP_READY})